@@ -0,0 +1,130 @@
+""" Fast answers to "is this username / email address taken?", for the registration form and its AJAX checks """
+from collections import OrderedDict
+import hashlib
+import math
+import threading
+import time
+
+from .models import UserProfile
+
+# Seconds before a process rebuilds its filters, to pick up accounts registered through other processes
+FILTER_MAX_AGE = 60
+
+# How many names confirmed as taken are remembered, and for how many seconds - so the same few prefixes typed by
+# many people signing up at once ("jo", "joh", "john") are only looked up once
+RECENTLY_TAKEN_SIZE = 1024
+RECENTLY_TAKEN_MAX_AGE = 30
+
+def normalize(value):
+    """ The case-folded form of a username or email address, used to compare them case-insensitively """
+    return (value or '').strip().casefold()
+
+def account_keys(user):
+    """ The UserProfile username_key and email_key fields for a User """
+    return {"username_key": normalize(user.username), "email_key": normalize(user.email)}
+
+class BloomFilter:
+    """ A compact set of strings that can answer "definitely not in the set" exactly, while "maybe in the set"
+        is wrong for about `error_rate` of the strings not in it (once `capacity` strings have been added).
+        Strings can't be removed
+    """
+
+    def __init__(self, capacity, error_rate=.01):
+        capacity = max(capacity, 1000)
+        self.size = int(-capacity * math.log(error_rate) / math.log(2) ** 2) # in bits
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, key):
+        # k positions from two halves of one hash (double hashing)
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        h1, h2 = int.from_bytes(digest[:8], 'little'), int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, key):
+        for p in self._positions(key):
+            self.bits[p >> 3] |= 1 << (p & 7)
+
+    def __contains__(self, key):
+        return all(self.bits[p >> 3] & (1 << (p & 7)) for p in self._positions(key))
+
+class AccountNames:
+    """ Looks up usernames and email addresses case-insensitively through the indexed UserProfile keys.
+        `taken` always asks the database. `probably_taken`, for the AJAX checks made on every keystroke, first
+        checks a Bloom filter of every key, so a name no one has is answered without a query, and remembers
+        names it recently found taken. The User signals add new accounts to this process's filters - accounts
+        registered through another process may be reported free for up to FILTER_MAX_AGE seconds, but are
+        still caught by the form's `taken` check when the user submits.
+    """
+
+    FIELDS = {"username": "username_key", "email": "email_key"}
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._build_lock = threading.Lock()
+        self._filters = {} # kind -> (BloomFilter, time built)
+        self._recently_taken = OrderedDict() # (kind, key) -> time found taken
+
+    def taken(self, kind, value):
+        """ Whether a username or email (`kind`) is in use, ignoring case. One indexed query """
+        key = normalize(value)
+        return bool(key) and self._query(kind, key)
+
+    def probably_taken(self, kind, value):
+        """ As `taken`, but answered from memory where possible (see the class docstring) """
+        key = normalize(value)
+        if not key or key not in self._filter(kind):
+            return False
+        now = time.monotonic()
+        found = self._recently_taken.get((kind, key))
+        if found is not None and now - found < RECENTLY_TAKEN_MAX_AGE:
+            return True
+        taken = self._query(kind, key)
+        if taken:
+            with self._lock:
+                self._recently_taken[(kind, key)] = now
+                self._recently_taken.move_to_end((kind, key))
+                if len(self._recently_taken) > RECENTLY_TAKEN_SIZE:
+                    self._recently_taken.popitem(last=False)
+        return taken
+
+    def add(self, user):
+        """ Called when a User is saved: adds their username and email to the filters """
+        keys = account_keys(user)
+        with self._lock:
+            for kind, field in self.FIELDS.items():
+                if keys[field] and kind in self._filters:
+                    self._filters[kind][0].add(keys[field])
+
+    def reset(self):
+        """ Drops the filters, to be rebuilt on next use - e.g. after creating users with bulk_create """
+        with self._lock:
+            self._filters = {}
+            self._recently_taken.clear()
+
+    def _query(self, kind, key):
+        return UserProfile.objects.filter(**{self.FIELDS[kind]: key}).exists()
+
+    def _filter(self, kind):
+        """ Returns the filter for `kind`, building it if there is none, or rebuilding it once it's too old.
+            While one thread rebuilds a filter, the others carry on with the old one
+        """
+        entry = self._filters.get(kind)
+        if entry is not None and time.monotonic() - entry[1] < FILTER_MAX_AGE:
+            return entry[0]
+        if not self._build_lock.acquire(blocking=entry is None):
+            return entry[0]
+        try:
+            built = time.monotonic()
+            field = self.FIELDS[kind]
+            keys = UserProfile.objects.exclude(**{field: ''}).values_list(field, flat=True)
+            bloom = BloomFilter(2 * keys.count()) # room for the accounts registered before the next rebuild
+            for key in keys.iterator():
+                bloom.add(key)
+            with self._lock:
+                self._filters[kind] = (bloom, built)
+            return bloom
+        finally:
+            self._build_lock.release()
+
+account_names = AccountNames()
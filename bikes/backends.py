@@ -0,0 +1,16 @@
+from django.contrib.auth import get_user_model
+from django.contrib.auth.backends import ModelBackend
+
+class ProfileBackend(ModelBackend):
+    """ The default username and password authentication, except that the logged-in user is loaded on each request
+        together with their UserProfile. Nearly every page needs the profile - for the user's role, at least - so
+        this saves a query, and the role is always read fresh from the database, whichever process changed it
+    """
+
+    def get_user(self, user_id):
+        UserModel = get_user_model()
+        try:
+            user = UserModel._default_manager.select_related('userprofile').get(pk=user_id)
+        except UserModel.DoesNotExist:
+            return None
+        return user if self.user_can_authenticate(user) else None
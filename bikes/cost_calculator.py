@@ -1,3 +1,4 @@
+from collections import namedtuple
 from django.conf import settings
 from django.utils import timezone
 import datetime
@@ -6,6 +7,14 @@ import math
 from .choices import MembershipType
 from .models import BikeHires, UserDiscounts
 
+# key in the BASIC_CHARGES setting for each membership type
+MEMBERSHIP_CHARGE_KEYS = {
+    MembershipType.STANDARD: 'standard',
+    MembershipType.STUDENT: 'student',
+    MembershipType.PENSIONER: 'pensioner',
+    MembershipType.STAFF: 'staff',
+}
+
 class CostCalculator():
     """ This class is responsible for calculating the cost of a bike ride based on:
         1. User member type
@@ -66,4 +75,48 @@ class CostCalculator():
         elif membership == MembershipType.STAFF:
             return charges['staff']
         elif membership == MembershipType.PENSIONER:
-            return charges['pensioner']
\ No newline at end of file
+            return charges['pensioner']
+
+
+class Tariff(namedtuple('Tariff', 'basic_charges standard_charge_time_max time_exceeded_interval charge_per_interval')):
+    """ The charge settings used to price hires. Tariff.current() gives the tariff in settings.py """
+
+    @classmethod
+    def current(cls):
+        return cls(
+            basic_charges=settings.BASIC_CHARGES,
+            standard_charge_time_max=settings.STANDARD_CHARGE_TIME_MAX,
+            time_exceeded_interval=settings.TIME_EXCEEDED_INTERVAL,
+            charge_per_interval=settings.CHARGE_PER_INTERVAL
+        )
+
+def calculate_costs(durations, memberships, discounts=None, tariff=None):
+    """ Batch version of CostCalculator.calculate_cost, pricing many hires in one NumPy pass.
+        Takes parallel arrays of hire durations (timedeltas), membership types, and discount fractions
+        (the discount_amount of an applicable discount, or NaN where no discount applies).
+        Returns arrays of (charges, amount saved by discounts), matching CostCalculator exactly.
+    """
+    import numpy as np # not imported at module level, so rider-facing workers don't pay for it at startup
+
+    tariff = tariff or Tariff.current()
+    # durations as whole microseconds, so the interval arithmetic matches timedelta division
+    micros = np.asarray(durations, dtype='timedelta64[us]').astype(np.int64)
+    memberships = np.asarray(memberships, dtype=np.int64)
+
+    basic_by_type = np.full(max(MEMBERSHIP_CHARGE_KEYS) + 1, np.nan) # unknown membership types are NaN
+    for membership, key in MEMBERSHIP_CHARGE_KEYS.items():
+        basic_by_type[membership] = tariff.basic_charges[key]
+    basic_cost = basic_by_type[memberships]
+
+    max_time = tariff.standard_charge_time_max // datetime.timedelta(microseconds=1)
+    interval = tariff.time_exceeded_interval // datetime.timedelta(microseconds=1)
+    number_intervals = np.ceil((micros - max_time) / interval)
+    total = np.where(micros <= max_time, basic_cost, basic_cost + tariff.charge_per_interval * number_intervals)
+
+    if discounts is None:
+        return total, np.zeros(len(total))
+    discounts = np.asarray(discounts, dtype=float)
+    discounted = ~np.isnan(discounts)
+    saved = np.where(discounted, total - total * discounts, 0)
+    total = np.where(discounted, total * discounts, total)
+    return total, saved
@@ -3,6 +3,7 @@ from django.core.exceptions import ValidationError
 from django.core.validators import RegexValidator
 from django.contrib.auth.models import User
 
+from .accounts import account_names
 from .choices import MembershipType, BikeStatus
 from .models import UserProfile, Bikes,BikeRepairs, Location,Discounts
 
@@ -23,13 +24,13 @@ class RegistrationForm(forms.ModelForm):
     
     def clean_username(self):
         username = self.cleaned_data['username']
-        if User.objects.filter(username=username).count() > 0:
+        if account_names.taken('username', username):
             raise ValidationError("Username already exists")
         return username
 
     def clean_email(self):
         email = self.cleaned_data['email'].lower()
-        if User.objects.filter(email=email).count() > 0:
+        if account_names.taken('email', email):
             raise ValidationError("Email already exists")
         return email
     
@@ -91,7 +92,10 @@ class BikeRepairsForm(forms.ModelForm):
 
 class RepairBikeForm(forms.Form):
     """ Form that repairs a bike """
-    bike = forms.ModelChoiceField(queryset=Bikes.objects.filter(status=BikeStatus.BEING_REPAIRED))
+    # each bike's label names its station
+    bike = forms.ModelChoiceField(
+        queryset=Bikes.objects.filter(status=BikeStatus.BEING_REPAIRED).select_related('location')
+    )
 
 class DiscountsForm(forms.ModelForm):
     date_from = forms.DateField(
@@ -1,174 +1,384 @@
+from array import array
+from bisect import bisect
+from itertools import islice
+import datetime
+import heapq
+import random
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.management import call_command
 from django.core.management.base import BaseCommand, CommandError
-from django.contrib.auth import get_user_model
-from django.db import IntegrityError
+from django.db import transaction
+from django.db.models import F, FloatField, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce, Greatest
 from django.utils import timezone
-import random, string, sys
-import datetime
+import numpy as np
 
+from bikes.accounts import account_names, normalize
 from bikes.choices import BikeStatus, UserType, MembershipType
-from bikes.cost_calculator import CostCalculator
-from bikes.models import *
-from reports.models import *
+from bikes.cost_calculator import calculate_costs
+from bikes.models import Bikes, BikeHires, BikeRepairs, Discounts, Location, UserDiscounts, UserProfile
+from bikes.utils import ride_distances
+from reports.cache import bump_data_version
+from reports.models import LocationBikeCount
+
+BATCH_SIZE = 5000
+
+STATIONS = [
+    {"station_name": "University of Glasgow", "latitude": 55.8715, "longitude": -4.2887},
+    {"station_name": "Strathclyde University", "latitude": 55.862785, "longitude": -4.242353},
+    {"station_name": "Glasgow Caledonian University", "latitude": 55.866231, "longitude": -4.250228},
+    {"station_name": "Glasgow Science Centre", "latitude": 55.858680, "longitude": -4.293803},
+    {"station_name": "Trongate", "latitude": 55.855789, "longitude": -4.246063},
+    {"station_name": "Partick Station", "latitude": 55.870007, "longitude": -4.308759},
+]
+CITY_CENTRE = (55.8609, -4.2514) # further stations are scattered around George Square
+STATION_SPREAD_KM = 2.5
+
+MANAGERS = ["lyle", "CJ", "alexander", "ebtihal", "binta", "ligen"]
+OPERATORS = 3
+STARTING_BALANCE = 100
+
+MEMBERSHIP_WEIGHTS = {
+    MembershipType.STANDARD: .55, MembershipType.STUDENT: .25, MembershipType.PENSIONER: .1, MembershipType.STAFF: .1
+}
+
+# relative demand in each hour of the day - commuting peaks on weekdays, and an afternoon peak at weekends
+WEEKDAY_HOURS = [1, .5, .3, .2, .3, 1, 4, 10, 14, 7, 5, 5, 6, 6, 5, 6, 9, 14, 11, 7, 5, 4, 3, 2]
+WEEKEND_HOURS = [2, 1.5, 1, .5, .3, .3, .5, 1, 3, 5, 7, 9, 10, 10, 10, 9, 8, 7, 6, 5, 4, 3, 3, 2]
+WEEKEND_DEMAND = .75
+SEASONAL_SWING = .35 # demand is this much above average in mid July, and below it in mid January
+
+# ride lengths in whole minutes, and the weight of each minute - mostly short rides
+RIDE_MINUTES = np.arange(1, 500)
+RIDE_MINUTE_WEIGHTS = np.select(
+    [RIDE_MINUTES < 36, RIDE_MINUTES < 50, RIDE_MINUTES < 80], [.70, .20, .07], default=.03
+)
+RIDE_SPEED_KMH = 15 # no ride is faster than this, from station to station
+TRIP_DISTANCE_KM = 2 # the chance of riding to a station falls by a factor of e every this many km
+
+DISCOUNT_TAKE_UP = .3 # share of riders who use the discount code, on one of their rides
 
 class Command(BaseCommand):
+    help = "Generates stations, bikes, users and a realistic hire history, reproducibly from a random seed. " \
+           "Each kind of data is only generated if there is none in the database yet."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--stations', type=int, default=len(STATIONS), help="Number of stations")
+        parser.add_argument('--bikes', type=int, default=85, help="Number of bikes")
+        parser.add_argument('--users', type=int, default=3,
+            help=f"Number of customer accounts, besides the {len(MANAGERS)} managers and {OPERATORS} operators")
+        parser.add_argument('--hires', type=int, default=250, help="Number of hires in the history")
+        parser.add_argument('--repairs', type=int, default=25, help="Number of repairs in the history")
+        parser.add_argument('--days', type=int, default=365, help="Length of the history, ending yesterday")
+        parser.add_argument('--seed', type=int, help="Random seed - the same seed and options give the same data")
 
     # This method is executed when the management command is run.
     def handle(self, *args, **kwargs):
-        print("**STARTING**\n")
+        if kwargs['stations'] < 1 or kwargs['bikes'] < 1 or kwargs['days'] < 1:
+            raise CommandError("At least one station, one bike and one day of history are needed")
+        seed = kwargs['seed'] if kwargs['seed'] is not None else random.randrange(2 ** 32)
+        self.rng = np.random.default_rng(seed)
+        self.stdout.write(f"**STARTING** (seed {seed})\n")
+
+        today = timezone.localdate()
+        self.history_start = timezone.make_aware(
+            datetime.datetime.combine(today - datetime.timedelta(days=kwargs['days']), datetime.time())
+        )
+        self.days = kwargs['days']
+
         if Location.objects.count() == 0:
-            self.create_locations()
+            self.create_locations(kwargs['stations'])
         if User.objects.count() == 0:
-            self.create_users()
+            self.create_users(kwargs['users'])
         if Bikes.objects.count() == 0:
-            self.create_bikes()
+            self.create_bikes(kwargs['bikes'])
         if Discounts.objects.count() == 0:
             self.create_discount()
         if BikeHires.objects.count() == 0:
-            self.create_bike_hire_history()
+            self.create_bike_hire_history(kwargs['hires'])
         if BikeRepairs.objects.count() == 0:
-            self.create_repairs()
-        print("\nSCRIPT COMPLETED")
-
-    def create_locations(self):
-        print("Creating locations...")
-        locations = [
-            {"station_name": "University of Glasgow", "latitude": 55.8715, "longitude": -4.2887},
-            {"station_name": "Strathclyde University", "latitude": 55.862785, "longitude": -4.242353},
-            {"station_name": "Glasgow Caledonian University", "latitude": 55.866231, "longitude": -4.250228},
-            {"station_name": "Glasgow Science Centre", "latitude": 55.858680, "longitude": -4.293803},
-            {"station_name": "Trongate", "latitude": 55.855789, "longitude": -4.246063},
-            {"station_name": "Partick Station", "latitude": 55.870007, "longitude": -4.308759},
-        ]
-        for location in locations:
-            Location.objects.create(**location)
-
-    def create_users(self):
-        print("Creating users...")
-        users = [
-            {"username": "lyle", "password": "password", "email": "lyle@gmail.com"},
-            {"username": "CJ", "password": "password", "email": "cj@gmail.com"},
-            {"username": "alexander", "password": "password", "email": "alexander@gmail.com"},
-            {"username": "ebtihal", "password": "password", "email": "ebtihal@gmail.com"},
-            {"username": "binta", "password": "password", "email": "binta@gmail.com"},
-            {"username": "ligen", "password": "password", "email": "ligen@gmail.com"}
-        ]
-        for user in users:
-            db_user = get_user_model().objects.create_user(**user)
-            # set these users as managers
-            UserProfile.objects.filter(user=db_user).update(user_type=UserType.MANAGER, balance=100)
-        
-        # create operators and customers user
-        for i in range(3):
-            customer = User.objects.create_user(
-                username=f"customer{i}", password="password", email=f"customer{i}@gmail.com"
-            )
-            operator = User.objects.create_user(
-                username=f"operator{i}", password="password", email=f"operator{i}@gmail.com"
+            self.create_repairs(kwargs['repairs'])
+        # check each station's bike counters against the bikes created above
+        call_command('reconcile_bike_counts', stdout=self.stdout)
+        bump_data_version()
+        self.stdout.write("\nSCRIPT COMPLETED")
+
+    def create_locations(self, count):
+        self.stdout.write(f"Creating {count} locations...")
+        stations = STATIONS[:count]
+        # the rest are scattered around the city centre, more densely towards the middle
+        for i in range(len(stations), count):
+            north_km, east_km = self.rng.normal(0, STATION_SPREAD_KM, 2)
+            stations.append({
+                "station_name": f"Station {i + 1}",
+                "latitude": CITY_CENTRE[0] + north_km / 111.2,
+                "longitude": CITY_CENTRE[1] + east_km / (111.2 * np.cos(np.radians(CITY_CENTRE[0]))),
+            })
+        bulk_create(Location, (Location(**station) for station in stations))
+
+    def create_users(self, customers):
+        self.stdout.write(f"Creating {len(MANAGERS) + OPERATORS + customers} users...")
+        user_types = {username: UserType.MANAGER for username in MANAGERS}
+        user_types.update({f"operator{i}": UserType.OPERATOR for i in range(OPERATORS)})
+        user_types.update({f"customer{i}": UserType.CUSTOMER for i in range(customers)})
+
+        # every generated user's password is "password" - hashed once, as hashing is deliberately slow
+        password = make_password("password")
+        with transaction.atomic():
+            bulk_create(User, (
+                User(username=username, email=f"{username.lower()}@gmail.com", password=password)
+                for username in user_types
+            ))
+            # bulk_create doesn't send post_save, so the profiles are created here too
+            users = User.objects.filter(userprofile__isnull=True).order_by('pk').values_list('pk', 'username', 'email')
+            weights = np.array(list(MEMBERSHIP_WEIGHTS.values()))
+            memberships = dict(zip(user_types, self.rng.choice(
+                list(MEMBERSHIP_WEIGHTS), size=len(user_types), p=weights / weights.sum()
+            ).tolist()))
+            bulk_create(UserProfile, (
+                UserProfile(
+                    user_id=pk, user_type=user_types[username], membership_type=memberships[username],
+                    balance=STARTING_BALANCE, username_key=normalize(username), email_key=normalize(email)
+                ) for pk, username, email in users.iterator()
+            ))
+        account_names.reset()
+
+    def create_bikes(self, count):
+        self.stdout.write(f"Creating {count} bikes...")
+        locations = list(Location.objects.order_by('pk'))
+        # bikes start out where demand is highest
+        popularity = station_popularity([(l.pk, l.latitude, l.longitude) for l in locations])
+        at = self.rng.choice(len(locations), size=count, p=popularity)
+        with transaction.atomic():
+            bulk_create(Bikes, (Bikes(location_id=locations[i].pk, status=BikeStatus.AVAILABLE) for i in at.tolist()))
+            counts = np.bincount(at, minlength=len(locations)).tolist()
+            for location, bike_count in zip(locations, counts):
+                location.initial_bike_count = location.bike_count = location.available_bikes = bike_count
+            Location.objects.bulk_update(
+                locations, ['initial_bike_count', 'bike_count', 'available_bikes'], batch_size=BATCH_SIZE
             )
-            UserProfile.objects.filter(user=customer).update(user_type=UserType.CUSTOMER, balance=100)
-            UserProfile.objects.filter(user=operator).update(user_type=UserType.OPERATOR, balance=100)
-
-        for u in UserProfile.objects.all():
-            u.membership_type = random.choice(MembershipType.CHOICES)[0]
-            u.save()
-    
-    def create_bikes(self):
-        print("Creating bikes...")
-        locations = Location.objects.all()
-        for _ in range(85):
-            location = random.choice(locations)
-            Bikes.objects.create(location=location, status=BikeStatus.AVAILABLE)
-        for location in locations:
-            init_count = location.bikes_set.count()
-            location.initial_bike_count = init_count
-            d = timezone.make_aware(datetime.datetime(year=2019, month=1, day=1))
-            LocationBikeCount.objects.create(location=location, count=init_count, datetime=d)
-            location.save()
+            bulk_create(LocationBikeCount, (
+                LocationBikeCount(location_id=location.pk, datetime=self.history_start, count=location.bike_count)
+                for location in locations
+            ))
 
     def create_discount(self):
-        print("Creating discounts...")
-        date_from = timezone.now()
-        date_to   = timezone.now() + timezone.timedelta(days=10)
+        self.stdout.write("Creating discounts...")
+        # valid over the whole history, so the discounted hires in it were priced with it
         Discounts.objects.create(
-            code="ABCDEFG", date_from=date_from, date_to=date_to, discount_amount=0.5 
+            code="ABCDEFG", date_from=self.history_start.date(),
+            date_to=timezone.localdate() + datetime.timedelta(days=10), discount_amount=0.5
         )
 
-    def create_bike_hire_history(self):
-        print("Creating historical data...")
-        users = UserProfile.objects.all()
-        locations = Location.objects.all()
-        bikes = Bikes.objects.all()
+    def create_bike_hire_history(self, count):
+        self.stdout.write(f"Creating {count} historical hires...")
+        locations = list(Location.objects.order_by('pk').values_list('pk', 'latitude', 'longitude'))
+        bikes = list(Bikes.objects.order_by('pk').values_list('pk', 'location_id'))
+        users = list(UserProfile.objects.order_by('pk').values_list('pk', 'membership_type'))
         discount = Discounts.objects.first()
-        hires = []
-        for i in range(250):
-            duration = self._get_random_duration()
-            start = self._get_random_datetime()
-            end = start + timezone.timedelta(minutes=duration)
-            user = random.choice(users)
-            hire = BikeHires(user=user, date_hired=start, date_returned=end)
-
-            # Add discount to ~30% of the hires
-            if random.random() < 0.3:
-                hire.discount_applied = discount
-                user_discount = UserDiscounts(user=user, discounts=discount, date_used=end)
-
-            # calculate the total cost of the journey, and the amount saved via discount
-            total, amount_saved = CostCalculator(hire).calculate_cost()
-            if hire.discount_applied is not None:
-                user_discount.amount_saved = amount_saved
-                user_discount.save()
-            hire.charges = total
-            user.add_charges(hire.charges)
-            user.save()
-            hires.append(hire)
-        
-        # sort the hires in date order
-        hires = sorted(hires, key=lambda obj: obj.date_hired)
-        
-        for h in hires:
-            bike = random.choice(bikes)
-            bike.last_hired = h.date_hired
-            start_station = bike.location
-            end_station = random.choice(locations)
-            if end_station.pk == start_station.pk:
-                locs = Location.objects.exclude(pk=end_station.pk)
-                end_station = random.choice(locs)
-            h.bike = bike
-            h.start_station = start_station
-            h.end_station = end_station
-            h.save()
-            bike.location = h.end_station
-            bike.save()
-
-    def create_repairs(self):
-        print("Creating repairs...")
-        bikes = Bikes.objects.all()
-        for _ in range(25):
-            bike = random.choice(bikes)
-            dt = self._get_random_datetime()
-            dt_repaired = dt + timezone.timedelta(days=random.randint(1,10))
-            cost = random.randint(2, 40)
-            if cost > 30 and random.random() < .5:
-                cost = cost // 2
-            BikeRepairs.objects.create(bike=bike, date_malfunctioned=dt, date_repaired=dt_repaired, repair_cost=cost)
-
-    def _get_random_duration(self):
-        """ Generates random duration for a ride. A weighted randomization (shorter rides are more likely) """
-        time_ranges = [*list(range(1,36)), *list(range(36,50)), *list(range(50,80)), *list(range(80,500))]
-        weights = [*[.70 for _ in range(1,36)], 
-                    *[.20 for _ in range(36,50)], 
-                    *[.07 for _ in range(50,80)], 
-                    *[.03 for _ in range(80,500)]]
-        duration = random.choices(time_ranges, weights=weights, k=1)[0]
-        return duration
-
-    def _get_random_datetime(self):
-        """ generates random date between 1st January 2019 and current date """
-        start_dt = timezone.now().replace(day=1, month=1).toordinal()
-        end_dt = timezone.now().date().toordinal()
-        random_day = datetime.date.fromordinal(random.randint(start_dt, end_dt))
-        dt = datetime.datetime(year=random_day.year, month=random_day.month, day=random_day.day)
-        dt = dt.replace(hour=random.randint(0,23))
-        dt = dt.replace(minute=random.randint(0,59))
-        dt = dt.replace(second=random.randint(0,59))
-        return timezone.make_aware(dt)
\ No newline at end of file
+        if not users:
+            raise CommandError("There are no users to hire bikes")
+
+        station_index = {pk: i for i, (pk, lat, lon) in enumerate(locations)}
+        docked = [[] for _ in locations]
+        for i, (pk, location_id) in enumerate(bikes):
+            if location_id in station_index:
+                docked[station_index[location_id]].append(i)
+        initial_counts = np.array([len(d) for d in docked])
+
+        hired = self._hire_times(count)
+        horizon = int((timezone.now() - self.history_start).total_seconds()) # every bike is back by now
+        starts, ends, bike_ids, durations, hired = self._ride(locations, docked, hired, horizon)
+        returned = hired + durations
+        if len(hired) < count:
+            self.stdout.write(f"Skipped {count - len(hired)} hires when every bike was out")
+
+        # heavy riders make many more trips than occasional ones
+        activity = self.rng.lognormal(0, 1, len(users))
+        riders = self.rng.choice(len(users), size=len(hired), p=activity / activity.sum())
+
+        # some riders use the discount code, once each
+        order = self.rng.permutation(len(hired))
+        _, first = np.unique(riders[order], return_index=True)
+        discounted = order[first][self.rng.random(len(first)) < DISCOUNT_TAKE_UP]
+        discounts = np.full(len(hired), np.nan)
+        if discount is not None:
+            discounts[discounted] = discount.discount_amount
+
+        memberships = np.array([membership for pk, membership in users])[riders]
+        charges, saved = calculate_costs(durations.astype('timedelta64[s]'), memberships, discounts)
+
+        def at(seconds):
+            return self.history_start + datetime.timedelta(seconds=float(seconds))
+
+        with transaction.atomic():
+            bulk_create(BikeHires, (
+                BikeHires(
+                    user_id=users[rider][0], bike_id=bikes[bike][0],
+                    start_station_id=locations[start][0], end_station_id=locations[end][0],
+                    date_hired=at(hire), date_returned=at(back), charges=cost,
+                    discount_applied=discount if np.isfinite(fraction) else None
+                ) for rider, bike, start, end, hire, back, cost, fraction in rows(
+                    riders, bike_ids, starts, ends, hired, returned, charges, discounts
+                )
+            ))
+            if discount is not None:
+                bulk_create(UserDiscounts, (
+                    UserDiscounts(user_id=users[riders[i]][0], discounts=discount, amount_saved=float(saved[i]))
+                    for i in discounted.tolist()
+                ))
+
+            # charges come out of each rider's balance, and any excess is owed, as in UserProfile.add_charges
+            charged = BikeHires.objects.filter(user=OuterRef('pk')).order_by().values('user') \
+                .annotate(total=Sum('charges')).values('total')
+            total = Coalesce(Subquery(charged, output_field=FloatField()), Value(0.0))
+            UserProfile.objects.update(
+                balance=Greatest(F('balance') - total, Value(0.0)), charges=F('charges') + Greatest(total - F('balance'), Value(0.0))
+            )
+
+            # each bike ends up where its last ride finished
+            last_hire = BikeHires.objects.filter(bike=OuterRef('pk')).order_by('-date_hired')
+            Bikes.objects.filter(pk__in=BikeHires.objects.values('bike')).update(
+                location=Subquery(last_hire.values('end_station')[:1]),
+                last_hired=Subquery(last_hire.values('date_hired')[:1])
+            )
+            Location.objects.bulk_update([
+                Location(pk=pk, bike_count=len(docked[i]), available_bikes=len(docked[i]))
+                for i, (pk, lat, lon) in enumerate(locations)
+            ], ['bike_count', 'available_bikes'], batch_size=BATCH_SIZE)
+
+            # the stations' bike count history: the count after every hire from, and return to, each station
+            stations = np.concatenate((starts, ends))
+            times = np.concatenate((hired, returned))
+            change = np.concatenate((np.full(len(hired), -1), np.ones(len(hired), dtype=int)))
+            order = np.lexsort((-change, times, stations)) # returns before hires at the same moment
+            stations, times, change = stations[order], times[order], change[order]
+            total = np.cumsum(change)
+            before = np.concatenate(([0], total[:-1]))[np.searchsorted(stations, stations)] # total before each station
+            counts = initial_counts[stations] + total - before
+            bulk_create(LocationBikeCount, (
+                LocationBikeCount(location_id=locations[station][0], datetime=at(when), count=count)
+                for station, when, count in rows(stations, times, counts)
+            ))
+
+        # build the hourly and daily bike counts, each user's ride totals, and the stations' trip counts
+        # from the history created above
+        call_command('rebuild_bike_count_rollups', stdout=self.stdout)
+        call_command('rebuild_ride_stats', stdout=self.stdout)
+        call_command('rebuild_trip_counts', stdout=self.stdout)
+
+    def _hire_times(self, count):
+        """ Returns the start of each hire, in seconds from the start of the history, in time order.
+            Demand varies with the season, the day of the week and the hour of the day
+        """
+        days = np.arange(self.days)
+        dates = [self.history_start.date() + datetime.timedelta(days=int(d)) for d in days]
+        weekend = np.array([date.weekday() >= 5 for date in dates], dtype=bool)
+        day_of_year = np.array([date.timetuple().tm_yday for date in dates])
+        demand = np.where(weekend, WEEKEND_DEMAND, 1) * (1 + SEASONAL_SWING * np.cos(2 * np.pi * (day_of_year - 196) / 365.25))
+        day = np.repeat(days, self.rng.multinomial(count, demand / demand.sum()))
+
+        hour = np.empty(count, dtype=int)
+        for is_weekend, weights in ((False, WEEKDAY_HOURS), (True, WEEKEND_HOURS)):
+            on = weekend[day] == is_weekend
+            hour[on] = self.rng.choice(24, size=on.sum(), p=np.array(weights) / sum(weights))
+        return np.sort(day * 86400 + hour * 3600 + self.rng.integers(0, 3600, count))
+
+    def _ride(self, locations, docked, hired, horizon):
+        """ Plays the hires through in time order, so that every bike is hired from where its previous ride ended.
+            Riders start from popular stations and ride to popular stations nearby - if their station is empty,
+            they hire from the nearest station with a bike. `docked` lists the bikes at each station, and is
+            left holding where each bike ends up.
+            Returns arrays of each hire's start station, end station, bike, duration and (for the hires that
+            could be made) start time.
+        """
+        n = len(locations)
+        pks = np.array([pk for pk, lat, lon in locations])
+        km = ride_distances(start_ids=np.repeat(pks, n), end_ids=np.tile(pks, n), method='haversine').reshape(n, n)
+        popularity = station_popularity(locations)
+        attraction = popularity * np.exp(-km / TRIP_DISTANCE_KM)
+        if n > 1:
+            np.fill_diagonal(attraction, 0) # rides end at a different station
+        destinations = (np.cumsum(attraction, axis=1) / attraction.sum(axis=1, keepdims=True)).tolist()
+        nearest = np.argsort(km, axis=1).tolist()
+        shortest = np.ceil(km / RIDE_SPEED_KMH * 3600).astype(int).tolist()
+
+        count = len(hired)
+        wanted = self.rng.choice(n, size=count, p=popularity)
+        where_to = self.rng.random(count)
+        minutes = self.rng.choice(RIDE_MINUTES, size=count, p=RIDE_MINUTE_WEIGHTS / RIDE_MINUTE_WEIGHTS.sum())
+        ride_seconds = minutes * 60 - self.rng.integers(0, 60, count)
+
+        # kept as compact arrays, rather than lists of Python ints, for millions of hires
+        starts, ends, bikes, durations, made = (array('q') for _ in range(5))
+        on_hire = [] # heap of (return time, bike, end station)
+        for when, wanted_start, destination, ride in rows(hired, wanted, where_to, ride_seconds):
+            while on_hire and on_hire[0][0] <= when:
+                _, bike, station = heapq.heappop(on_hire)
+                docked[station].append(bike)
+            start = next((s for s in nearest[wanted_start] if docked[s]), None)
+            if start is None:
+                continue # every bike is out
+            end = min(bisect(destinations[start], destination), n - 1)
+            duration = min(max(ride, shortest[start][end]), horizon - when)
+            bike = docked[start].pop()
+            heapq.heappush(on_hire, (when + duration, bike, end))
+            starts.append(start)
+            ends.append(end)
+            bikes.append(bike)
+            durations.append(duration)
+            made.append(when)
+        for _, bike, station in on_hire:
+            docked[station].append(bike)
+
+        return tuple(np.frombuffer(a, dtype=np.int64) for a in (starts, ends, bikes, durations, made))
+
+    def create_repairs(self, count):
+        self.stdout.write(f"Creating {count} repairs...")
+        bikes = list(Bikes.objects.values_list('pk', flat=True))
+        if not bikes:
+            return
+        broke = self.rng.integers(0, self.days * 86400, count)
+        days_to_fix = self.rng.integers(1, 11, count)
+        costs = self.rng.integers(2, 41, count)
+        # halve about half of the most expensive repairs
+        costs = np.where((costs > 30) & (self.rng.random(count) < .5), costs // 2, costs)
+        bulk_create(BikeRepairs, (
+            BikeRepairs(
+                bike_id=bikes[bike],
+                date_malfunctioned=self.history_start + datetime.timedelta(seconds=when),
+                date_repaired=self.history_start + datetime.timedelta(seconds=when, days=days),
+                repair_cost=cost
+            ) for bike, when, days, cost in zip(
+                self.rng.integers(0, len(bikes), count).tolist(), broke.tolist(), days_to_fix.tolist(), costs.tolist()
+            )
+        ))
+
+def station_popularity(locations):
+    """ Share of the city's demand at each station, given as (pk, latitude, longitude) - busiest in the
+        city centre, with some stations much busier than their neighbours. The same stations always get the same shares
+    """
+    lat, lon = np.array([(lat, lon) for pk, lat, lon in locations]).T
+    north_km = (lat - CITY_CENTRE[0]) * 111.2
+    east_km = (lon - CITY_CENTRE[1]) * 111.2 * np.cos(np.radians(CITY_CENTRE[0]))
+    popularity = np.exp(-np.hypot(north_km, east_km) / (2 * STATION_SPREAD_KM))
+    popularity *= np.random.default_rng([pk for pk, lat, lon in locations]).lognormal(0, .5, len(locations))
+    return popularity / popularity.sum()
+
+def rows(*arrays):
+    """ Iterates over parallel NumPy arrays, yielding a tuple of Python numbers from each position in turn.
+        Only BATCH_SIZE elements at a time are converted, so it takes little memory however long the arrays are
+    """
+    for i in range(0, len(arrays[0]), BATCH_SIZE):
+        yield from zip(*(a[i:i + BATCH_SIZE].tolist() for a in arrays))
+
+def bulk_create(model, objects):
+    """ Inserts the model instances from an iterable, BATCH_SIZE at a time, so they are never all in memory at once """
+    objects = iter(objects)
+    while True:
+        batch = list(islice(objects, BATCH_SIZE))
+        if not batch:
+            break
+        model.objects.bulk_create(batch)
@@ -0,0 +1,109 @@
+import statistics
+import threading
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, DatabaseError
+
+from bikes.choices import BikeStatus
+from bikes.models import Bikes, BikeNotAvailable, Location, UserProfile
+from bikes import utils
+
+class Command(BaseCommand):
+    help = "Hammers one station with concurrent hires and returns, and reports hires/sec and the conflict rate. " \
+           "This writes real hires - run it against a generated dataset, not a live database."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--station', help="Station name to hire from (defaults to the station with the most bikes)")
+        parser.add_argument('--threads', type=int, default=8, help="Number of concurrent simulated riders")
+        parser.add_argument('--seconds', type=float, default=10, help="How long to run for")
+
+    # This method is executed when the management command is run.
+    def handle(self, *args, **kwargs):
+        if kwargs['station']:
+            station = Location.objects.filter(station_name__iexact=kwargs['station']).first()
+        else:
+            station = Location.objects.order_by('-available_bikes').first()
+        if station is None:
+            raise CommandError("No station found - generate some data with add_bike_data first")
+
+        riders = [self._get_rider(i) for i in range(kwargs['threads'])]
+        results = [{"hires": 0, "conflicts": 0, "errors": 0, "return_retries": 0, "latencies": []} for _ in riders]
+        deadline = time.perf_counter() + kwargs['seconds']
+        threads = [
+            threading.Thread(target=self._ride, args=(rider, station, deadline, result))
+            for rider, result in zip(riders, results)
+        ]
+
+        self.stdout.write(f"Hiring from {station.station_name} with {len(threads)} threads for {kwargs['seconds']}s...")
+        start = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - start
+
+        hires = sum(r['hires'] for r in results)
+        conflicts = sum(r['conflicts'] for r in results)
+        errors = sum(r['errors'] for r in results)
+        attempts = hires + conflicts + errors
+        latencies = sorted(l for r in results for l in r['latencies'])
+
+        self.stdout.write(f"Attempts:      {attempts}")
+        self.stdout.write(f"Hires:         {hires} ({hires / elapsed:.1f} hires/sec)")
+        self.stdout.write(f"Conflicts:     {conflicts} ({conflicts / max(attempts, 1):.1%} of attempts)")
+        self.stdout.write(f"Errors:        {errors} (database errors during a hire)")
+        self.stdout.write(f"Return retries: {sum(r['return_retries'] for r in results)}")
+        if latencies:
+            p95 = latencies[min(len(latencies) - 1, int(len(latencies) * .95))]
+            self.stdout.write(f"Hire latency:  p50 {statistics.median(latencies) * 1000:.1f}ms, p95 {p95 * 1000:.1f}ms")
+
+        # the bikes were all returned to the station, but check the counters survived the contention
+        station.refresh_from_db()
+        actual = station.bikes_set.filter(status=BikeStatus.AVAILABLE).count()
+        self.stdout.write(f"Available bikes at station: counter {station.available_bikes}, actual {actual}")
+
+    def _get_rider(self, i):
+        """ Returns the UserProfile for benchmark rider `i`, creating the user if needed, with no hire or charges """
+        user = User.objects.filter(username=f"benchmark{i}").first()
+        if user is None:
+            user = User.objects.create_user(username=f"benchmark{i}", password="password", email=f"benchmark{i}@example.com")
+        UserProfile.objects.filter(user=user).update(current_hire=None, charges=0)
+        return UserProfile.objects.get(user=user)
+
+    def _ride(self, rider, station, deadline, result):
+        """ Repeatedly hires the first available bike at the station, and returns it straight away """
+        try:
+            while time.perf_counter() < deadline:
+                bike = Bikes.objects.filter(location=station, status=BikeStatus.AVAILABLE).order_by('pk').first()
+                if bike is None:
+                    continue # every bike is out - try again
+                start = time.perf_counter()
+                try:
+                    hire = bike.hire(rider)
+                except BikeNotAvailable:
+                    result['conflicts'] += 1
+                    continue
+                except DatabaseError:
+                    result['errors'] += 1
+                    continue
+                result['latencies'].append(time.perf_counter() - start)
+                result['hires'] += 1
+                hire.user = rider
+                hire.bike = bike
+                self._return(hire, station, deadline, result)
+        finally:
+            connection.close() # each thread has its own database connection
+
+    def _return(self, hire, station, deadline, result):
+        """ Returns the bike to the station, retrying if the database is busy - otherwise the rider is stuck on hire """
+        while True:
+            try:
+                utils.return_bike(hire, station, None)
+                return
+            except DatabaseError:
+                result['return_retries'] += 1
+                if time.perf_counter() > deadline + 5:
+                    raise
+                time.sleep(.01)
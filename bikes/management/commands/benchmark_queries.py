@@ -0,0 +1,97 @@
+import statistics
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import Count, Max
+
+from bikes.models import BikeHires, Location
+from reports.models import LocationBikeCount
+from reports.utils import RAW_MAX_SPAN
+
+# The models whose Meta.indexes serve the queries below
+INDEXED_MODELS = (BikeHires, LocationBikeCount)
+
+PAGE_SIZE = 20
+
+class Rollback(Exception):
+    pass
+
+class Command(BaseCommand):
+    help = "Times the hot queries of the user-hires page and the bike location report, and shows their query plans, " \
+           "with the composite indexes on BikeHires and LocationBikeCount and without them. The indexes are " \
+           "dropped inside a transaction that is rolled back, which locks the tables - run it against a generated " \
+           "dataset, not a live database."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repeat', type=int, default=20, help="Number of times to run each query")
+
+    # This method is executed when the management command is run.
+    def handle(self, *args, **kwargs):
+        if not connection.features.can_rollback_ddl:
+            raise CommandError(f"The indexes can't be dropped and restored in a transaction on {connection.vendor}")
+        queries = self._queries()
+        if not queries:
+            raise CommandError("No hires found - generate some data with add_bike_data first")
+
+        try:
+            with transaction.atomic():
+                for model in INDEXED_MODELS:
+                    for index in model._meta.indexes:
+                        with connection.cursor() as cursor:
+                            cursor.execute(f"DROP INDEX {connection.ops.quote_name(index.name)}")
+                without_indexes = {name: self._measure(qs, kwargs['repeat']) for name, qs in queries.items()}
+                raise Rollback # put the indexes back
+        except Rollback:
+            pass
+        # SQLite keeps prepared statements, plans and all, per connection - start again with a new one
+        connection.close()
+        with_indexes = {name: self._measure(qs, kwargs['repeat']) for name, qs in queries.items()}
+
+        self.stdout.write(f"{'Query':<34}{'Indexed ms':>12}{'Unindexed ms':>14}{'Speed-up':>10}")
+        for name in queries:
+            indexed, unindexed = with_indexes[name][0], without_indexes[name][0]
+            self.stdout.write(f"{name:<34}{indexed * 1000:>12.3f}{unindexed * 1000:>14.3f}"
+                              f"{unindexed / max(indexed, 1e-9):>9.1f}x")
+        for name in queries:
+            self.stdout.write(f"\n{name}\n  indexed:\n{indent(with_indexes[name][1])}"
+                              f"\n  unindexed:\n{indent(without_indexes[name][1])}")
+
+    def _queries(self):
+        """ The querysets to time, keyed by description, for the busiest user and station in the data """
+        busiest_user = BikeHires.objects.filter(user__isnull=False).values_list('user').annotate(n=Count('id')) \
+            .order_by('-n').first()
+        station = Location.objects.order_by('-bike_count').first()
+        if busiest_user is None or station is None:
+            return {}
+        user_id = busiest_user[0]
+        latest = LocationBikeCount.objects.filter(location=station).aggregate(last=Max('datetime'))['last']
+
+        user_hires = BikeHires.objects.select_related('start_station', 'end_station') \
+            .filter(user_id=user_id, end_station__isnull=False).order_by('-date_hired')
+        queries = {
+            "A user's latest hires": user_hires[:PAGE_SIZE],
+            "A user's hire history": user_hires,
+        }
+        if latest is not None:
+            queries["A station's recent history"] = LocationBikeCount.objects \
+                .filter(location=station, datetime__gte=latest - RAW_MAX_SPAN, datetime__lte=latest) \
+                .values_list('datetime', 'count')
+        return queries
+
+    def _measure(self, queryset, repeat):
+        """ Returns the median time for the database to run the queryset's SQL and return every row, and its
+            query plan. Building model instances from the rows is left out - the indexes make no difference to it
+        """
+        sql, params = queryset.query.sql_with_params()
+        times = []
+        with connection.cursor() as cursor:
+            for _ in range(repeat + 1):
+                start = time.perf_counter()
+                cursor.execute(sql, params)
+                cursor.fetchall()
+                times.append(time.perf_counter() - start)
+        return statistics.median(times[1:]), queryset.explain() # the first run warms the cache
+
+def indent(text):
+    return '\n'.join(f"    {line}" for line in text.splitlines())
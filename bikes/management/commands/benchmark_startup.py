@@ -0,0 +1,57 @@
+import os
+import statistics
+import subprocess
+import sys
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+# Imported by the reports, and not expected to be loaded when a worker starts
+ANALYTICS_MODULES = ('numpy', 'geopy', 'bokeh', 'matplotlib', 'networkx')
+
+# Run in a fresh interpreter: what a new worker does before serving its first request
+STARTUP = "import django; django.setup(); import {urlconf}"
+
+class Command(BaseCommand):
+    help = "Measures worker startup - Django setup and importing every view - with python -X importtime, " \
+           "and checks that the analytics libraries are left to load on first use"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repeat', type=int, default=5, help="Number of fresh interpreters to time")
+        parser.add_argument('--top', type=int, default=10, help="Number of slowest imports to list")
+
+    # This method is executed when the management command is run.
+    def handle(self, *args, **kwargs):
+        runs = [self._import_times() for _ in range(kwargs['repeat'])]
+        totals = [sum(cumulative for name, self_us, cumulative, depth in run if depth == 0) for run in runs]
+        self.stdout.write(f"Startup imports: median {statistics.median(totals) / 1000:.0f}ms "
+                          f"(min {min(totals) / 1000:.0f}ms, max {max(totals) / 1000:.0f}ms, {len(runs)} runs)")
+
+        self.stdout.write("Slowest imports (cumulative):")
+        run = runs[totals.index(sorted(totals)[len(totals) // 2])]
+        for name, self_us, cumulative, depth in sorted(run, key=lambda r: -r[2])[:kwargs['top']]:
+            self.stdout.write(f"  {cumulative / 1000:8.1f}ms  {name}")
+
+        loaded = sorted({name.split('.')[0] for name, *_ in run} & set(ANALYTICS_MODULES))
+        if loaded:
+            self.stdout.write(self.style.WARNING(f"Analytics modules loaded at startup: {', '.join(loaded)}"))
+        else:
+            self.stdout.write(self.style.SUCCESS("No analytics modules loaded at startup"))
+
+    def _import_times(self):
+        """ Returns (module, self us, cumulative us, nesting depth) for every import made by a fresh worker """
+        code = STARTUP.format(urlconf=settings.ROOT_URLCONF)
+        env = dict(os.environ, DJANGO_SETTINGS_MODULE=os.environ.get('DJANGO_SETTINGS_MODULE', 'rainy.settings'))
+        result = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', code], env=env, cwd=settings.BASE_DIR,
+            stderr=subprocess.PIPE, universal_newlines=True, check=True
+        )
+        imports = []
+        for line in result.stderr.splitlines():
+            # import time: self [us] | cumulative | imported package
+            if not line.startswith('import time:') or 'cumulative' in line:
+                continue
+            self_us, cumulative, name = line[len('import time:'):].split('|')
+            depth = (len(name) - len(name.lstrip()) - 1) // 2
+            imports.append((name.strip(), int(self_us), int(cumulative), depth))
+        return imports
@@ -0,0 +1,148 @@
+import random
+import statistics
+import threading
+import time
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, DatabaseError
+from django.test.utils import override_settings
+
+from bikes.choices import BikeStatus
+from bikes.models import Bikes, BikeNotAvailable, Location, UserProfile
+from bikes import utils
+from reports.utils import financial_summary, trip_counts
+
+class Command(BaseCommand):
+    help = "Measures sustained write throughput under read load: writer threads hire bikes and return them to other " \
+           "stations, while reader threads build the financial and route reports, and the writes/sec, reads/sec " \
+           "and \"database is locked\" errors are reported. This writes real hires - run it against a generated " \
+           "dataset, not a live database."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--writers', type=int, default=8, help="Number of threads hiring and returning bikes")
+        parser.add_argument('--readers', type=int, default=8, help="Number of threads reading reports")
+        parser.add_argument('--seconds', type=float, default=10, help="How long to run for")
+        parser.add_argument('--journal-mode', choices=['delete', 'wal'],
+            help="SQLite journal mode to run with (defaults to the SQLITE_PRAGMAS setting). It's kept in the "
+                 "database file, so the configured mode is put back afterwards")
+        parser.add_argument('--unserialized', action='store_true',
+            help="Let the writes run concurrently, rather than one at a time (see bikes.sqlite.serialized_write)")
+
+    # This method is executed when the management command is run.
+    def handle(self, *args, **kwargs):
+        stations = list(Location.objects.values_list('pk', flat=True))
+        if len(stations) < 2:
+            raise CommandError("At least two stations are needed - generate some data with add_bike_data first")
+        configured_mode = settings.SQLITE_PRAGMAS.get('journal_mode')
+        if kwargs['journal_mode'] and connection.vendor == 'sqlite':
+            self._set_journal_mode(kwargs['journal_mode'])
+
+        writers = [self._get_writer(i) for i in range(kwargs['writers'])]
+        write_results = [{"writes": 0, "errors": 0, "latencies": []} for _ in writers]
+        read_results = [{"reads": 0, "errors": 0} for _ in range(kwargs['readers'])]
+        deadline = time.perf_counter() + kwargs['seconds']
+        threads = [
+            threading.Thread(target=self._write, args=(writer, stations, deadline, result))
+            for writer, result in zip(writers, write_results)
+        ] + [
+            threading.Thread(target=self._read, args=(deadline, result)) for result in read_results
+        ]
+
+        mode = self._journal_mode() if connection.vendor == 'sqlite' else connection.vendor
+        self.stdout.write(f"{len(writers)} writers and {len(read_results)} readers for {kwargs['seconds']}s "
+                          f"(journal mode {mode}, writes {'unserialized' if kwargs['unserialized'] else 'serialized'})...")
+        with override_settings(SQLITE_SERIALIZE_WRITES=not kwargs['unserialized']):
+            start = time.perf_counter()
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            elapsed = time.perf_counter() - start
+
+        writes = sum(r['writes'] for r in write_results)
+        write_errors = sum(r['errors'] for r in write_results)
+        reads = sum(r['reads'] for r in read_results)
+        latencies = sorted(l for r in write_results for l in r['latencies'])
+        self.stdout.write(f"Writes:        {writes} ({writes / elapsed:.1f} writes/sec)")
+        self.stdout.write(f"Errors:        {write_errors} in the writer threads ({write_errors / max(writes + write_errors, 1):.1%} of attempts)")
+        self.stdout.write(f"Reads:         {reads} ({reads / elapsed:.1f} reports/sec), "
+                          f"{sum(r['errors'] for r in read_results)} errors")
+        if latencies:
+            p95 = latencies[min(len(latencies) - 1, int(len(latencies) * .95))]
+            self.stdout.write(f"Write latency: p50 {statistics.median(latencies) * 1000:.1f}ms, p95 {p95 * 1000:.1f}ms")
+
+        if kwargs['journal_mode'] and configured_mode and connection.vendor == 'sqlite':
+            self._set_journal_mode(configured_mode)
+
+    def _journal_mode(self):
+        with connection.cursor() as cursor:
+            cursor.execute("PRAGMA journal_mode")
+            return cursor.fetchone()[0]
+
+    def _set_journal_mode(self, mode):
+        with connection.cursor() as cursor:
+            cursor.execute(f"PRAGMA journal_mode = {mode}")
+
+    def _get_writer(self, i):
+        """ Returns the UserProfile for benchmark writer `i`, creating the user if needed, with no hire or charges """
+        user = User.objects.filter(username=f"benchmark-writer{i}").first()
+        if user is None:
+            user = User.objects.create_user(
+                username=f"benchmark-writer{i}", password="password", email=f"benchmark-writer{i}@example.com"
+            )
+        UserProfile.objects.filter(user=user).update(current_hire=None, charges=0)
+        return UserProfile.objects.get(user=user)
+
+    def _write(self, writer, stations, deadline, result):
+        """ Repeatedly hires an available bike from a random station, and returns it to another.
+            The hire and the return each count as a write
+        """
+        rng = random.Random(writer.pk)
+        try:
+            while time.perf_counter() < deadline:
+                try:
+                    bike = Bikes.objects.filter(location=rng.choice(stations), status=BikeStatus.AVAILABLE).first()
+                    end_station = Location.objects.get(pk=rng.choice(stations))
+                except DatabaseError:
+                    result['errors'] += 1 # without WAL, reads fail too while a write commits
+                    continue
+                if bike is None:
+                    continue
+                hire = self._timed(result, lambda: bike.hire(writer))
+                if hire is None:
+                    continue
+                hire.user, hire.bike = writer, bike
+                # keep trying the return, even past the deadline - otherwise the writer is left with a bike on hire
+                while self._timed(result, lambda: utils.return_bike(hire, end_station, None)) is None:
+                    time.sleep(.01)
+        finally:
+            connection.close() # each thread has its own database connection
+
+    def _timed(self, result, write):
+        """ Makes a write, recording its latency, or the error if it failed. Returns its result, or None if it failed """
+        start = time.perf_counter()
+        try:
+            value = write()
+        except BikeNotAvailable:
+            return None # another writer hired the bike first
+        except DatabaseError:
+            result['errors'] += 1
+            return None
+        result['latencies'].append(time.perf_counter() - start)
+        result['writes'] += 1
+        return value
+
+    def _read(self, deadline, result):
+        """ Repeatedly builds the financial report and the whole network's route counts """
+        try:
+            while time.perf_counter() < deadline:
+                try:
+                    financial_summary()
+                    trip_counts()
+                    result['reads'] += 1
+                except DatabaseError:
+                    result['errors'] += 1
+        finally:
+            connection.close()
@@ -0,0 +1,270 @@
+from http.cookiejar import CookieJar
+from urllib.error import HTTPError, URLError
+from urllib.parse import urlencode
+from urllib.request import HTTPCookieProcessor, HTTPRedirectHandler, build_opener
+import json
+import random
+import re
+import threading
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.urls import reverse
+
+from bikes.choices import UserType
+from bikes.models import Location, UserProfile
+from reports.charts import CHARTS
+
+PASSWORD = "loadtest"
+REQUEST_TIMEOUT = 30 # seconds
+
+# the report pages a manager cycles through, by URL name in reports.urls
+REPORT_PAGES = [
+    'reports_index', 'bike_locations', 'user-report', 'financial-report', 'bike_status', 'path_routes', 'path_routes_graph',
+    'tariff-simulator',
+]
+
+class Command(BaseCommand):
+    help = "Load tests a running server: simulated riders hire and return bikes, operators move bikes, and managers " \
+           "read the reports, all concurrently through the real URLs. Reports the throughput, latency percentiles " \
+           "and error rate of each endpoint. Run it with the same settings as the server - it creates its " \
+           "accounts in the server's database, and writes real hires - against a generated dataset, not a live database."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', default="http://127.0.0.1:8000", help="Address of the server under test")
+        parser.add_argument('--riders', type=int, default=20, help="Number of concurrent simulated riders")
+        parser.add_argument('--operators', type=int, default=2, help="Number of concurrent simulated operators")
+        parser.add_argument('--managers', type=int, default=2, help="Number of concurrent simulated managers")
+        parser.add_argument('--seconds', type=float, default=60, help="How long to run for")
+        parser.add_argument('--think', type=float, default=0,
+            help="Average pause in seconds between a client's requests (0 to send them back to back)")
+        parser.add_argument('--output', help="Write the results to this JSON file")
+        parser.add_argument('--baseline', help="Compare the results with this JSON file, from an earlier --output")
+        parser.add_argument('--tolerance', type=float, default=.2,
+            help="Fail if an endpoint's p95 latency grows, or its throughput falls, by more than this fraction "
+                 "of the baseline, or its error rate rises by more than this many percentage points / 100")
+
+    # This method is executed when the management command is run.
+    def handle(self, *args, **kwargs):
+        stations = list(Location.objects.values_list('pk', flat=True))
+        if len(stations) < 2:
+            raise CommandError("At least two stations are needed - generate some data with add_bike_data first")
+
+        clients = [(self._rider, name) for name in self._accounts('rider', kwargs['riders'], UserType.CUSTOMER)]
+        clients += [(self._operator, name) for name in self._accounts('operator', kwargs['operators'], UserType.OPERATOR)]
+        clients += [(self._manager, name) for name in self._accounts('manager', kwargs['managers'], UserType.MANAGER)]
+        results = [{} for _ in clients] # per client: endpoint -> {"latencies": [...], "errors": n}
+        deadline = time.perf_counter() + kwargs['seconds']
+        threads = [
+            threading.Thread(target=self._run, args=(
+                workflow, Client(kwargs['url'], result), username, stations, deadline, kwargs['think']
+            ))
+            for (workflow, username), result in zip(clients, results)
+        ]
+
+        self.stdout.write(f"Load testing {kwargs['url']} with {kwargs['riders']} riders, {kwargs['operators']} "
+                          f"operators and {kwargs['managers']} managers for {kwargs['seconds']}s...")
+        start = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - start
+
+        report = {
+            "url": kwargs['url'],
+            "clients": {"riders": kwargs['riders'], "operators": kwargs['operators'], "managers": kwargs['managers']},
+            "think": kwargs['think'],
+            "seconds": elapsed,
+            "endpoints": summarise(results, elapsed),
+        }
+        self._print(report['endpoints'])
+        if kwargs['output']:
+            with open(kwargs['output'], 'w') as f:
+                json.dump(report, f, indent=2)
+            self.stdout.write(f"Results written to {kwargs['output']}")
+        if kwargs['baseline']:
+            with open(kwargs['baseline']) as f:
+                baseline = json.load(f)
+            if (baseline['clients'], baseline['think']) != (report['clients'], report['think']):
+                self.stdout.write(self.style.WARNING(
+                    f"The baseline ran {baseline['clients']} clients with a think time of {baseline['think']}s - "
+                    "the results are only comparable with the same load"
+                ))
+            regressions = self._compare(report['endpoints'], baseline['endpoints'], kwargs['tolerance'])
+            if regressions:
+                raise CommandError(f"{regressions} endpoint(s) regressed against {kwargs['baseline']}")
+
+    def _accounts(self, role, count, user_type):
+        """ Returns the usernames of `count` load test accounts of one type, creating them if needed.
+            Each is given enough balance, and its charges cleared, so that its hires aren't refused
+        """
+        usernames = [f"loadtest-{role}{i}" for i in range(count)]
+        for username in usernames:
+            if not User.objects.filter(username=username).exists():
+                User.objects.create_user(username=username, password=PASSWORD, email=f"{username}@example.com")
+        UserProfile.objects.filter(user__username__in=usernames).update(user_type=user_type, balance=10000, charges=0)
+        return usernames
+
+    def _run(self, workflow, client, username, stations, deadline, think):
+        """ Logs the client in, then repeats its workflow until the deadline """
+        rng = random.Random(username)
+        try:
+            client.get('login', reverse('bikes:login'))
+            client.post('login', reverse('bikes:login'), {"username": username, "password": PASSWORD})
+            while time.perf_counter() < deadline:
+                for step in workflow(client, rng, stations):
+                    if think:
+                        time.sleep(rng.expovariate(1 / think))
+                    if time.perf_counter() >= deadline:
+                        break
+        except Exception as e:
+            client.record('client crashed', 0, error=True)
+            self.stderr.write(f"{username}: {e!r}")
+
+    def _rider(self, client, rng, stations):
+        """ Browses the map and a station, hires a bike there, and returns it to another station.
+            A generator - each step yields once its request is made
+        """
+        body = client.get('user-hires', reverse('bikes:user-hires'))
+        yield
+        if not current_hire(body):
+            client.get('index', reverse('bikes:index'))
+            yield
+            client.get('view-map', reverse('bikes:view-map'))
+            yield
+            body = client.get('location-detail', reverse('bikes:location_detail', args=[rng.choice(stations)]))
+            yield
+            bikes = re.findall(r'hire-btn"\s+data-bikeid="(\d+)"', body)
+            if not bikes:
+                return # the station is empty - try another
+            client.post('hire', reverse('bikes:hire-bike'), {"bike_id": rng.choice(bikes)})
+            yield
+            body = client.get('user-hires', reverse('bikes:user-hires'))
+            yield
+        hire_id = current_hire(body)
+        if hire_id:
+            client.post('return', reverse('bikes:return-bike'), {
+                "hire_id": hire_id, "location": rng.choice(stations), "discount": ""
+            })
+            yield
+
+    def _operator(self, client, rng, stations):
+        """ Checks the operator dashboard, and moves a bike between two stations """
+        client.get('operator-index', reverse('bikes:operator-index'))
+        yield
+        old, new = rng.sample(stations, 2)
+        client.post('move-bike', reverse('bikes:move-bike'), {"location": old, "new_location": new})
+        yield
+
+    def _manager(self, client, rng, stations):
+        """ Reads every report page, and the data for every chart """
+        for page in REPORT_PAGES:
+            client.get(f"reports/{page}", reverse(f'reports:{page}'))
+            yield
+        for chart in CHARTS:
+            client.get('reports/chart-data', reverse('reports:chart_data', args=[chart]))
+            yield
+
+    def _print(self, endpoints):
+        self.stdout.write(f"\n{'Endpoint':<28}{'Requests':>9}{'Req/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'Errors':>9}")
+        for name, e in sorted(endpoints.items()):
+            self.stdout.write(
+                f"{name:<28}{e['requests']:>9}{e['throughput']:>9.1f}{e['p50_ms']:>9.1f}{e['p95_ms']:>9.1f}"
+                f"{e['p99_ms']:>9.1f}{e['error_rate']:>9.1%}"
+            )
+
+    def _compare(self, endpoints, baseline, tolerance):
+        """ Prints each endpoint's change from the baseline, and returns the number that regressed """
+        self.stdout.write(f"\n{'Compared with baseline':<28}{'Req/s':>10}{'p95':>10}{'Errors':>10}")
+        regressions = 0
+        for name in sorted(set(endpoints) & set(baseline)):
+            now, before = endpoints[name], baseline[name]
+            throughput = change(now['throughput'], before['throughput'])
+            p95 = change(now['p95_ms'], before['p95_ms'])
+            errors = now['error_rate'] - before['error_rate']
+            regressed = throughput < -tolerance or p95 > tolerance or errors > tolerance / 100
+            regressions += regressed
+            self.stdout.write(
+                f"{name:<28}{throughput:>+10.1%}{p95:>+10.1%}{errors:>+10.1%}" + ("  REGRESSED" if regressed else "")
+            )
+        for name in sorted(set(baseline) - set(endpoints)):
+            self.stdout.write(f"{name:<28} not requested in this run")
+        return regressions
+
+class NoRedirects(HTTPRedirectHandler):
+    """ Hands redirects back to the client (as an HTTPError), so a POST is timed on its own """
+
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+class Client:
+    """ One simulated user's browser: keeps its session and CSRF cookies, and times every request into `result` """
+
+    def __init__(self, base_url, result):
+        self.base_url = base_url.rstrip('/')
+        self.cookies = CookieJar()
+        self.opener = build_opener(HTTPCookieProcessor(self.cookies), NoRedirects)
+        self.result = result
+
+    def get(self, endpoint, path):
+        return self._request(endpoint, path)
+
+    def post(self, endpoint, path, data):
+        csrf_token = next((c.value for c in self.cookies if c.name == 'csrftoken'), '')
+        return self._request(endpoint, path, dict(data, csrfmiddlewaretoken=csrf_token))
+
+    def _request(self, endpoint, path, data=None):
+        """ Makes a request, and returns the response body. Statuses of 400 and over, and failures to connect
+            or read the response, count as errors. Redirects are not followed
+        """
+        body = data and urlencode(data).encode()
+        start = time.perf_counter()
+        try:
+            with self.opener.open(self.base_url + path, body, timeout=REQUEST_TIMEOUT) as response:
+                text = response.read().decode(errors='replace') # the route graph is a PNG
+            error = False
+        except HTTPError as e:
+            text = e.read().decode(errors='replace')
+            error = e.code >= 400
+        except (URLError, OSError):
+            text, error = '', True
+        self.record(endpoint, time.perf_counter() - start, error)
+        return text
+
+    def record(self, endpoint, latency, error=False):
+        stats = self.result.setdefault(endpoint, {"latencies": [], "errors": 0})
+        stats['latencies'].append(latency)
+        stats['errors'] += error
+
+def current_hire(user_hires_page):
+    """ The id of the rider's current hire, from their hires page's return form, or None """
+    match = re.search(r'name="hire_id" value="(\d+)"', user_hires_page)
+    return match and match.group(1)
+
+def percentile(ordered, fraction):
+    """ The nearest-rank percentile of a sorted list """
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+def change(now, before):
+    return (now - before) / before if before else 0
+
+def summarise(results, elapsed):
+    """ Combines the clients' results into each endpoint's request count, throughput, latency percentiles
+        (in milliseconds) and error rate
+    """
+    endpoints = {}
+    for name in {name for result in results for name in result}:
+        latencies = sorted(l for result in results for l in result.get(name, {}).get('latencies', []))
+        errors = sum(result.get(name, {}).get('errors', 0) for result in results)
+        endpoints[name] = {
+            "requests": len(latencies),
+            "throughput": len(latencies) / elapsed,
+            "p50_ms": percentile(latencies, .5) * 1000,
+            "p95_ms": percentile(latencies, .95) * 1000,
+            "p99_ms": percentile(latencies, .99) * 1000,
+            "mean_ms": sum(latencies) / len(latencies) * 1000,
+            "error_rate": errors / len(latencies),
+        }
+    return endpoints
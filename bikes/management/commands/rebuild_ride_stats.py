@@ -0,0 +1,44 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, Sum, Max, F, ExpressionWrapper, fields
+import numpy as np
+
+from bikes.models import BikeHires, UserRideStats
+from bikes.utils import ride_distances
+
+class Command(BaseCommand):
+    help = "Rebuilds every user's ride totals (UserRideStats) from the BikeHires history"
+
+    # This method is executed when the management command is run.
+    def handle(self, *args, **kwargs):
+        hires = BikeHires.objects.filter(end_station__isnull=False, user__isnull=False)
+
+        # count, charges, duration and last ride per user, in one grouped query
+        duration = ExpressionWrapper(F('date_returned') - F('date_hired'), output_field=fields.DurationField())
+        totals = hires.values('user').order_by('user').annotate(
+            num_rides=Count('id'), total_charges=Sum('charges'), total_duration=Sum(duration), last_ride=Max('date_returned')
+        )
+
+        # distance per user - price every ride in one pass, then sum the distances by user id
+        rows = np.array(list(hires.order_by().values_list('user_id', 'start_station_id', 'end_station_id')), dtype=float)
+        km_by_user = {}
+        if len(rows):
+            km = ride_distances(start_ids=rows[:, 1], end_ids=rows[:, 2])
+            user_ids, inverse = np.unique(rows[:, 0].astype(np.int64), return_inverse=True)
+            km_by_user = dict(zip(user_ids.tolist(), np.bincount(inverse, weights=km).tolist()))
+
+        stats = [
+            UserRideStats(
+                user_id=t['user'],
+                num_rides=t['num_rides'],
+                total_km=km_by_user.get(t['user'], 0),
+                total_minutes=t['total_duration'].total_seconds() / 60 if t['total_duration'] else 0,
+                total_charges=t['total_charges'] or 0,
+                last_ride=t['last_ride']
+            ) for t in totals
+        ]
+
+        with transaction.atomic():
+            UserRideStats.objects.all().delete()
+            UserRideStats.objects.bulk_create(stats) # Django picks a batch size within the database's limits
+        self.stdout.write(f"Rebuilt ride totals for {len(stats)} users")
@@ -0,0 +1,53 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Count, Q, OuterRef, Subquery, IntegerField
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from bikes.choices import BikeStatus
+from bikes.models import Bikes, Location
+from reports.models import LocationBikeCount
+
+class Command(BaseCommand):
+    help = "Checks each station's bike counters against the Bikes table, and fixes any drift"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help="Report drift without fixing it")
+
+    # This method is executed when the management command is run.
+    def handle(self, *args, **kwargs):
+        locations = Location.objects.annotate(
+            actual_docked=Count('bikes'),
+            actual_available=Count('bikes', filter=Q(bikes__status=BikeStatus.AVAILABLE))
+        )
+        drifted = [
+            loc for loc in locations
+            if loc.bike_count != loc.actual_docked or loc.available_bikes != loc.actual_available
+        ]
+        for loc in drifted:
+            self.stdout.write(
+                f"{loc.station_name}: bikes {loc.bike_count} (actual {loc.actual_docked}), "
+                f"available {loc.available_bikes} (actual {loc.actual_available})"
+            )
+
+        if drifted and not kwargs['dry_run']:
+            # recount inside the UPDATE itself, so hires made since the check above aren't lost
+            bikes = Bikes.objects.filter(location=OuterRef('pk')).order_by().values('location')
+            docked = bikes.annotate(cnt=Count('pk')).values('cnt')
+            available = bikes.filter(status=BikeStatus.AVAILABLE).annotate(cnt=Count('pk')).values('cnt')
+            Location.objects.filter(pk__in=[loc.pk for loc in drifted]).update(
+                bike_count=Coalesce(Subquery(docked, output_field=IntegerField()), 0),
+                available_bikes=Coalesce(Subquery(available, output_field=IntegerField()), 0)
+            )
+
+            # the corrected counts become the latest entries in the stations' history
+            now = timezone.now()
+            recounted = [loc.pk for loc in drifted if loc.bike_count != loc.actual_docked]
+            for pk, count in Location.objects.filter(pk__in=recounted).values_list('pk', 'bike_count'):
+                LocationBikeCount.append(pk, now, count)
+
+        if not drifted:
+            self.stdout.write("All station counters are correct")
+        elif kwargs['dry_run']:
+            self.stdout.write(f"{len(drifted)} station(s) have drifted")
+        else:
+            self.stdout.write(f"Fixed {len(drifted)} station(s)")
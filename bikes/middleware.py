@@ -0,0 +1,92 @@
+from collections import Counter
+import logging
+import time
+
+from django.conf import settings
+from django.db import connection
+
+logger = logging.getLogger(__name__)
+
+class QueryRecorder:
+    """ Context manager recording every SQL statement run on the default database connection, in this thread:
+        the number of statements, the time spent in the database, and the statements run more than once.
+        Repeated statements are compared with their parameters left out, so one query per row of a list
+        (an N+1 query) shows up as a single statement repeated N times.
+    """
+
+    def __init__(self):
+        self.statements = Counter() # SQL (without parameters) -> number of times run
+        self.db_time = 0
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        self._wrapper = connection.execute_wrapper(self)
+        self._wrapper.__enter__()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._wrapper.__exit__(*exc_info)
+        self.total_time = time.perf_counter() - self.started
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.db_time += time.perf_counter() - start
+            self.statements[sql] += 1
+
+    @property
+    def queries(self):
+        return sum(self.statements.values())
+
+    @property
+    def duplicates(self):
+        """ The number of statements that repeated an earlier one """
+        return sum(count - 1 for count in self.statements.values())
+
+    @property
+    def python_time(self):
+        return self.total_time - self.db_time
+
+    def most_repeated(self):
+        """ The statement run the most times, and how many times, or None if no statement was repeated """
+        if not self.duplicates:
+            return None
+        return self.statements.most_common(1)[0]
+
+    def summary(self):
+        return f"{self.queries} queries ({self.duplicates} duplicated) in {self.db_time * 1000:.1f}ms, " \
+               f"python {self.python_time * 1000:.1f}ms"
+
+class QueryBudgetMiddleware:
+    """ Records the SQL run by each request (see QueryRecorder). With the QUERY_BUDGET_HEADERS setting on (it
+        defaults to DEBUG), the numbers are sent in a Server-Timing header, which browsers show with the request's
+        timings, and logged at debug level along with the most repeated statement. With it or QUERY_BUDGET_RECORD
+        on (as in QueryBudgetTestCase), the recorder is attached to the response as `response.queries`.
+        Otherwise nothing is recorded, and requests run as if the middleware weren't there.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        headers = getattr(settings, 'QUERY_BUDGET_HEADERS', settings.DEBUG)
+        if not (headers or getattr(settings, 'QUERY_BUDGET_RECORD', False)):
+            return self.get_response(request)
+
+        with QueryRecorder() as recorder:
+            response = self.get_response(request)
+        response.queries = recorder
+
+        if headers:
+            response['Server-Timing'] = (
+                f'db;dur={recorder.db_time * 1000:.1f};desc="{recorder.queries} queries, {recorder.duplicates} duplicated", '
+                f'app;dur={recorder.python_time * 1000:.1f}'
+            )
+            view = request.resolver_match.view_name if request.resolver_match else request.path
+            logger.debug(f"{request.method} {view}: {recorder.summary()}")
+            repeated = recorder.most_repeated()
+            if repeated:
+                logger.debug(f"  most repeated ({repeated[1]} times): {repeated[0]}")
+        return response
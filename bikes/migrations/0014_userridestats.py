@@ -0,0 +1,65 @@
+# Generated by Django 2.2.4 on 2026-10-17 22:03
+
+from django.db import migrations, models
+from django.db.models import Count, ExpressionWrapper, F, Max, Sum
+import django.db.models.deletion
+
+
+def fill_ride_stats(apps, schema_editor):
+    """ Totals every user's existing returned hires, as the rebuild_ride_stats command does """
+    import geopy.distance
+
+    BikeHires = apps.get_model('bikes', 'BikeHires')
+    Location = apps.get_model('bikes', 'Location')
+    UserRideStats = apps.get_model('bikes', 'UserRideStats')
+    hires = BikeHires.objects.filter(end_station__isnull=False, user__isnull=False)
+
+    duration = ExpressionWrapper(F('date_returned') - F('date_hired'), output_field=models.DurationField())
+    totals = hires.values('user').order_by('user').annotate(
+        num_rides=Count('id'), total_charges=Sum('charges'), total_duration=Sum(duration), last_ride=Max('date_returned')
+    )
+
+    # distance per user, working out each pair of stations' distance once
+    coords = {pk: (lat, lon) for pk, lat, lon in Location.objects.values_list('pk', 'latitude', 'longitude')}
+    pair_km = {}
+    km_by_user = {}
+    for user_id, start_id, end_id in hires.order_by().values_list('user_id', 'start_station_id', 'end_station_id').iterator():
+        if start_id is None:
+            continue
+        if (start_id, end_id) not in pair_km:
+            pair_km[start_id, end_id] = geopy.distance.distance(coords[start_id], coords[end_id]).km
+        km_by_user[user_id] = km_by_user.get(user_id, 0) + pair_km[start_id, end_id]
+
+    UserRideStats.objects.bulk_create(
+        UserRideStats(
+            user_id=t['user'],
+            num_rides=t['num_rides'],
+            total_km=km_by_user.get(t['user'], 0),
+            total_minutes=t['total_duration'].total_seconds() / 60 if t['total_duration'] else 0,
+            total_charges=t['total_charges'] or 0,
+            last_ride=t['last_ride']
+        ) for t in totals.iterator()
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bikes', '0013_auto_20191106_2317'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserRideStats',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('num_rides', models.IntegerField(default=0)),
+                ('total_km', models.FloatField(default=0)),
+                ('total_minutes', models.FloatField(default=0)),
+                ('total_charges', models.FloatField(default=0)),
+                ('last_ride', models.DateTimeField(blank=True, null=True)),
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='ride_stats', to='bikes.UserProfile')),
+            ],
+        ),
+        migrations.RunPython(fill_ride_stats, migrations.RunPython.noop),
+    ]
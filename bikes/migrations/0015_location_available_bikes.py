@@ -0,0 +1,26 @@
+# Generated by Django 2.2.4 on 2026-10-17 22:04
+
+from django.db import migrations, models
+from django.db.models import Count, Q
+
+
+def count_available_bikes(apps, schema_editor):
+    Location = apps.get_model('bikes', 'Location')
+    for location in Location.objects.annotate(actual=Count('bikes', filter=Q(bikes__status=1))):
+        Location.objects.filter(pk=location.pk).update(available_bikes=location.actual)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bikes', '0014_userridestats'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='location',
+            name='available_bikes',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.RunPython(count_available_bikes, migrations.RunPython.noop),
+    ]
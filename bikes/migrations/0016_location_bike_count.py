@@ -0,0 +1,26 @@
+# Generated by Django 2.2.4 on 2026-10-17 22:06
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def count_docked_bikes(apps, schema_editor):
+    Location = apps.get_model('bikes', 'Location')
+    for location in Location.objects.annotate(actual=Count('bikes')):
+        Location.objects.filter(pk=location.pk).update(bike_count=location.actual)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bikes', '0015_location_available_bikes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='location',
+            name='bike_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.RunPython(count_docked_bikes, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 2.2.4 on 2026-10-17 22:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bikes', '0016_location_bike_count'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='bikehires',
+            index=models.Index(fields=['user', 'date_hired'], name='bikes_bikeh_user_id_14a8c0_idx'),
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 2.2.4 on 2026-10-17 23:10
+
+from django.db import migrations, models
+
+
+def fill_account_name_keys(apps, schema_editor):
+    UserProfile = apps.get_model('bikes', 'UserProfile')
+    profiles = UserProfile.objects.select_related('user').order_by('pk')
+    batch = []
+    for profile in profiles.iterator():
+        profile.username_key = profile.user.username.strip().casefold()
+        profile.email_key = profile.user.email.strip().casefold()
+        batch.append(profile)
+        if len(batch) >= 1000:
+            UserProfile.objects.bulk_update(batch, ['username_key', 'email_key'])
+            batch = []
+    UserProfile.objects.bulk_update(batch, ['username_key', 'email_key'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bikes', '0017_query_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userprofile',
+            name='email_key',
+            field=models.CharField(db_index=True, default='', editable=False, max_length=254),
+        ),
+        migrations.AddField(
+            model_name='userprofile',
+            name='username_key',
+            field=models.CharField(db_index=True, default='', editable=False, max_length=150),
+        ),
+        migrations.RunPython(fill_account_name_keys, migrations.RunPython.noop),
+    ]
@@ -1,11 +1,20 @@
 from django.core.validators import MaxValueValidator, MinValueValidator
 from django.contrib.auth.models import User
-from django.db import models
+from django.db import models, transaction
+from django.db.models import F, Q, Case, When, Value
 from django.utils import timezone
 
+from reports.cache import bump_data_version
 from .choices import UserType, BikeStatus, MembershipType
+from .sqlite import serialized_write
 
 
+class BikeNotAvailable(Exception):
+    """ Raised when a bike can't be hired - it was hired or taken for repair first, or the user already has a hire """
+
+class HireAlreadyReturned(Exception):
+    """ Raised when returning a hire that has already been returned """
+
 class Bikes(models.Model):
     status = models.IntegerField(choices=BikeStatus.CHOICES)
     location = models.ForeignKey("Location", on_delete=models.SET_NULL, blank=True, null=True)
@@ -13,21 +22,37 @@ class Bikes(models.Model):
 
     def hire(self, user):
         """ This function sets the model attributes upon a user hiring the bike.
-            It also creates the BikeHires model associated with the hire, and sets the user's current hire
+            It also creates the BikeHires model associated with the hire, and sets the user's current hire.
+            The bike is claimed with a conditional UPDATE, so when two users hire the same bike at once only one
+            succeeds - the other gets BikeNotAvailable, as does a user who already has a bike on hire.
         """
-        start_location = self.location
-        self.status = BikeStatus.ON_HIRE
-        self.location = None
-        self.last_hired = timezone.now()
-        self.save() # save model with new changes
-        
-        # create corresponding BikeHires object
-        bike_hire = BikeHires(bike=self, user=user, start_station=start_location, date_hired=self.last_hired)
-        bike_hire.save()
-
-        # set user's current hire
+        start_location_id = self.location_id
+        if start_location_id is None:
+            raise BikeNotAvailable(f"Bike {self.pk} is not at a station")
+        now = timezone.now()
+        with serialized_write(), transaction.atomic():
+            # claim the bike - only succeeds if it's still available at the station it was hired from
+            claimed = Bikes.objects.filter(pk=self.pk, status=BikeStatus.AVAILABLE, location_id=start_location_id) \
+                .update(status=BikeStatus.ON_HIRE, location=None, last_hired=now)
+            if not claimed:
+                raise BikeNotAvailable(f"Bike {self.pk} is no longer available")
+
+            # create corresponding BikeHires object
+            bike_hire = BikeHires.objects.create(
+                bike=self, user=user, start_station_id=start_location_id, date_hired=now
+            )
+
+            # set user's current hire, unless they already have one
+            if not UserProfile.objects.filter(pk=user.pk, current_hire=None).update(current_hire=bike_hire):
+                raise BikeNotAvailable("Please return your bike before attempting to hire a new one")
+
+            # one less bike at (and available at) the start station
+            Location.adjust_counts(start_location_id, docked=-1, available=-1, when=now)
+            bump_data_version()
+
+        self.status, self.location, self.last_hired = BikeStatus.ON_HIRE, None, now
         user.current_hire = bike_hire
-        user.save()
+        return bike_hire
 
     def __str__(self):
         if self.location is not None:
@@ -54,6 +79,11 @@ class UserProfile(models.Model):
     profile_pic = models.ImageField(upload_to='profile/profile_images', blank=True)
     current_hire = models.OneToOneField("BikeHires", on_delete=models.SET_NULL, null=True, blank=True)
 
+    # the user's username and email, case-folded (see bikes.accounts) - so they can be looked up case-insensitively
+    # through an index. Kept up to date by the User post_save signal
+    username_key = models.CharField(max_length=150, db_index=True, editable=False, default='')
+    email_key = models.CharField(max_length=254, db_index=True, editable=False, default='')
+
     def add_balance(self, balance):
         """ Adds balance to user's account. Removes charges if applicable """
         if self.charges > 0:
@@ -81,6 +111,60 @@ class UserProfile(models.Model):
             # if balance is zero, simply add charges to existing charges
             self.charges += charges
 
+    @staticmethod
+    def add_charges_update(charges):
+        """ The add_charges() logic as UPDATE expressions, so charges can be applied to a row atomically:
+            UserProfile.objects.filter(pk=pk).update(**UserProfile.add_charges_update(charges))
+        """
+        covered = Q(balance__gte=charges) # the balance covers all of the charges
+        return dict(
+            balance=Case(When(covered, then=F('balance') - charges), default=Value(0.0), output_field=models.FloatField()),
+            charges=Case(
+                When(covered, then=F('charges')), default=F('charges') + charges - F('balance'), output_field=models.FloatField()
+            ),
+        )
+
+    @staticmethod
+    def add_balance_update(balance):
+        """ The add_balance() logic as UPDATE expressions, so funds can be added to a row atomically:
+            UserProfile.objects.filter(pk=pk).update(**UserProfile.add_balance_update(balance))
+        """
+        clears = Q(charges__lt=balance) # the funds pay off all of the charges
+        return dict(
+            balance=Case(
+                When(clears, then=F('balance') + balance - F('charges')), default=F('balance'), output_field=models.FloatField()
+            ),
+            charges=Case(When(clears, then=Value(0.0)), default=F('charges') - balance, output_field=models.FloatField()),
+        )
+
+class UserRideStats(models.Model):
+    """ Running totals of a user's completed rides, so that the profile page doesn't have to read their
+        whole hire history. Updated by utils.return_bike on every return, and rebuilt from the BikeHires
+        table by the `rebuild_ride_stats` management command.
+    """
+
+    user = models.OneToOneField(UserProfile, on_delete=models.CASCADE, related_name='ride_stats')
+    num_rides = models.IntegerField(default=0)
+    total_km = models.FloatField(default=0)
+    total_minutes = models.FloatField(default=0)
+    total_charges = models.FloatField(default=0)
+    last_ride = models.DateTimeField(null=True, blank=True)
+
+    @classmethod
+    def add_ride(cls, hire, km):
+        """ Adds a returned hire to its user's totals, in a single atomic UPDATE """
+        totals = dict(
+            num_rides=F('num_rides') + 1,
+            total_km=F('total_km') + km,
+            total_minutes=F('total_minutes') + hire.get_duration().total_seconds() / 60,
+            total_charges=F('total_charges') + (hire.charges or 0),
+            last_ride=hire.date_returned
+        )
+        if cls.objects.filter(user_id=hire.user_id).update(**totals) == 0:
+            # first ride for this user - create their row, then apply the totals
+            cls.objects.get_or_create(user_id=hire.user_id)
+            cls.objects.filter(user_id=hire.user_id).update(**totals)
+
 class Location(models.Model):
     """ Table that stores all the locations where bikes are available, along with lat/lon coordinates """
 
@@ -89,14 +173,37 @@ class Location(models.Model):
     longitude = models.FloatField()
     initial_bike_count = models.IntegerField(default=0)
 
+    # number of bikes docked at the station, and how many of those have status AVAILABLE. Kept up to date by
+    # the hire, return, move and repair code paths (see adjust_counts), and checked by `reconcile_bike_counts`
+    bike_count = models.IntegerField(default=0)
+    available_bikes = models.IntegerField(default=0)
+
     def num_bikes(self):
-        return self.bikes_set.filter(status=BikeStatus.AVAILABLE).count()
+        return self.available_bikes
+
+    @staticmethod
+    def adjust_counts(location_id, docked=0, available=0, when=None):
+        """ Atomically adds to a station's bike counters, in a single UPDATE.
+            A change to the `docked` count is also appended to the station's LocationBikeCount history, at `when`
+        """
+        if location_id is None:
+            return
+        with transaction.atomic(savepoint=False):
+            Location.objects.filter(pk=location_id).update(
+                bike_count=F('bike_count') + docked, available_bikes=F('available_bikes') + available
+            )
+            if docked:
+                from reports.models import LocationBikeCount # imported here - reports.models imports this module
+
+                # the UPDATE above locks the row until commit, so this reads back our own new count
+                count = Location.objects.filter(pk=location_id).values_list('bike_count', flat=True).get()
+                LocationBikeCount.append(location_id, when or timezone.now(), count)
 
     class Meta:
         ordering = ("station_name",)
 
     def __str__(self):
-        return self.station_name + ": " + str(self.bikes_set.count()) + " bikes"
+        return self.station_name + ": " + str(self.bike_count) + " bikes" # every bike docked there, as before
 
 class BikeHires(models.Model):
     """ A table that tracks all historical bike hires.
@@ -122,6 +229,7 @@ class BikeHires(models.Model):
 
     class Meta:
         ordering = ("date_hired",)
+        indexes = [models.Index(fields=['user', 'date_hired'])] # a user's hires, in date order (user-hires page)
 
 class BikeRepairs(models.Model):
     """ A table to track all historical bike repairs """
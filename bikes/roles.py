@@ -0,0 +1,33 @@
+""" Which kind of user (customer, operator or manager) is making a request, and the views limited to some kinds """
+from functools import wraps
+
+from django.contrib.auth.decorators import login_required
+from django.http import HttpResponseForbidden
+from django.shortcuts import redirect
+from django.urls import reverse
+
+from .choices import UserType
+
+def user_role(request):
+    """ Returns the request user's UserType, or None if they aren't logged in. The profile comes with the user
+        (see backends.ProfileBackend), so this doesn't make a query
+    """
+    if not request.user.is_authenticated:
+        return None
+    return request.user.userprofile.user_type
+
+def role_required(*user_types, forbidden=False):
+    """ Decorates a view that only users of the given UserTypes may see. Anyone else is sent to log in if they
+        haven't, and otherwise redirected to the home page - or, with forbidden=True, refused with a 403
+    """
+    def decorator(view):
+        @wraps(view)
+        @login_required
+        def wrapper(request, *args, **kwargs):
+            if user_role(request) not in user_types:
+                return HttpResponseForbidden() if forbidden else redirect(reverse('bikes:index'))
+            return view(request, *args, **kwargs)
+        return wrapper
+    return decorator
+
+OPERATORS = (UserType.OPERATOR, UserType.MANAGER)
@@ -1,41 +1,57 @@
 from django.contrib.auth.models import User
-from django.db.models.signals import post_save, pre_delete, pre_save
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_save, pre_delete, post_delete
 from django.dispatch import receiver
 
-from .models import UserProfile, BikeHires
-from reports.models import LocationBikeCount
+from reports.cache import bump_data_version
+from .accounts import account_names, account_keys
+from .models import UserProfile, Location, Bikes
+from .sqlite import apply_pragmas
+from .utils import station_distances
 
 @receiver(post_save, sender=User, dispatch_uid='save_new_user_profile')
 def create_or_save_user_profile(sender, instance, created, **kwargs):
-    """ Creates a UserProfile instance whenever a new User is created """
+    """ Creates a UserProfile instance whenever a new User is created, keeping its case-folded copies of the
+        username and email (for looking them up case-insensitively) in step
+    """
+    keys = account_keys(instance)
     if created:
         # The instance arg is the User instance that triggered the signal
-        UserProfile.objects.create(user=instance)
+        UserProfile.objects.create(user=instance, **keys)
     else:
-        instance.userprofile.save()
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and not {'username', 'email'} & set(update_fields):
+            return # e.g. last_login, saved on every login
+        # only the keys are written - a full save could overwrite a balance or hire written meanwhile
+        if not UserProfile.objects.filter(user=instance).exclude(**keys).update(**keys):
+            return
+        if User.userprofile.is_cached(instance):
+            for field, key in keys.items():
+                setattr(instance.userprofile, field, key)
+    account_names.add(instance)
 
-@receiver(pre_save, sender=BikeHires)
-def create_bikecount(sender, instance, **kwargs):
-    try:
-        obj = sender.objects.get(pk=instance.pk)
-    except sender.DoesNotExist:
-        last_count = LocationBikeCount.objects.filter(location=instance.start_station).last().count
-        LocationBikeCount.objects.create(
-            location=instance.start_station, datetime=instance.date_hired, count=last_count - 1
-        )
-        if instance.end_station is not None:
-            last_count = LocationBikeCount.objects.filter(location=instance.end_station).last().count
-            LocationBikeCount.objects.create(
-                location=instance.end_station, datetime=instance.date_returned, count=last_count + 1
-            )
-    else:
-        if not obj.end_station == instance.end_station:
-            # TODO: test this
-            last_count = LocationBikeCount.objects.filter(location=obj.start_station).last().count
-            LocationBikeCount.objects.create(
-                location=obj.start_station, datetime=obj.date_hired, count=last_count - 1
-            )
-            last_count = LocationBikeCount.objects.filter(location=instance.end_station).last().count
-            LocationBikeCount.objects.create(
-                location=instance.end_station, datetime=instance.date_returned, count=last_count + 1
-            )
+@receiver(post_save, sender=Location, dispatch_uid='update_station_distances')
+def update_station_distances(sender, instance, **kwargs):
+    """ Keeps the station distance cache in step when a Location is created or moved """
+    station_distances.update_station(instance)
+
+@receiver(post_delete, sender=Location, dispatch_uid='remove_station_distances')
+def remove_station_distances(sender, instance, **kwargs):
+    station_distances.remove_station(instance)
+
+@receiver(post_save, sender=UserProfile, dispatch_uid='bump_report_version_profile_save')
+@receiver(post_save, sender=Location, dispatch_uid='bump_report_version_location_save')
+@receiver(post_delete, sender=Location, dispatch_uid='bump_report_version_location_delete')
+@receiver(post_save, sender=Bikes, dispatch_uid='bump_report_version_bike_save')
+@receiver(post_delete, sender=Bikes, dispatch_uid='bump_report_version_bike_delete')
+def bump_report_version(sender, **kwargs):
+    """ Stales the cached reports when users, stations or bikes are edited outside the hire/return/move/repair
+        write paths (which bump the version themselves) - e.g. adding funds, registering, or in the admin
+    """
+    bump_data_version()
+
+@receiver(connection_created, dispatch_uid='tune_sqlite_connection')
+def tune_sqlite_connection(sender, connection, **kwargs):
+    """ Applies the SQLITE_PRAGMAS setting (WAL journaling, the busy timeout...) to every new SQLite connection """
+    if connection.vendor == 'sqlite':
+        apply_pragmas(connection)
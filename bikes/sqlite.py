@@ -0,0 +1,29 @@
+""" Running on SQLite under concurrent use: connection tuning, and serialising this process's writes """
+from contextlib import contextmanager
+import threading
+
+from django.conf import settings
+from django.db import connection
+
+# held for the length of each write transaction, by one thread at a time - a queue of waiting writers
+_write_lock = threading.RLock()
+
+def apply_pragmas(sqlite_connection):
+    """ Applies the SQLITE_PRAGMAS setting to a new SQLite connection """
+    with sqlite_connection.cursor() as cursor:
+        for name, value in getattr(settings, 'SQLITE_PRAGMAS', {}).items():
+            cursor.execute(f"PRAGMA {name} = {value}")
+
+@contextmanager
+def serialized_write():
+    """ Runs a write transaction - as a context manager, or decorating a function that makes one - once any
+        other thread in this process has finished its own. Only used on SQLite, where a database has one writer
+        at a time: without this, two threads whose transactions read and then write can each wait on the other's
+        lock, and SQLite fails one at once with "database is locked" rather than waiting out the busy timeout.
+        Other processes' writes still take turns through the busy timeout. Can be nested.
+    """
+    if connection.vendor != 'sqlite' or not getattr(settings, 'SQLITE_SERIALIZE_WRITES', True):
+        yield
+        return
+    with _write_lock:
+        yield
@@ -0,0 +1,50 @@
+""" Helpers for tests that hold views to a SQL query budget """
+from io import StringIO
+
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+
+from . import utils
+from .accounts import account_names
+from .choices import BikeStatus
+from .models import Bikes
+
+@override_settings(QUERY_BUDGET_RECORD=True)
+class QueryBudgetTestCase(TestCase):
+    """ Runs against a mid-size generated dataset - big enough that a query per row of a list shows up
+        as dozens of repeated statements - and checks the queries recorded by QueryBudgetMiddleware
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        call_command(
+            'add_bike_data', stations=12, bikes=60, users=30, hires=600, repairs=10, days=60, seed=1, stdout=StringIO()
+        )
+        # some bikes waiting for repair, listed on the operator page
+        for bike in Bikes.objects.filter(status=BikeStatus.AVAILABLE).order_by('-pk')[:8]:
+            utils.report_bike(bike)
+        cls.customer = User.objects.get(username="customer0")
+        cls.operator = User.objects.get(username="operator0")
+        cls.manager = User.objects.get(username="lyle")
+
+    def setUp(self):
+        self.clear_caches()
+
+    def clear_caches(self):
+        """ Cached report pages would hide the queries that build them """
+        caches['default'].clear()
+        caches['reports'].clear()
+        account_names.reset()
+        utils.station_distances.reset()
+
+    def assertQueryBudget(self, response, queries, duplicates=0):
+        """ Fails if the request behind `response` ran more than `queries` SQL statements,
+            or repeated a statement (with different parameters) more than `duplicates` times
+        """
+        recorder = response.queries
+        repeated = recorder.most_repeated()
+        detail = f"{recorder.summary()}" + (f"; most repeated ({repeated[1]} times): {repeated[0]}" if repeated else "")
+        self.assertLessEqual(recorder.queries, queries, f"Over the query budget: {detail}")
+        self.assertLessEqual(recorder.duplicates, duplicates, f"Too many repeated queries: {detail}")
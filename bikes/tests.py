@@ -1,4 +1,602 @@
+from datetime import datetime, timedelta
+from io import StringIO
+import json
+import tempfile
+import threading
+import time
+from unittest import mock, skipUnless
+import random
+
 from django.conf import settings
-from django.test import TestCase
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db import connection
+from django.test import LiveServerTestCase, SimpleTestCase, TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+import numpy as np
+import pytz
+
+from reports.models import LocationBikeCount, LocationBikeCountDaily, LocationBikeCountHourly, StationTripCount
+from . import utils
+from .accounts import account_names, BloomFilter
+from .choices import BikeStatus, MembershipType, UserType
+from .cost_calculator import CostCalculator, calculate_costs
+from .forms import RegistrationForm
+from .management.commands.add_bike_data import STATIONS
+from .models import Bikes, BikeHires, BikeNotAvailable, Discounts, HireAlreadyReturned, Location, UserProfile, \
+    UserRideStats
+from .sqlite import serialized_write
+from .testing import QueryBudgetTestCase
+
+NOW = datetime(2019, 11, 20, 8, 30, tzinfo=pytz.UTC)
+
+class AccountNamesTests(TestCase):
+    """ Checking whether usernames and email addresses are taken (accounts.AccountNames) """
+
+    def setUp(self):
+        account_names.reset()
+        User.objects.create_user(username="Rider", password="password", email="Rider@Example.com")
+
+    def test_case_insensitive(self):
+        for names in (account_names.taken, account_names.probably_taken):
+            self.assertTrue(names('username', "rIDER"))
+            self.assertTrue(names('email', " rider@example.com"))
+            self.assertFalse(names('username', "rider2"))
+            self.assertFalse(names('email', ""))
+        form = RegistrationForm({
+            "username": "RIDER", "email": "RIDER@example.com", "password": "password", "password_confirm": "password",
+            "membership_type": MembershipType.STANDARD
+        })
+        self.assertFalse(form.is_valid())
+        self.assertEqual(set(form.errors), {"username", "email"})
+
+    def test_new_and_changed_accounts_found(self):
+        self.assertFalse(account_names.probably_taken('username', "newrider")) # builds the filter
+        user = User.objects.create_user(username="NewRider", password="password")
+        self.assertTrue(account_names.probably_taken('username', "newrider"))
+        user.email = "NewRider@example.com"
+        user.save()
+        self.assertTrue(account_names.probably_taken('email', "newrider@example.com"))
+        self.assertEqual(UserProfile.objects.get(user=user).email_key, "newrider@example.com")
+
+    def test_login_leaves_profile_alone(self):
+        # a return charged the rider since their profile was loaded
+        profile = User.objects.get(username="Rider").userprofile
+        UserProfile.objects.filter(pk=profile.pk).update(charges=5)
+        with mock.patch('bikes.signals.bump_data_version') as bump, CaptureQueriesContext(connection) as queries:
+            self.assertTrue(self.client.login(username="Rider", password="password"))
+            profile.user.save()
+        # at most the keys are written - not the rest of the row
+        updates = [q['sql'] for q in queries if q['sql'].startswith('UPDATE "bikes_userprofile"')]
+        self.assertFalse([sql for sql in updates if '"charges"' in sql], updates)
+        bump.assert_not_called() # the managers' cached reports are kept
+        self.assertEqual(UserProfile.objects.get(pk=profile.pk).charges, 5)
+
+    def test_bloom_filter(self):
+        bloom = BloomFilter(1000)
+        added = [f"rider{i}" for i in range(1000)]
+        for name in added:
+            bloom.add(name)
+        self.assertTrue(all(name in bloom for name in added))
+        self.assertLess(sum(f"other{i}" in bloom for i in range(10000)), 300) # about 1% expected
+
+class StationDistancesTests(TestCase):
+    """ The station distance cache (utils.station_distances), and the Location signals that keep it up to date """
+
+    def setUp(self):
+        self.trongate = Location.objects.create(station_name="Trongate", latitude=55.855789, longitude=-4.246063)
+        self.partick = Location.objects.create(station_name="Partick Station", latitude=55.870007, longitude=-4.308759)
+        utils.station_distances.rebuild()
+        self.distances = utils.station_distances
+
+    def test_cached(self):
+        km = self.distances.km(self.trongate.pk, self.partick.pk)
+        self.assertAlmostEqual(km, 4.23, places=2)
+        with mock.patch('geopy.distance.distance') as distance, self.assertNumQueries(0):
+            self.assertEqual(self.distances.km(self.trongate.pk, self.partick.pk), km)
+            self.assertEqual(self.distances.km(self.partick.pk, self.trongate.pk), km) # either way round
+        distance.assert_not_called()
+
+    def test_moved_station(self):
+        km = self.distances.km(self.trongate.pk, self.partick.pk)
+        self.partick.latitude += .01
+        self.partick.save()
+        self.assertGreater(self.distances.km(self.trongate.pk, self.partick.pk), km)
+
+    def test_deleted_and_missing_stations(self):
+        self.distances.km(self.trongate.pk, self.partick.pk)
+        partick = self.partick.pk
+        self.partick.delete()
+        with self.assertRaises(Location.DoesNotExist):
+            self.distances.km(self.trongate.pk, partick)
+        with self.assertRaises(Location.DoesNotExist):
+            self.distances.km(self.trongate.pk, partick + 100)
+
+    def test_station_moved_elsewhere(self):
+        km = self.distances.km(self.trongate.pk, self.partick.pk)
+        # as if by another process - without this process's signals
+        Location.objects.filter(pk=self.partick.pk).update(latitude=self.partick.latitude + .01)
+        self.assertEqual(self.distances.km(self.trongate.pk, self.partick.pk), km)
+        self.distances._loaded -= utils.STATION_COORDINATES_MAX_AGE # once the coordinates are old enough...
+        self.assertGreater(self.distances.km(self.trongate.pk, self.partick.pk), km) # ...they're reloaded
+
+    def test_station_created_elsewhere(self):
+        # as if by another process - without this process's signals
+        Location.objects.bulk_create([Location(station_name="Govan", latitude=55.861, longitude=-4.312)])
+        govan = Location.objects.get(station_name="Govan")
+        self.assertGreater(self.distances.km(self.trongate.pk, govan.pk), 0)
+
+class RideDistancesTests(TestCase):
+    """ utils.ride_distances, for every pair of the real stations generated by add_bike_data """
+
+    def setUp(self):
+        stations = [Location.objects.create(**station) for station in STATIONS]
+        utils.station_distances.rebuild()
+        pairs = [(a.pk, b.pk) for a in stations for b in stations if a != b]
+        self.start_ids, self.end_ids = zip(*pairs)
+
+    def test_haversine_within_error_bound(self):
+        geodesic = utils.ride_distances(start_ids=self.start_ids, end_ids=self.end_ids)
+        haversine = utils.ride_distances(start_ids=self.start_ids, end_ids=self.end_ids, method='haversine')
+        self.assertTrue((geodesic > 0).all())
+        self.assertEqual(
+            geodesic.tolist(), [utils.station_distances.km(s, e) for s, e in zip(self.start_ids, self.end_ids)]
+        )
+        error = np.abs(haversine - geodesic) / geodesic
+        self.assertLess(error.max(), .0035) # the bound around Glasgow - and .0056 anywhere
+
+    def test_rides_without_stations(self):
+        start_ids, end_ids = [self.start_ids[0], None], [None, self.end_ids[0]]
+        for method in ('geodesic', 'haversine'):
+            self.assertEqual(utils.ride_distances(start_ids=start_ids, end_ids=end_ids, method=method).tolist(), [0, 0])
+
+class UserRoleTests(TestCase):
+    """ The user's role (roles.user_role), and the views limited to operators """
+
+    def setUp(self):
+        self.user = User.objects.create_user(username="rider", password="password")
+        self.client.force_login(self.user)
+
+    def test_role_read_with_user(self):
+        self.assertRedirects(self.client.get(reverse('bikes:operator-index')), reverse('bikes:index'))
+        with CaptureQueriesContext(connection) as queries:
+            self.assertFalse(self.client.get(reverse('bikes:index')).context['can_view_operator'])
+        # the profile is joined to the user, not read by a query of its own
+        self.assertFalse([q for q in queries if 'FROM "bikes_userprofile"' in q['sql']])
+
+        # changed without signals, as another process might
+        UserProfile.objects.filter(user=self.user).update(user_type=UserType.OPERATOR)
+        response = self.client.get(reverse('bikes:index'))
+        self.assertTrue(response.context['can_view_operator'])
+        self.assertFalse(response.context['can_view_manager'])
+        self.assertEqual(self.client.get(reverse('bikes:operator-index')).status_code, 200)
+
+    def test_logged_out(self):
+        self.client.logout()
+        response = self.client.get(reverse('bikes:operator-index'))
+        self.assertRedirects(
+            response, f"{settings.LOGIN_URL}?next={reverse('bikes:operator-index')}", fetch_redirect_response=False
+        )
+        self.assertFalse(self.client.get(reverse('bikes:index')).context['can_view_operator'])
+
+class UserHiresPaginationTests(TestCase):
+    """ The user-hires history, paginated by keyset (utils.keyset_page) """
+
+    def setUp(self):
+        start = Location.objects.create(station_name="Trongate", latitude=55.855789, longitude=-4.246063)
+        end = Location.objects.create(station_name="Partick Station", latitude=55.870007, longitude=-4.308759)
+        self.user = User.objects.create_user(username="customer", password="password")
+        # hires with tied dates, charges and durations, so the pk has to break ties
+        BikeHires.objects.bulk_create(
+            BikeHires(
+                user=self.user.userprofile, start_station=start, end_station=end, date_hired=NOW + timedelta(hours=i // 2),
+                date_returned=NOW + timedelta(hours=i // 2, minutes=10 * (i % 3)), charges=float(i % 3)
+            ) for i in range(8)
+        )
+        # and one without charges, sorted as if free
+        BikeHires.objects.filter(pk=BikeHires.objects.order_by('pk')[4].pk).update(charges=None)
+        self.client.force_login(self.user)
+
+    def pages(self, order, cursor=None, direction='after'):
+        """ Follows the cursors from the first page (or from `cursor`), returning each page's hire pks """
+        pages = []
+        params = {"order": order, direction: cursor} if cursor else {"order": order}
+        while True:
+            context = self.client.get(reverse('bikes:user-hires'), params).context
+            pages.append([hire.pk for hire in context['historical_hires']])
+            cursor = context['next_cursor' if direction == 'after' else 'previous_cursor']
+            if cursor is None:
+                return pages, context
+            params = {"order": order, direction: cursor}
+
+    def test_every_ordering(self):
+        hires = list(BikeHires.objects.all())
+        sort_keys = {
+            "date_hired": lambda h: (h.date_hired, h.pk), "charges": lambda h: (h.charges or 0, h.pk),
+            "duration": lambda h: (h.get_duration(), h.pk),
+        }
+        with mock.patch('bikes.views.HIRES_PER_PAGE', 3):
+            for field, sort_key in sort_keys.items():
+                for order in (field, f"-{field}"):
+                    with self.subTest(order=order):
+                        expected = [h.pk for h in sorted(hires, key=sort_key, reverse=order.startswith('-'))]
+                        pages, last = self.pages(order)
+                        self.assertEqual([len(page) for page in pages], [3, 3, 2])
+                        self.assertEqual(sum(pages, []), expected)
+                        # and back again from the last page
+                        back, _ = self.pages(order, last['previous_cursor'], direction='before')
+                        self.assertEqual(back, pages[-2::-1])
+
+    def test_invalid_parameters(self):
+        with mock.patch('bikes.views.HIRES_PER_PAGE', 3):
+            first = self.client.get(reverse('bikes:user-hires')).context['historical_hires']
+            for params in ({"order": "user__balance"}, {"after": "junk"}, {"order": "duration", "before": "1:x"}):
+                context = self.client.get(reverse('bikes:user-hires'), params).context
+                self.assertEqual(len(context['historical_hires']), 3)
+                self.assertIsNone(context['previous_cursor'])
+            self.assertEqual(
+                self.client.get(reverse('bikes:user-hires'), {"order": "user__balance"}).context['historical_hires'],
+                first
+            )
+
+class HireReturnTests(TestCase):
+    """ Tests for hiring a bike (Bikes.hire) and returning it (utils.return_bike) """
+
+    def setUp(self):
+        self.start = Location.objects.create(
+            station_name="Trongate", latitude=55.855789, longitude=-4.246063, bike_count=1, available_bikes=1
+        )
+        self.end = Location.objects.create(station_name="Partick Station", latitude=55.870007, longitude=-4.308759)
+        self.user = User.objects.create_user(username="customer", password="password").userprofile
+        self.user.balance = 10
+        self.user.save()
+        self.bike = Bikes.objects.create(status=BikeStatus.AVAILABLE, location=self.start)
+
+    def hire(self):
+        with mock.patch('django.utils.timezone.now', return_value=NOW):
+            self.bike.hire(self.user)
+        # load the hire the way the return view does
+        hire = BikeHires.objects.select_related('bike').get(bike=self.bike)
+        hire.user = self.user
+        return hire
+
+    def return_bike(self, hire, discount_code=""):
+        with mock.patch('django.utils.timezone.now', return_value=NOW.replace(minute=50)):
+            return utils.return_bike(hire, self.end, discount_code)
+
+    def statements(self, hire):
+        """ The SQL issued by return_bike, less the savepoint that TestCase's own transaction turns it into """
+        return [sql for sql in hire.return_queries if 'SAVEPOINT' not in sql]
+
+    def test_funds_and_payments_apply_to_current_row(self):
+        self.client.force_login(self.user.user)
+        self.hire()
+        # a return charging more than the balance, made since the profile was last saved
+        UserProfile.objects.filter(pk=self.user.pk).update(**UserProfile.add_charges_update(12))
+        self.client.post(reverse('bikes:addfunds'), {"balance": 1})
+        self.client.post(reverse('bikes:paycharges'))
+        profile = UserProfile.objects.get(pk=self.user.pk)
+        self.assertEqual((profile.balance, profile.charges), (0, 1)) # not covered, so not paid
+
+        self.client.post(reverse('bikes:addfunds'), {"balance": 4})
+        self.client.post(reverse('bikes:paycharges'))
+        profile = UserProfile.objects.get(pk=self.user.pk)
+        self.assertEqual((profile.balance, profile.charges), (3, 0))
+        self.assertIsNotNone(profile.current_hire_id) # left as the hire set it
+
+    def test_hire_claims_bike_once(self):
+        stale = Bikes.objects.get(pk=self.bike.pk)
+        self.hire()
+        other = User.objects.create_user(username="other", password="password").userprofile
+        with self.assertRaises(BikeNotAvailable):
+            stale.hire(other)
+        self.start.refresh_from_db()
+        self.assertEqual(self.start.available_bikes, 0)
+        self.assertEqual(BikeHires.objects.count(), 1)
+
+    def test_return_updates_user_bike_and_station(self):
+        hire = self.return_bike(self.hire())
+
+        self.user.refresh_from_db()
+        self.assertIsNone(self.user.current_hire)
+        self.assertEqual(self.user.balance, 10 - hire.charges)
+        self.assertEqual(UserRideStats.objects.get(user=self.user).num_rides, 1)
+
+        self.bike.refresh_from_db()
+        self.assertEqual((self.bike.status, self.bike.location), (BikeStatus.AVAILABLE, self.end))
+        self.end.refresh_from_db()
+        self.assertEqual((self.end.bike_count, self.end.available_bikes), (1, 1))
+        self.assertEqual(LocationBikeCount.objects.filter(location=self.end).last().count, 1)
+        self.assertEqual(StationTripCount.objects.get(start_station=self.start, end_station=self.end).trips, 1)
+
+    def test_return_after_repair_while_on_hire(self):
+        hire = self.hire()
+        utils.report_bike(self.bike)
+        utils.repair_bike(self.bike)
+        self.return_bike(hire)
+
+        self.bike.refresh_from_db()
+        self.assertEqual((self.bike.status, self.bike.location), (BikeStatus.AVAILABLE, self.end))
+        self.end.refresh_from_db()
+        self.assertEqual((self.end.bike_count, self.end.available_bikes), (1, 1))
+        out = StringIO()
+        call_command('reconcile_bike_counts', '--dry-run', stdout=out)
+        self.assertIn("All station counters are correct", out.getvalue())
+
+    def test_move_leaves_hired_bike_alone(self):
+        stale = Bikes.objects.get(pk=self.bike.pk)
+        hire = self.hire()
+        self.assertIsNone(utils.move_bike(self.start, self.end))
+        stale.refresh_from_db()
+        self.assertEqual((stale.status, stale.location), (BikeStatus.ON_HIRE, None))
+
+        self.return_bike(hire)
+        self.bike.refresh_from_db()
+        utils.report_bike(self.bike)
+        bike = utils.move_bike(self.end, self.start)
+        self.assertEqual((bike.pk, bike.status, bike.location), (self.bike.pk, BikeStatus.BEING_REPAIRED, self.start))
+        out = StringIO()
+        call_command('reconcile_bike_counts', '--dry-run', stdout=out)
+        self.assertIn("All station counters are correct", out.getvalue())
+
+    def test_return_query_count(self):
+        hire = self.hire()
+        # warm up the rows and caches that are only created on first use
+        UserRideStats.objects.create(user=self.user)
+        LocationBikeCount.append(self.end.pk, NOW.replace(minute=50), 0)
+        StationTripCount.objects.create(start_station=self.start, end_station=self.end, date=NOW.date())
+        utils.station_distances.coordinates((self.start.pk, self.end.pk))
+
+        # update hire, trip count, user, ride totals, bike and station; read back station count; insert history;
+        # 2 rollups
+        hire = self.return_bike(hire)
+        self.assertEqual(len(self.statements(hire)), 10, self.statements(hire))
+
+    def test_return_query_count_with_discount(self):
+        Discounts.objects.create(code="HALF", date_from=NOW.date(), date_to=NOW.date(), discount_amount=.5)
+        hire = self.hire()
+        UserRideStats.objects.create(user=self.user)
+        LocationBikeCount.append(self.end.pk, NOW.replace(minute=50), 0)
+        StationTripCount.objects.create(start_station=self.start, end_station=self.end, date=NOW.date())
+        utils.station_distances.coordinates((self.start.pk, self.end.pk))
+
+        # as above, plus the discount lookup and the UserDiscounts insert
+        hire = self.return_bike(hire, "HALF")
+        self.assertEqual(len(self.statements(hire)), 12, self.statements(hire))
+
+    def test_return_twice(self):
+        hire = self.hire()
+        self.return_bike(hire)
+        with self.assertRaises(HireAlreadyReturned):
+            self.return_bike(hire)
+        self.end.refresh_from_db()
+        self.assertEqual(self.end.bike_count, 1)
+
+class BatchCostTests(SimpleTestCase):
+    """ calculate_costs must agree exactly with CostCalculator, for any hire """
+
+    def random_hire(self, rng):
+        # mostly short rides, with some durations landing exactly on a charge interval boundary
+        if rng.random() < .2:
+            duration = timedelta(minutes=30 * rng.randint(0, 20))
+        else:
+            duration = timedelta(seconds=rng.randint(0, 12 * 3600), microseconds=rng.randint(0, 999999))
+        discount = None
+        if rng.random() < .3:
+            amount = rng.choice([0, 1, .5, rng.random()])
+            discount = Discounts(discount_amount=amount, date_from=NOW.date(), date_to=NOW.date() + timedelta(days=1))
+        user = UserProfile(membership_type=rng.choice(MembershipType.CHOICES)[0])
+        return BikeHires(user=user, date_hired=NOW, date_returned=NOW + duration, discount_applied=discount)
+
+    def test_matches_cost_calculator(self):
+        rng = random.Random(2019)
+        hires = [self.random_hire(rng) for _ in range(5000)]
+        with mock.patch('django.utils.timezone.now', return_value=NOW):
+            expected = [CostCalculator(hire).calculate_cost() for hire in hires]
+        charges, saved = calculate_costs(
+            [hire.get_duration() for hire in hires],
+            [hire.user.membership_type for hire in hires],
+            [hire.discount_applied.discount_amount if hire.discount_applied else np.nan for hire in hires]
+        )
+        for i, hire in enumerate(hires):
+            self.assertEqual((charges[i], saved[i]), expected[i], f"duration {hire.get_duration()}")
+
+class GenerateDataTests(TestCase):
+    """ add_bike_data's bulk-inserted history must be as consistent as one built hire by hire """
+
+    def test_history_is_consistent(self):
+        output = StringIO()
+        call_command('add_bike_data', stations=8, bikes=20, users=10, hires=300, days=30, seed=1, stdout=output)
+        self.assertIn("All station counters are correct", output.getvalue())
+        self.assertEqual(BikeHires.objects.count(), 300)
+
+        # every bike is hired from where its previous ride ended, and is back before its next hire
+        last_ride = {}
+        for bike, start, end, hired, returned in BikeHires.objects.order_by('date_hired') \
+                .values_list('bike', 'start_station', 'end_station', 'date_hired', 'date_returned'):
+            if bike in last_ride:
+                self.assertEqual(last_ride[bike][0], start)
+                self.assertLessEqual(last_ride[bike][1], hired)
+            last_ride[bike] = (end, returned)
+        for bike in Bikes.objects.filter(pk__in=last_ride):
+            self.assertEqual(bike.location_id, last_ride[bike.pk][0])
+
+        # each station's history ends at its current count
+        for location in Location.objects.all():
+            history = LocationBikeCount.objects.filter(location=location).order_by('datetime', 'pk')
+            self.assertEqual(history.last().count, location.bike_count)
+            self.assertFalse(history.filter(count__lt=0).exists())
+
+@skipUnless(connection.vendor == 'sqlite', "SQLite only")
+class SQLiteTuningTests(TestCase):
+    """ The SQLite connection settings, and serialized_write """
+
+    def test_pragmas_applied(self):
+        with connection.cursor() as cursor:
+            cursor.execute("PRAGMA busy_timeout")
+            self.assertEqual(cursor.fetchone()[0], settings.SQLITE_PRAGMAS['busy_timeout'])
+            cursor.execute("PRAGMA synchronous")
+            self.assertEqual(cursor.fetchone()[0], 1) # NORMAL
+
+    def test_writes_wait_their_turn(self):
+        order = []
+        started = threading.Event()
+
+        def first():
+            with serialized_write():
+                started.set()
+                time.sleep(.1)
+                order.append('first')
+
+        thread = threading.Thread(target=first)
+        thread.start()
+        started.wait()
+        with serialized_write(), serialized_write(): # nested in the same thread
+            order.append('second')
+        thread.join()
+        self.assertEqual(order, ['first', 'second'])
+
+class BenchmarkQueriesTests(TransactionTestCase):
+    """ The benchmark_queries command - a TransactionTestCase, as it drops the indexes in its own transaction """
+
+    @skipUnless(connection.vendor == 'sqlite', "PostgreSQL's planner reads tables this small without the indexes")
+    def test_indexes_used_and_restored(self):
+        call_command('add_bike_data', stations=3, bikes=6, users=4, hires=40, repairs=0, days=5, seed=1, stdout=StringIO())
+        out = StringIO()
+        call_command('benchmark_queries', repeat=1, stdout=out)
+        for model in (BikeHires, LocationBikeCount):
+            for index in model._meta.indexes:
+                self.assertIn(f"USING INDEX {index.name}", out.getvalue())
+                with connection.cursor() as cursor:
+                    indexes = connection.introspection.get_constraints(cursor, model._meta.db_table)
+                self.assertIn(index.name, indexes)
+
+class LoadTestTests(LiveServerTestCase):
+    """ The load_test harness, run briefly by one rider against a live server """
+
+    @classmethod
+    def setUpClass(cls):
+        # the live server handles each request in a new thread, which would otherwise keep its connection open for
+        # DATABASE_CONN_MAX_AGE - and PostgreSQL can't drop the test database while they are
+        cls.conn_max_age = connection.settings_dict['CONN_MAX_AGE']
+        connection.settings_dict['CONN_MAX_AGE'] = 0
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        connection.settings_dict['CONN_MAX_AGE'] = cls.conn_max_age
+
+    def test_rider_hires_and_returns(self):
+        start = Location.objects.create(station_name="Trongate", latitude=55.855789, longitude=-4.246063)
+        Location.objects.create(station_name="Partick Station", latitude=55.870007, longitude=-4.308759)
+        Bikes.objects.create(status=BikeStatus.AVAILABLE, location=start)
+        Location.objects.filter(pk=start.pk).update(bike_count=1, available_bikes=1)
+
+        with tempfile.NamedTemporaryFile('r', suffix='.json') as output:
+            call_command(
+                'load_test', url=self.live_server_url, riders=1, operators=0, managers=0, seconds=2,
+                output=output.name, stdout=StringIO()
+            )
+            endpoints = json.load(output)['endpoints']
+        self.assertGreater(endpoints['hire']['requests'], 0)
+        self.assertGreater(endpoints['return']['requests'], 0)
+        self.assertEqual(sum(e['error_rate'] for e in endpoints.values()), 0)
+
+class QueryBudgetTests(QueryBudgetTestCase):
+    """ The number of queries each view in bikes.views makes. Duplicates are only allowed where a request
+        genuinely repeats a statement for a fixed number of objects - never once per row of a list
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.bike = Bikes.objects.select_related('location').filter(status=BikeStatus.AVAILABLE).first()
+        self.station = self.bike.location
+        self.other_station = Location.objects.exclude(pk=self.station.pk).first()
+        # changing a station's bike count costs the most queries when its summary rows for the current hour and day
+        # have to be created, so budget for that
+        LocationBikeCountHourly.objects.filter(period__gte=LocationBikeCountDaily.truncate(timezone.now())).delete()
+        LocationBikeCountDaily.objects.filter(period__gte=LocationBikeCountDaily.truncate(timezone.now())).delete()
+
+    def test_public_pages(self):
+        self.assertQueryBudget(self.client.get(reverse('bikes:index')), 1)
+        self.assertQueryBudget(self.client.get(reverse('bikes:view-map')), 2)
+        self.assertQueryBudget(self.client.get(reverse('bikes:location_detail', args=[self.station.pk])), 3)
+        self.assertQueryBudget(self.client.get(reverse('bikes:location_list')), 2)
+
+    def test_registration_checks(self):
+        check_username, check_email = reverse('bikes:ajax_check_username'), reverse('bikes:ajax_check_email')
+        # the first check loads the names into memory, after which free names need no query...
+        self.assertQueryBudget(self.client.get(check_username, {"username": "cust"}), 2)
+        self.assertQueryBudget(self.client.get(check_username, {"username": "custo"}), 0)
+        self.assertQueryBudget(self.client.get(check_email, {"email": "rider@example.com"}), 2)
+        self.assertQueryBudget(self.client.get(check_email, {"email": "rider2@example.com"}), 0)
+        # ...and a taken name is only looked up once
+        response = self.client.get(check_username, {"username": "Customer1"})
+        self.assertTrue(response.json()['username_exists'])
+        self.assertQueryBudget(response, 1)
+        self.assertQueryBudget(self.client.get(check_username, {"username": "customer1"}), 0)
+
+    def test_server_timing_header(self):
+        with self.settings(QUERY_BUDGET_HEADERS=True), self.assertLogs('bikes.middleware', 'DEBUG') as logs:
+            response = self.client.get(reverse('bikes:view-map'))
+        self.assertRegex(response['Server-Timing'], r'^db;dur=[\d.]+;desc="2 queries, 0 duplicated", app;dur=[\d.]+$')
+        self.assertRegex(logs.output[0], r'GET bikes:view-map: 2 queries \(0 duplicated\)')
+        self.assertFalse(self.client.get(reverse('bikes:view-map')).has_header('Server-Timing'))
+        with self.settings(QUERY_BUDGET_RECORD=False):
+            self.assertFalse(hasattr(self.client.get(reverse('bikes:view-map')), 'queries')) # nothing recorded
+
+    def test_register(self):
+        self.assertQueryBudget(self.client.get(reverse('bikes:register')), 0)
+        response = self.client.post(reverse('bikes:register'), {
+            "username": "newrider", "email": "newrider@example.com", "password": "password",
+            "password_confirm": "password", "membership_type": MembershipType.STANDARD
+        })
+        self.assertRedirects(response, reverse('bikes:profile'))
+        # the profile is saved once by the post_save signal, and again with the membership type
+        self.assertQueryBudget(response, 17, duplicates=1)
+
+    def test_customer_pages(self):
+        self.client.force_login(self.customer)
+        self.assertQueryBudget(self.client.get(reverse('bikes:index')), 3)
+        self.assertQueryBudget(self.client.get(reverse('bikes:view-map')), 4)
+        self.assertQueryBudget(self.client.get(reverse('bikes:profile')), 3)
+        self.assertQueryBudget(self.client.post(reverse('bikes:addfunds'), {"balance": 5}), 3)
+        self.assertQueryBudget(self.client.post(reverse('bikes:paycharges')), 3)
+
+    def test_hire_and_return(self):
+        self.client.force_login(self.customer)
+        self.assertTrue(BikeHires.objects.filter(user__user=self.customer).count() > 1)
+        # the first page also loads the station coordinates, for the rides' distances
+        self.assertQueryBudget(self.client.get(reverse('bikes:user-hires')), 4)
+        self.assertQueryBudget(self.client.get(reverse('bikes:user-hires'), {"order": "-duration"}), 3)
+
+        self.assertQueryBudget(self.client.post(reverse('bikes:hire-bike'), {"bike_id": self.bike.pk}), 19)
+        self.assertQueryBudget(self.client.get(reverse('bikes:user-hires')), 8)
+        hire = UserProfile.objects.get(user=self.customer).current_hire
+        response = self.client.post(reverse('bikes:return-bike'), {
+            "hire_id": hire.pk, "location": self.other_station.pk, "discount": ""
+        })
+        self.assertQueryBudget(response, 25)
+        self.assertQueryBudget(self.client.post(reverse('bikes:bike_repair'), {"bike": self.bike.pk}), 7)
+
+    def test_operator_pages(self):
+        self.client.force_login(self.operator)
+        # the move form has two lists of stations
+        self.assertQueryBudget(self.client.get(reverse('bikes:operator-index')), 5, duplicates=1)
+        self.assertQueryBudget(self.client.post(reverse('bikes:track_bike'), {"bike_id": self.bike.pk}), 4)
+        response = self.client.post(reverse('bikes:create-discount'), {
+            "code": "SPRING", "discount_amount": 10, "date_from": "01-03-2020", "date_to": "31-05-2020"
+        })
+        self.assertQueryBudget(response, 4)
+        self.assertTrue(Discounts.objects.filter(code="SPRING").exists())
+        # both stations' counts (and their hourly and daily summaries) are adjusted, with the same statements
+        response = self.client.post(reverse('bikes:move-bike'), {
+            "location": self.station.pk, "new_location": self.other_station.pk
+        })
+        self.assertQueryBudget(response, 30, duplicates=8)
 
-# Create your tests here.
+        utils.report_bike(self.bike)
+        self.assertQueryBudget(self.client.post(reverse('bikes:repair-bike'), {"bike": self.bike.pk}), 8)
@@ -1,88 +1,306 @@
 from collections import namedtuple
-from datetime import datetime
+from datetime import datetime, timedelta
 import random
+import threading
+import time
 
-from django.db.models import F
+from django.db import connection, transaction
+from django.core.exceptions import ValidationError
+from django.db.models import F, Q
 from django.utils import timezone
+from django.utils.duration import duration_string
 import pytz
-import geopy.distance
 
+from reports.cache import bump_data_version
+from reports.models import StationTripCount
 from .cost_calculator import CostCalculator
 from .models import *
-from reports.models import LocationBikeCount
+from .sqlite import serialized_write
+
+class QueryLog:
+    """ Records the SQL statements run on a database connection, while installed with connection.execute_wrapper() """
+
+    def __init__(self):
+        self.queries = []
+
+    def __call__(self, execute, sql, params, many, context):
+        self.queries.append(sql)
+        return execute(sql, params, many, context)
 
 def return_bike(hire, end_station, user_discount_code):
-    hire.end_station = end_station
-    hire.date_returned = timezone.now()
-    model = Discounts.objects.filter(code=user_discount_code)
-    if model.exists():
-        model = model.get()
-        hire.discount_applied = model
-        discount_model = UserDiscounts(user=hire.user, discounts=model, date_used=timezone.now())
-    charges, discount = CostCalculator(hire).calculate_cost()
-    if hire.discount_applied is not None:
-        discount_model.amount_saved = discount
-        discount_model.save()
-    hire.charges = charges
-    hire.save()
-
-    # nullify user's current hire
-    hire.user.current_hire = None
-    hire.user.add_charges(charges)
-    hire.user.save()
-
-    # set bike location
-    bike = hire.bike
-    bike.location = hire.end_station
-    bike.save()
+    """ Returns a hired bike to `end_station` as one atomic unit: prices the hire, charges the user, adds the ride
+        to their totals and the stations' trip counts, and docks the bike. `hire.user` and `hire.bike` are used as loaded (e.g. via select_related)
+        rather than fetched again, and every write is an UPDATE of only the changed columns.
+        Raises HireAlreadyReturned if the hire was already returned. The SQL issued is stored on `hire.return_queries`
+    """
+    log = QueryLog()
+    with connection.execute_wrapper(log), serialized_write(), transaction.atomic():
+        hire.end_station = end_station
+        hire.date_returned = timezone.now()
+        hire.discount_applied = Discounts.objects.filter(code=user_discount_code).first() if user_discount_code else None
+        charges, discount = CostCalculator(hire).calculate_cost()
+        hire.charges = charges
+
+        # close the hire - unless it has already been returned, e.g. by a form submitted twice
+        closed = BikeHires.objects.filter(pk=hire.pk, date_returned=None).update(
+            end_station=end_station, date_returned=hire.date_returned, charges=charges,
+            discount_applied=hire.discount_applied
+        )
+        if not closed:
+            raise HireAlreadyReturned(f"Bike {hire.bike_id} has already been returned")
+        if hire.start_station_id is not None:
+            StationTripCount.add_trip(hire.start_station_id, end_station.pk, timezone.localdate(hire.date_hired))
+        if hire.discount_applied is not None:
+            UserDiscounts.objects.create(user_id=hire.user_id, discounts=hire.discount_applied, amount_saved=discount)
+
+        # nullify user's current hire, and add the charges to their account
+        UserProfile.objects.filter(pk=hire.user_id).update(current_hire=None, **UserProfile.add_charges_update(charges))
+        hire.user.current_hire = None
+        hire.user.add_charges(charges)
+
+        # add the ride to the user's running totals
+        UserRideStats.add_ride(hire, ride_distance(hire).km)
 
+        # set bike location. The bike is available again, unless it was reported for repair while on hire and
+        # hasn't been repaired since (repair_bike makes an undocked bike AVAILABLE, ready for its return)
+        bike = hire.bike
+        available = Bikes.objects.filter(pk=bike.pk, status=BikeStatus.ON_HIRE) \
+            .update(location=end_station, status=BikeStatus.AVAILABLE)
+        if available:
+            bike.status = BikeStatus.AVAILABLE
+        else:
+            Bikes.objects.filter(pk=bike.pk).update(location=end_station)
+            # the UPDATE locks the row, so the status read back can't change before commit
+            bike.status = Bikes.objects.filter(pk=bike.pk).values_list('status', flat=True).get()
+            available = int(bike.status == BikeStatus.AVAILABLE)
+        bike.location = end_station
+        Location.adjust_counts(end_station.pk, docked=1, available=available, when=hire.date_returned)
+        bump_data_version()
+
+    hire.return_queries = log.queries
     return hire
 
-def move_bike(bike, new_station):
-    
-    # set bike location
-    old = bike.location
-    bike.location = new_station
-    
-    # update location bike count table for old and new stations
-    count = LocationBikeCount.objects.filter(location=old).last().count
-    LocationBikeCount.objects.create(
-        location=old, datetime=timezone.now(), count=count - 1
-    )
-    # add 1 to new bike station's count
-    count = LocationBikeCount.objects.filter(location=new_station).last().count
-    LocationBikeCount.objects.create(
-        location=new_station, datetime=timezone.now(), count=count + 1
-    )
+def move_bike(old_station, new_station):
+    """ Moves a bike docked at `old_station` to `new_station`, and returns it - or None if there was no bike to move.
+        The bike is claimed with a conditional UPDATE, so one hired (or moved) meanwhile is left alone
+    """
+    with serialized_write(), transaction.atomic():
+        while True:
+            bike = Bikes.objects.filter(location=old_station).first()
+            if bike is None:
+                return None
+            # only moved if it's still there with the status read, which the counts below are adjusted for
+            if Bikes.objects.filter(pk=bike.pk, location=old_station, status=bike.status).update(location=new_station):
+                break
+        bike.location = new_station
 
-    bike.save()
+        # update the bike counts (and history) for the old and new stations
+        now = timezone.now()
+        available = int(bike.status == BikeStatus.AVAILABLE)
+        Location.adjust_counts(old_station.pk, docked=-1, available=-available, when=now)
+        Location.adjust_counts(new_station.pk, docked=1, available=available, when=now)
+        bump_data_version()
+    return bike
+
+def report_bike(bike):
+    """ Takes a bike out of circulation for repair, and creates the corresponding BikeRepairs object """
+    with serialized_write(), transaction.atomic():
+        # only an available bike leaves its station's available count
+        was_available = Bikes.objects.filter(pk=bike.pk, status=BikeStatus.AVAILABLE) \
+            .update(status=BikeStatus.BEING_REPAIRED)
+        if was_available:
+            Location.adjust_counts(bike.location_id, available=-1)
+        else:
+            Bikes.objects.filter(pk=bike.pk).update(status=BikeStatus.BEING_REPAIRED)
+        bike.status = BikeStatus.BEING_REPAIRED
+        BikeRepairs.objects.create(bike=bike)
+        bump_data_version()
     return bike
 
 def repair_bike(bike):
-    # change the status of the bike to repaired
-    bike.status = 1
+    with serialized_write(), transaction.atomic():
+        # change the status of the bike to repaired, and return it to its station's available count
+        repaired = Bikes.objects.filter(pk=bike.pk, status=BikeStatus.BEING_REPAIRED) \
+            .update(status=BikeStatus.AVAILABLE)
+        bike.status = BikeStatus.AVAILABLE
+        if repaired:
+            Location.adjust_counts(bike.location_id, available=1)
+        bump_data_version()
     # generate repair "cost" - between 2 and 40 with values <= 30 more likely
     cost = random.randint(2, 40)
     if cost > 30 and random.random() < .5:
         cost = cost // 2
-    bike.save()
     return cost
 
+def add_funds(user, balance):
+    """ Adds funds to a user's (UserProfile's) balance, paying off their charges first.
+        Applied to the row as it is now, not as `user` was read - a return may have added charges since
+    """
+    with serialized_write():
+        UserProfile.objects.filter(pk=user.pk).update(**UserProfile.add_balance_update(balance))
+        bump_data_version()
+
+def pay_charges(user):
+    """ Pays a user's charges from their balance, if it covers them. Returns whether they were paid.
+        A conditional update, so charges added by a return since `user` was read are paid (or not) too,
+        and nothing else on the row is overwritten
+    """
+    with serialized_write():
+        paid = UserProfile.objects.filter(pk=user.pk, balance__gte=F('charges')) \
+            .update(balance=F('balance') - F('charges'), charges=0)
+        if paid:
+            bump_data_version()
+    return bool(paid)
+
+Distance = namedtuple('Distance', 'km miles feet')
+
+# Seconds before StationDistances reloads the station coordinates, to pick up stations moved by another process
+STATION_COORDINATES_MAX_AGE = 60
+
+class StationDistances:
+    """ Cache of the geodesic distance between pairs of stations, keyed by (start pk, end pk).
+        Station coordinates are loaded from the Location table, and each pair's distance is calculated at most once
+        per position of its stations. The Location signals keep the cache in step when a station is created, moved
+        or deleted in this process; stations changed by another process are picked up when the coordinates are
+        reloaded, at most STATION_COORDINATES_MAX_AGE seconds after they were last loaded.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._coords = None # station pk -> (latitude, longitude)
+        self._loaded = None # time.monotonic() when _coords was loaded
+        self._km = {}       # (start pk, end pk) -> distance in km
+
+    def rebuild(self):
+        """ Reloads every station's coordinates and drops all cached distances """
+        self._reload(keep_distances=False)
+
+    def reset(self):
+        """ Drops the coordinates and distances, to be loaded again on next use """
+        with self._lock:
+            self._coords, self._km = None, {}
+
+    def _reload(self, keep_distances=True):
+        """ Reloads every station's coordinates, dropping the cached distances of stations that moved or were deleted """
+        loaded = time.monotonic()
+        coords = {pk: (lat, lon) for pk, lat, lon in Location.objects.values_list('pk', 'latitude', 'longitude')}
+        with self._lock:
+            if keep_distances and self._coords is not None:
+                changed = {pk for pk, position in self._coords.items() if coords.get(pk) != position}
+                self._km = {k: v for k, v in self._km.items() if not changed.intersection(k)}
+            else:
+                self._km = {}
+            self._coords, self._loaded = coords, loaded
+
+    def _expired(self):
+        return self._coords is None or time.monotonic() - self._loaded >= STATION_COORDINATES_MAX_AGE
+
+    def update_station(self, location):
+        """ Called when a Location is saved. Drops cached distances for the station if it is new or has moved """
+        coords = (location.latitude, location.longitude)
+        with self._lock:
+            if self._coords is None or self._coords.get(location.pk) == coords:
+                return
+            self._coords[location.pk] = coords
+            self._km = {k: v for k, v in self._km.items() if location.pk not in k}
+
+    def remove_station(self, location):
+        with self._lock:
+            if self._coords is not None:
+                self._coords.pop(location.pk, None)
+            self._km = {k: v for k, v in self._km.items() if location.pk not in k}
+
+    def coordinates(self, station_ids=()):
+        """ Returns the mapping of station pk -> (latitude, longitude), making sure it covers `station_ids` """
+        if self._expired() or any(pk not in self._coords for pk in station_ids):
+            # the station may have been created (or moved) by another process - reload the coordinates
+            self._reload()
+        return self._coords
+
+    def km(self, start_id, end_id):
+        """ Returns the distance in km between two stations, given their primary keys.
+            Raises Location.DoesNotExist if either station doesn't exist
+        """
+        key = (start_id, end_id)
+        if self._expired():
+            self._reload()
+        try:
+            return self._km[key]
+        except KeyError:
+            pass
+        import geopy.distance # loaded on first use, like the other analytics libraries
+
+        coords = self.coordinates((start_id, end_id))
+        missing = [pk for pk in (start_id, end_id) if pk not in coords]
+        if missing:
+            raise Location.DoesNotExist(f"No station with id {missing[0]}")
+        dist = geopy.distance.distance(coords[start_id], coords[end_id]).km # geodesic distance
+        with self._lock:
+            self._km[key] = self._km[(end_id, start_id)] = dist
+        return dist
+
+station_distances = StationDistances()
+
 def ride_distance(hire):
     """ Calculates a ride's distance between the start and end stations
-        Uses geopy.distance.distance [an implementation of geodesic distance]
+        Distances come from the `station_distances` cache [geodesic distance, via geopy.distance.distance]
         returns namedtuple of distance attributes: kilometres, miles and feet for the distance 
     """
-    start, end = hire.start_station, hire.end_station
-    Distance = namedtuple('Distance', 'km miles feet')
-    if end is not None:
-        # extract latitude and longitudes for the start and end stations
-        start = start.latitude, start.longitude
-        end   = end.latitude, end.longitude
-        dist = geopy.distance.distance(start, end) # calculate geodesic distance
-        return Distance(km=dist.km, miles=dist.miles, feet=dist.feet)
+    if hire.end_station_id is not None and hire.start_station_id is not None:
+        import geopy.units
+
+        km = station_distances.km(hire.start_station_id, hire.end_station_id)
+        miles = geopy.units.miles(kilometers=km)
+        return Distance(km=km, miles=miles, feet=geopy.units.feet(miles=miles))
     return 0 # if end is None
 
+# mean Earth radius (IUGG), used by the haversine mode of ride_distances
+EARTH_RADIUS_KM = 6371.0088
+
+def ride_distances(hires=None, start_ids=None, end_ids=None, method='geodesic'):
+    """ Batch version of ride_distance. Takes either a BikeHires queryset, or parallel sequences of
+        start and end station ids, and returns a NumPy array of every ride's distance in km.
+        Rides without an end station have a distance of 0.
+
+        method='geodesic' - exact WGS-84 geodesic distance (the same values as ride_distance). Each distinct
+            station pair is solved once via `station_distances`, then broadcast to every ride with NumPy.
+        method='haversine' - great-circle distance on a sphere of radius EARTH_RADIUS_KM, in a single NumPy pass.
+            Differs from the geodesic distance by at most 0.56% (the Earth's flattening), and by at most 0.35% around Glasgow.
+    """
+    import numpy as np
+
+    if hires is not None:
+        rows = list(hires.order_by().values_list('start_station_id', 'end_station_id'))
+        pairs = np.array(rows, dtype=float).reshape(-1, 2) # null station ids become NaN
+        start_ids, end_ids = pairs[:, 0], pairs[:, 1]
+    start_ids = np.asarray(start_ids, dtype=float)
+    end_ids = np.asarray(end_ids, dtype=float)
+
+    distances = np.zeros(len(start_ids))
+    valid = ~(np.isnan(start_ids) | np.isnan(end_ids))
+    if not valid.any():
+        return distances
+    start_ids = start_ids[valid].astype(np.int64)
+    end_ids = end_ids[valid].astype(np.int64)
+
+    if method == 'geodesic':
+        pairs, inverse = np.unique(np.stack((start_ids, end_ids), axis=1), axis=0, return_inverse=True)
+        pair_km = np.array([station_distances.km(int(start), int(end)) for start, end in pairs])
+        distances[valid] = pair_km[inverse.ravel()]
+    elif method == 'haversine':
+        coords = station_distances.coordinates(set(np.unique(np.concatenate((start_ids, end_ids))).tolist()))
+        pks = np.array(sorted(coords))
+        lat = np.radians([coords[pk][0] for pk in pks])
+        lon = np.radians([coords[pk][1] for pk in pks])
+        start, end = np.searchsorted(pks, start_ids), np.searchsorted(pks, end_ids)
+
+        a = np.sin((lat[end] - lat[start]) / 2) ** 2 + \
+            np.cos(lat[start]) * np.cos(lat[end]) * np.sin((lon[end] - lon[start]) / 2) ** 2
+        distances[valid] = 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(a))
+    else:
+        raise ValueError(f"Unknown distance method: {method}")
+    return distances
+
 def parse_dates(date_from, date_to):
     """ Creates timezone aware datetime objects from string parameters """
     day_from, month_from, year_from = date_from.split("-")
@@ -95,4 +313,57 @@ def parse_dates(date_from, date_to):
         year=int(year_to), month=int(month_to), day=int(day_to), tzinfo=pytz.UTC
     )
 
-    return _from, _to
\ No newline at end of file
+    return _from, _to
+
+
+KeysetPage = namedtuple('KeysetPage', 'object_list next_cursor previous_cursor')
+
+def keyset_page(queryset, ordering, after=None, before=None, per_page=20):
+    """ Returns one page of `queryset`, ordered by `ordering` (a field or annotation, with '-' for descending) and
+        then by pk, as a KeysetPage. `after` and `before` are the page's neighbours' next_cursor and previous_cursor
+        (None at either end) - each is the sort key of a row, and the page is found by seeking past it, so a page
+        costs the same however far through the results it is, unlike with an OFFSET.
+        The ordering field must not be null. An invalid cursor gives the first page
+    """
+    field = ordering.lstrip('-')
+    key = _decode_cursor(queryset, field, before or after)
+    backwards = key is not None and bool(before)
+    # the direction the rows are read in, which is reversed when reading back from `before`
+    descending = ordering.startswith('-') != backwards
+    if key is not None:
+        value, pk = key
+        seek = 'lt' if descending else 'gt'
+        queryset = queryset.filter(Q(**{f"{field}__{seek}": value}) | Q(**{field: value, f"pk__{seek}": pk}))
+    direction = '-' if descending else ''
+    rows = list(queryset.order_by(f"{direction}{field}", f"{direction}pk")[:per_page + 1])
+    more = len(rows) > per_page # one extra row is read to find out if there's another page
+    rows = rows[:per_page]
+    if backwards:
+        rows.reverse()
+    has_next, has_previous = (True, more) if backwards else (more, key is not None)
+    return KeysetPage(
+        rows,
+        _encode_cursor(rows[-1], field) if rows and has_next else None,
+        _encode_cursor(rows[0], field) if rows and has_previous else None
+    )
+
+def _encode_cursor(row, field):
+    value = getattr(row, field)
+    if isinstance(value, datetime):
+        value = value.isoformat()
+    elif isinstance(value, timedelta):
+        value = duration_string(value)
+    return f"{row.pk}:{value}"
+
+def _decode_cursor(queryset, field, cursor):
+    """ Returns the (value, pk) sort key in a cursor, or None if there isn't one or it's invalid """
+    if not cursor:
+        return None
+    output_field = queryset.query.annotations[field].output_field if field in queryset.query.annotations \
+        else queryset.model._meta.get_field(field)
+    try:
+        pk, value = cursor.split(':', 1)
+        value = output_field.to_python(value)
+        return (value, int(pk)) if value is not None else None
+    except (ValidationError, ValueError):
+        return None
@@ -1,10 +1,10 @@
 from django.contrib import messages
 from django.contrib.auth import authenticate, login
 from django.contrib.auth.decorators import login_required
-from django.contrib.auth.models import User
 from django.contrib.messages.views import SuccessMessageMixin
 from django.core.paginator import Paginator
-from django.db.models import F, ExpressionWrapper, fields
+from django.db.models import F, ExpressionWrapper, Value, fields
+from django.db.models.functions import Coalesce
 from django.http import JsonResponse, HttpResponse
 from django.shortcuts import render, redirect
 from django.urls import reverse
@@ -13,11 +13,14 @@ from django.views.generic.edit import CreateView
 from django.views.decorators.csrf import csrf_exempt
 from rest_framework.generics import ListAPIView
 
+from .accounts import account_names
 from .cost_calculator import CostCalculator
-from .choices import MembershipType, BikeStatus, UserType
+from .choices import MembershipType
 from .forms import RegistrationForm, UserProfileForm, BikeHireForm, ReturnBikeForm, BikeRepairsForm, \
     MoveBikeForm, DiscountsForm, RepairBikeForm
-from .models import Location, UserProfile, BikeHires, Bikes, Discounts, BikeRepairs
+from .models import Location, UserProfile, UserRideStats, BikeHires, Bikes, BikeNotAvailable, HireAlreadyReturned, \
+    Discounts
+from .roles import role_required, OPERATORS
 from .serializers import LocationSerializer
 from . import utils
 
@@ -53,9 +56,9 @@ def location_detail(request, pk):
         return HttpResponse("Location not found")
 
     bikes = location.bikes_set.all()
-    num_bikes = bikes.count()
 
     paginator = Paginator(bikes, 10)
+    num_bikes = paginator.count
     page = request.GET.get('page', 1)
     bikes = paginator.get_page(page)
 
@@ -75,16 +78,12 @@ def location_detail(request, pk):
 @login_required
 def profile(request):
     # get current user and userprofile models from the request
-    user = request.user
-    current_user = UserProfile.objects.get(user=user)
+    current_user = request.user.userprofile
 
-    # filter out the user's rides from the database
-    user_rides = BikeHires.objects.filter(user=current_user, end_station__isnull=False)
-    # get the total number of rides the user has taken
-    num_bike_rides = user_rides.count()
-
-    # calculate the total distance the user has travelled in all their rides
-    distance_travelled = sum([utils.ride_distance(hire).km for hire in user_rides])
+    # the user's ride totals are kept up to date on every return (see UserRideStats)
+    stats = UserRideStats.objects.filter(user=current_user).first() or UserRideStats(user=current_user)
+    num_bike_rides = stats.num_rides
+    distance_travelled = stats.total_km
     photo_form = UserProfileForm({'picture': current_user.profile_pic})
     context = {
         "num_bike_rides": num_bike_rides,
@@ -105,9 +104,7 @@ def addfunds(request):
     
     added_balance = request.POST.get('balance', 0)
     added_balance = '%.2f' % (float(added_balance))
-    userprofile = request.user.userprofile
-    userprofile.add_balance(float(added_balance))
-    userprofile.save()
+    utils.add_funds(request.user.userprofile, float(added_balance))
     messages.info(request, f"£{added_balance} was added to your balance.")
     return redirect(reverse("bikes:profile"))
 
@@ -117,43 +114,54 @@ def paycharges(request):
 
     # does this have to be a post?
     #      
-    userprofile = request.user.userprofile
-    if userprofile.balance >= userprofile.charges:
-        userprofile.balance = userprofile.balance - userprofile.charges
-        userprofile.charges = 0
-        userprofile.save()
+    if utils.pay_charges(request.user.userprofile):
         messages.info(request, "Your charges have been paid")
     else:
         messages.info(request, "Your balance does not cover your charges. \nPlease add more funds.")
     return redirect(reverse("bikes:profile"))
 
+# The orderings offered on the user-hires page
+HIRE_ORDERINGS = ('date_hired', 'charges', 'duration')
+HIRES_PER_PAGE = 20
+
 @login_required
 def user_hires(request):
-    """ This view shows the user's current hires, as well as their historical hires """
+    """ This view shows the user's current hires, as well as their historical hires.
+        The history is paginated by keyset (see utils.keyset_page), as riders can have thousands of hires
+    """
     user = request.user.userprofile
     current_hire = user.current_hire
 
     ordering = request.GET.get('order')
-    if ordering is None:
+    if ordering is None or ordering.lstrip('-') not in HIRE_ORDERINGS:
         ordering = '-date_hired'
 
-    if "duration" not in ordering:
-        historical_hires = BikeHires.objects.filter(user=user, end_station__isnull=False).order_by(ordering)
-    else:
+    # the stations are shown for every hire, so fetch them in the same query
+    hires = BikeHires.objects.select_related('start_station', 'end_station').filter(user=user, end_station__isnull=False)
+    if "duration" in ordering:
         # because duration is an 'implied' field, we need to annotate each model with their duration before ordering
         # duration = date_returned - date_hired. The below code annotates each model with a 'duration' field
         duration = ExpressionWrapper(F('date_returned') - F('date_hired'), output_field=fields.DurationField())
-        historical_hires = BikeHires.objects.filter(user=user, end_station__isnull=False) \
-            .annotate(duration=duration)
-        historical_hires = historical_hires.order_by(ordering)
-    
-    # annotate the historical hires models with the distance travelled for each ride
-    for h in historical_hires:
+        hires = hires.annotate(duration=duration)
+    sort = ordering
+    if "charges" in ordering:
+        # charges can be null, which the keyset can't seek past - a hire without charges is sorted as free
+        hires = hires.annotate(cost=Coalesce('charges', Value(0.0), output_field=fields.FloatField()))
+        sort = ordering.replace('charges', 'cost')
+    page = utils.keyset_page(
+        hires, sort, after=request.GET.get('after'), before=request.GET.get('before'), per_page=HIRES_PER_PAGE
+    )
+
+    # annotate the page's hires with the distance travelled for each ride
+    for h in page.object_list:
         h.distance = utils.ride_distance(h)
 
     context = {
         "current_hire": current_hire,
-        "historical_hires": historical_hires
+        "historical_hires": page.object_list,
+        "ordering": ordering,
+        "next_cursor": page.next_cursor,
+        "previous_cursor": page.previous_cursor
     }
 
     if current_hire is not None:
@@ -170,18 +178,25 @@ def hire_bike(request):
     user = request.user.userprofile
     if form.is_valid():
         bike_id = form.cleaned_data['bike_id'] 
-        bike = Bikes.objects.get(pk=bike_id)
+        bike = Bikes.objects.select_related('location').get(pk=bike_id)
         
-        if user.current_hire is not None:
+        if user.current_hire_id is not None:
             messages.error(request, "Please return your bike before attempting to hire a new one")
             return redirect(reverse('bikes:user-hires'))
         elif user.charges != 0:
             messages.error(request, "You can not hire another bike before you pay your charges.")
             return redirect(reverse('bikes:user-hires'))
+        elif bike.location is None:
+            messages.error(request, f"Bike {bike_id} is not available to hire")
+            return redirect(reverse('bikes:view-map'))
         station = bike.location.station_name
         
         # call the hire() method to hire the bike [this is on Bikes model]
-        bike.hire(user)
+        try:
+            bike.hire(user)
+        except BikeNotAvailable as e:
+            messages.error(request, str(e))
+            return redirect(reverse('bikes:location_detail', args=[bike.location_id]))
 
         messages.info(request, f"You have hired bike {bike_id} from station {station}")
         return redirect(reverse('bikes:user-hires'))
@@ -192,11 +207,20 @@ def return_bike(request):
     user = request.user.userprofile
     form = ReturnBikeForm(request.POST or None) # populate the bike form with POST data
     if form.is_valid():
-        hire = BikeHires.objects.get(pk=form.cleaned_data['hire_id']) # get model object
+        # get model object - users can only return their own hires
+        hire = BikeHires.objects.select_related('bike').filter(pk=form.cleaned_data['hire_id'], user=user).first()
+        if hire is None:
+            messages.error(request, "Warning: an error occurred when trying to return the bike")
+            return redirect(reverse('bikes:user-hires'))
+        hire.user = user
 
         # call utils function to perform all actions required when returning a bike
-        hire = utils.return_bike(hire, form.cleaned_data['location'], form.cleaned_data['discount'])
-        messages.info(request, f"Bike {hire.bike.pk} returned. Charges: £{hire.charges:.2f}")
+        try:
+            hire = utils.return_bike(hire, form.cleaned_data['location'], form.cleaned_data['discount'])
+        except HireAlreadyReturned as e:
+            messages.error(request, str(e))
+            return redirect(reverse('bikes:user-hires'))
+        messages.info(request, f"Bike {hire.bike_id} returned. Charges: £{hire.charges:.2f}")
 
     # redirect user to their hires page
     else:
@@ -231,10 +255,11 @@ class RegistrationView(SuccessMessageMixin, CreateView):
 def validate_username(request):
     """ Called when a user is registering and typing their username.
         Every key typed will send a request to this view function, to check whether the username is taken.
-        If the username matches a username in the database, the user should be prevented from signing up
+        If the username matches a username in the database, the user should be prevented from signing up.
+        Most names typed are free, and are answered from memory without a query (see accounts.AccountNames)
     """
     username = request.GET.get('username', None)
-    username_exists = User.objects.filter(username__iexact=username).exists()
+    username_exists = account_names.probably_taken('username', username)
     return JsonResponse({
         "username_exists": username_exists
     })
@@ -246,7 +271,7 @@ def validate_email(request):
         unless they change the email address
     """
     email = request.GET.get('email', None)
-    email_exists = User.objects.filter(email__iexact=email).exists()
+    email_exists = account_names.probably_taken('email', email)
     return JsonResponse({
         "email_exists": email_exists
     })
@@ -269,7 +294,7 @@ def profile_pic_add(request, pk):
 
 
 class LocationList(ListAPIView):
-    queryset = Location.objects.all()
+    queryset = Location.objects.prefetch_related('bikes_set') # each location lists its bikes
     serializer_class = LocationSerializer
 
 def bike_report(request):
@@ -281,12 +306,8 @@ def bike_report(request):
         # this is the Bike object (i.e. the model)
         bike = form.cleaned_data['bike']
 
-        # now set bikes status to BEING_REPAIRED
-        bike.status = BikeStatus.BEING_REPAIRED
-        bike.save()
-
-        # and create the BikeRepairs object
-        BikeRepairs.objects.create(bike=bike)
+        # now set bikes status to BEING_REPAIRED, and create the BikeRepairs object
+        utils.report_bike(bike)
 
         messages.info(request, f"Bike {bike.pk} has been reported for repair, and taken out of circulation")
         return redirect(reverse('bikes:view-map'))
@@ -296,18 +317,9 @@ def bike_report(request):
 ################## 
 # OPERATOR VIEWS
 
-def is_operator(user):
-    """ This function is the 'test' for which a user must pass to view the operator pages.
-        The user must be of type UserType.OPERATOR in order to view any of these pages. """
-
-    return user.userprofile.user_type == UserType.OPERATOR or user.userprofile.user_type == UserType.MANAGER
-
 @csrf_exempt
-@login_required
+@role_required(*OPERATORS)
 def operator_index(request):
-    if not is_operator(request.user):
-        return redirect(reverse('bikes:index'))
-
     trackurl = reverse('bikes:track_bike')
     repairurl = reverse('bikes:repair-bike')
     repairform = RepairBikeForm()
@@ -322,10 +334,8 @@ def operator_index(request):
     return render(request, 'bikes/operator_index.html',context)
 
 @csrf_exempt
-@login_required
+@role_required(*OPERATORS)
 def track_bike(request):
-    if not is_operator(request.user):
-        return redirect(reverse('bikes:index'))
     bike_id = request.POST['bike_id']
     try:
         bike = Bikes.objects.get(pk = bike_id)
@@ -335,11 +345,8 @@ def track_bike(request):
     except Bikes.DoesNotExist:
         return JsonResponse({"bike_location": "None", "bike_status" : "None"})
 
-@login_required
+@role_required(*OPERATORS)
 def create_discount(request):
-    if not is_operator(request.user):
-        return redirect(reverse('bikes:index'))
-
     form = DiscountsForm(request.POST or None)
     if form.is_valid():
         discount = form.save()
@@ -350,38 +357,35 @@ def create_discount(request):
     return redirect(reverse('bikes:operator-index'))
 
 @csrf_exempt
-@login_required
+@role_required(*OPERATORS)
 def repair_bike(request):
-    if not is_operator(request.user):
-        return redirect(reverse('bikes:index'))
-
     repair_form = RepairBikeForm(request.POST or None)
 
     if repair_form.is_valid():
         bike = repair_form.cleaned_data['bike']
         cost = utils.repair_bike(bike)
-        messages.success(request, f"Bike {bike.pk} was repaired at cost of £{cost}, and is now available at \
-            {bike.location.station_name} station.")
+        if bike.location is not None:
+            messages.success(request, f"Bike {bike.pk} was repaired at cost of £{cost}, and is now available at \
+                {bike.location.station_name} station.")
+        else:
+            messages.success(request, f"Bike {bike.pk} was repaired at cost of £{cost}, and will be available \
+                once its hire is returned.")
     else:
         messages.error(request, "There was a problem repairing that bike. Please try again")
     return redirect(reverse('bikes:operator-index'))
 
 
-@login_required
+@role_required(*OPERATORS)
 def move_bike(request):
     """ Moves a bike from location A to location B """
-    if not is_operator(request.user):
-        return redirect(reverse('bikes:index'))
     form = MoveBikeForm(request.POST or None)
     if form.is_valid():
         old = form.cleaned_data['location'] # get original station
         new = form.cleaned_data['new_location'] # get new station
-        try:
-            bike = Bikes.objects.get(pk=old.bikes_set.first().id) # get bike object from database
-            bike = utils.move_bike(bike, new) # call utils method to move the bike
+        bike = utils.move_bike(old, new) # call utils method to move a bike at the original station
+        if bike is not None:
             messages.info(request, f"Bike {bike.pk} has been moved from {old.station_name} to {new.station_name}.")
-
-        except (AttributeError, Bikes.DoesNotExist) as e:
+        else:
             messages.error(request, f"An error occurred: station selected ({old.station_name}) does not have any bikes to move!")
         
     else:
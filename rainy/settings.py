@@ -1,4 +1,5 @@
 import os
+from django.core.exceptions import ImproperlyConfigured
 from django.urls import reverse_lazy
 from django.utils import timezone
 
@@ -36,6 +37,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'bikes.middleware.QueryBudgetMiddleware', # first, so it counts the queries made by the other middleware too
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -70,11 +72,81 @@ WSGI_APPLICATION = 'rainy.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/2.2/ref/settings/#databases
 
-DATABASES = {
-    'default': {
+# The database is configured from the environment, defaulting to the SQLite file used in development:
+#   DATABASE_ENGINE        'sqlite3' (the default), or 'postgresql' for production - this needs the psycopg2 package
+#                          from requirements-postgresql.txt
+#   DATABASE_NAME          the SQLite file, or the PostgreSQL database (default 'rainy')
+#   DATABASE_USER, DATABASE_PASSWORD, DATABASE_HOST, DATABASE_PORT
+#                          PostgreSQL connection details (by default, the local server's Unix socket as the current user)
+#   DATABASE_CONN_MAX_AGE  seconds each process keeps its connection open for later requests, rather than reconnecting
+#                          for every request (default 60; 0 closes it after each request)
+#   DATABASE_POOLER        set to 'pgbouncer' when DATABASE_HOST/PORT is a PgBouncer pool in transaction pooling mode,
+#                          which shares a few server connections between many processes. Cursors can't be kept
+#                          open across transactions there, so Django's server-side cursors are turned off
+db_engine = os.environ.get('DATABASE_ENGINE', 'sqlite3')
+
+if db_engine == 'sqlite3':
+    default_database = {
         'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+        'NAME': os.environ.get('DATABASE_NAME', os.path.join(BASE_DIR, 'db.sqlite3')),
+    }
+elif db_engine == 'postgresql':
+    default_database = {
+        'ENGINE': 'django.db.backends.postgresql',
+        'NAME': os.environ.get('DATABASE_NAME', 'rainy'),
+        'USER': os.environ.get('DATABASE_USER', ''),
+        'PASSWORD': os.environ.get('DATABASE_PASSWORD', ''),
+        'HOST': os.environ.get('DATABASE_HOST', ''),
+        'PORT': os.environ.get('DATABASE_PORT', ''),
+        'DISABLE_SERVER_SIDE_CURSORS': os.environ.get('DATABASE_POOLER') == 'pgbouncer',
     }
+else:
+    raise ImproperlyConfigured(f"Unsupported DATABASE_ENGINE {db_engine!r} - use 'sqlite3' or 'postgresql'")
+
+default_database['CONN_MAX_AGE'] = int(os.environ.get('DATABASE_CONN_MAX_AGE', 60))
+
+# SQLite tuning for concurrent requests, applied to every new connection (see bikes/sqlite.py):
+#   journal_mode  WAL lets the pages keep reading while a hire or return is written, and a write no longer waits
+#                 for the reads to finish. It's a property of the database file, kept once set
+#   synchronous   NORMAL is safe with WAL: a power cut can lose the last few commits, but can't corrupt the database
+#   mmap_size     reads the database through memory-mapped I/O, up to this many bytes
+#   busy_timeout  milliseconds a write waits for another process's write to finish, before "database is locked"
+# Set DATABASE_SQLITE_TUNING=0 for SQLite's defaults (the journal mode stays as it was last set)
+SQLITE_PRAGMAS = {
+    'journal_mode': 'wal',
+    'synchronous': 'normal',
+    'mmap_size': 256 * 1024 * 1024,
+    'busy_timeout': 20000,
+} if os.environ.get('DATABASE_SQLITE_TUNING', '1') == '1' else {}
+
+# On SQLite, the hire, return, move, repair and balance writes wait for each other within a process (see
+# bikes.sqlite.serialized_write), rather than failing with "database is locked" when they collide
+SQLITE_SERIALIZE_WRITES = True
+
+DATABASES = {
+    'default': default_database
+}
+
+
+# Caches
+# https://docs.djangoproject.com/en/2.2/topics/cache/
+# The 'reports' cache holds snapshots of the report pages (see reports/cache.py), bounded by age and number.
+# Local memory caches are per process, which is safe with several processes: the report data version that the
+# snapshots are cached under is kept in the database, so a write in any process stales every process's snapshots.
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'default',
+    },
+    'reports': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'reports',
+        'TIMEOUT': 60 * 60,
+        'OPTIONS': {
+            'MAX_ENTRIES': 200,
+        },
+    },
 }
 
 
@@ -122,6 +194,10 @@ MEDIA_URL = '/media/'
 MEDIA_ROOT = MEDIA_DIR
 
 # Login settings
+AUTHENTICATION_BACKENDS = [
+    'bikes.backends.ProfileBackend', # loads the user's profile along with them, on every request
+    'django.contrib.auth.backends.ModelBackend', # for sessions logged in before ProfileBackend was added
+]
 LOGIN_URL = '/login/'
 LOGIN_REDIRECT_URL = reverse_lazy('bikes:index')
 LOGOUT_REDIRECT_URL = reverse_lazy('bikes:index')
@@ -140,4 +216,21 @@ STANDARD_CHARGE_TIME_MAX = timezone.timedelta(minutes=30)
 # The charge period when a ride exceeds 30 minutes, is £1 [CHARGE_PER_INTERVAL]
 # per additional 30 minute interval [TIME_EXCEEDED_INTERVAL]
 TIME_EXCEEDED_INTERVAL = timezone.timedelta(minutes=30)
-CHARGE_PER_INTERVAL = 1
\ No newline at end of file
+CHARGE_PER_INTERVAL = 1
+
+# Per-request SQL instrumentation (see bikes/middleware.py): when on, each response has a Server-Timing header
+# with its query count, duplicated queries, database time and Python time, and these are logged by bikes.middleware.
+# Defaults to DEBUG. QUERY_BUDGET_RECORD records the queries for tests (response.queries) without the headers
+# QUERY_BUDGET_HEADERS = True
+# QUERY_BUDGET_RECORD = False
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler'},
+    },
+    'loggers': {
+        'bikes.middleware': {'handlers': ['console'], 'level': 'DEBUG' if DEBUG else 'INFO'},
+    },
+}
@@ -0,0 +1,68 @@
+""" Snapshot cache for the report pages.
+    Each report's context is cached under the report name, its GET parameters and a data version. The write paths
+    (hire, return, move, report/repair) bump the version once their transaction commits, so a report is never served
+    from data older than the last write - stale snapshots are simply never looked up again, and are evicted by the
+    'reports' cache's TIMEOUT and MAX_ENTRIES (see CACHES in settings.py).
+    The version is a database row (ReportDataVersion), so a write made by one process stales the snapshots cached
+    by every other; the snapshots themselves may be cached per process.
+"""
+from collections import namedtuple
+from hashlib import md5
+import time
+
+from django.core.cache import caches
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.utils import timezone
+from django.utils.http import urlencode
+
+DataVersion = namedtuple('DataVersion', 'version modified') # modified is a Unix timestamp
+
+def data_version():
+    """ Returns the current report data version, and when it last changed, in one query """
+    from .models import ReportDataVersion # imported here - bikes.models imports this module, and reports.models it
+
+    row = ReportDataVersion.objects.filter(pk=1).values_list('version', 'modified').first()
+    if row is None:
+        # start from the clock rather than 1, so that if the version is ever lost (e.g. the table is emptied)
+        # it can't return to a value that snapshots were cached under before
+        try:
+            with transaction.atomic():
+                ReportDataVersion.objects.create(pk=1, version=int(time.time() * 1000), modified=timezone.now())
+        except IntegrityError:
+            pass # created by another request meanwhile
+        row = ReportDataVersion.objects.values_list('version', 'modified').get(pk=1)
+    version, modified = row
+    return DataVersion(version, int(modified.timestamp()))
+
+def bump_data_version():
+    """ Marks every cached report snapshot as stale, once the current transaction (if any) commits """
+    transaction.on_commit(_bump)
+
+def _bump():
+    from .models import ReportDataVersion
+
+    if not ReportDataVersion.objects.filter(pk=1).update(version=F('version') + 1, modified=timezone.now()):
+        data_version() # no version yet - any new one is already unused
+
+def report_key(name, params, version=None):
+    """ The cache key for report `name` with the given GET parameters, at `version` (by default, the current
+        data version)
+    """
+    if version is None:
+        version = data_version().version
+    query = urlencode(sorted((k, sorted(v)) for k, v in params.lists()), doseq=True)
+    return f"reports:{name}:{version}:{md5(query.encode()).hexdigest()}"
+
+def cached_report(name, params, build, version=None):
+    """ Returns the context for report `name` from the cache, or calls build() to compute (and cache) it.
+        The key is taken before building, so a write made while the report is built leaves the result
+        cached under the old version
+    """
+    cache = caches['reports']
+    key = report_key(name, params, version)
+    context = cache.get(key)
+    if context is None:
+        context = build()
+        cache.set(key, context)
+    return context
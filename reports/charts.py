@@ -0,0 +1,118 @@
+""" The data behind each report chart. The chart_data view serves these as JSON (with conditional GET),
+    and static/js/charts.js draws them in the browser once they scroll into view.
+    Each function takes the request's GET parameters and returns a JSON-serialisable dict.
+"""
+import calendar
+
+from django.db.models import Count
+from django.http import QueryDict
+
+from bikes.choices import UserType, MembershipType, BikeStatus
+from bikes.models import Bikes, Location, UserProfile
+from bikes.utils import parse_dates
+from .cache import cached_report
+from .utils import bike_count_series, financial_summary
+
+def report_location(params):
+    """ The station picked with the `loc` parameter (a station name), or the first station """
+    loc = params.get('loc', None)
+    if loc is None:
+        return Location.objects.first()
+    return Location.objects.get(station_name__iexact=loc)
+
+def report_dates(params):
+    """ The `date_from` and `date_to` parameters (DD-MM-YYYY), or (None, None) unless both are given and valid """
+    date_from = params.get('date_from', None)
+    date_to   = params.get('date_to', None)
+    if not (date_from and date_to):
+        return None, None
+    try:
+        parse_dates(date_from, date_to)
+    except ValueError:
+        return None, None
+    return date_from, date_to
+
+def cached_financial_summary():
+    """ financial_summary, shared by the financial report page and its charts until the data changes """
+    return cached_report('financial-summary', QueryDict(), financial_summary)
+
+def location_counts(params):
+    """ The number of bikes currently at each station """
+    stations = Location.objects.values_list('station_name', 'bike_count') # kept up to date on each Location
+    return {
+        "stations": [name for name, count in stations],
+        "bike_counts": [count for name, count in stations]
+    }
+
+def location_history(params):
+    """ A station's bike count over time (see bike_count_series), with datetimes as milliseconds since the epoch """
+    location = report_location(params)
+    date_from, date_to = report_dates(params)
+    if date_from and date_to:
+        series = bike_count_series(location, *parse_dates(date_from, date_to))
+    else:
+        series = bike_count_series(location)
+    series["datetime"] = [d.timestamp() * 1000 for d in series["datetime"]]
+    series["station"] = location.station_name
+    return series
+
+def membership_counts(params):
+    """ The number of users of each membership type """
+    counts = dict(UserProfile.objects.values_list('membership_type').annotate(n=Count('pk')).order_by())
+    return {
+        "memberships": [name for key, name in MembershipType.CHOICES],
+        "counts": [counts.get(key, 0) for key, name in MembershipType.CHOICES]
+    }
+
+def user_type_counts(params):
+    """ The number of users of each type (customer, operator, manager) """
+    counts = dict(UserProfile.objects.values_list('user_type').annotate(n=Count('pk')).order_by())
+    return {
+        "user_types": [name for key, name in UserType.CHOICES],
+        "counts": [counts.get(key, 0) for key, name in UserType.CHOICES]
+    }
+
+def income_per_month(params):
+    """ Income from hires in each month, oldest first """
+    summary = cached_financial_summary()
+    return {
+        "months": [f"{calendar.month_abbr[month]} {year}" for year, month in summary.income_by_month],
+        "income": list(summary.income_by_month.values())
+    }
+
+def income_per_membership(params):
+    """ Income from hires by members of each membership type """
+    summary = cached_financial_summary()
+    return {
+        "memberships": [name for key, name in MembershipType.CHOICES],
+        "income": [summary.income_by_membership.get(key, 0) for key, name in MembershipType.CHOICES]
+    }
+
+def charge_histogram(params):
+    """ The number of hires costing between £n and £n+1, for each n with any hires """
+    summary = cached_financial_summary()
+    return {
+        "lower": [lower for lower, rides in summary.charge_histogram],
+        "rides": [rides for lower, rides in summary.charge_histogram],
+        "bin_width": 1
+    }
+
+def bike_statuses(params):
+    """ The number of bikes with each status """
+    counts = dict(Bikes.objects.values_list('status').annotate(n=Count('pk')).order_by())
+    return {
+        "statuses": [name for key, name in BikeStatus.CHOICES],
+        "counts": [counts.get(key, 0) for key, name in BikeStatus.CHOICES]
+    }
+
+# chart name (in the data URL) -> function returning its data
+CHARTS = {
+    'location-counts': location_counts,
+    'location-history': location_history,
+    'membership-counts': membership_counts,
+    'user-type-counts': user_type_counts,
+    'income-per-month': income_per_month,
+    'income-per-membership': income_per_membership,
+    'charge-histogram': charge_histogram,
+    'bike-statuses': bike_statuses,
+}
@@ -0,0 +1,34 @@
+from datetime import timedelta
+
+from django import forms
+
+from bikes.cost_calculator import Tariff
+
+# An alternative tariff for the tariff simulator. The initial values are the current tariff from settings.py
+class TariffForm(forms.Form):
+    standard = forms.FloatField(min_value=0, label="Standard (£)")
+    student = forms.FloatField(min_value=0, label="Student (£)")
+    pensioner = forms.FloatField(min_value=0, label="Pensioner (£)")
+    staff = forms.FloatField(min_value=0, label="Staff (£)")
+    standard_minutes = forms.IntegerField(min_value=0, label="Standard ride time (minutes)")
+    interval_minutes = forms.IntegerField(min_value=1, label="Charge interval (minutes)")
+    charge_per_interval = forms.FloatField(min_value=0, label="Charge per interval (£)")
+
+    @staticmethod
+    def initial_from_tariff(tariff):
+        return dict(
+            tariff.basic_charges,
+            standard_minutes=tariff.standard_charge_time_max // timedelta(minutes=1),
+            interval_minutes=tariff.time_exceeded_interval // timedelta(minutes=1),
+            charge_per_interval=tariff.charge_per_interval
+        )
+
+    def tariff(self):
+        """ Returns the Tariff entered in the (valid) form """
+        data = self.cleaned_data
+        return Tariff(
+            basic_charges={key: data[key] for key in ('standard', 'student', 'pensioner', 'staff')},
+            standard_charge_time_max=timedelta(minutes=data['standard_minutes']),
+            time_exceeded_interval=timedelta(minutes=data['interval_minutes']),
+            charge_per_interval=data['charge_per_interval']
+        )
@@ -0,0 +1,53 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from reports.models import LocationBikeCount, LocationBikeCountHourly, LocationBikeCountDaily
+
+ROLLUPS = (LocationBikeCountHourly, LocationBikeCountDaily)
+BATCH_SIZE = 2000
+
+class Command(BaseCommand):
+    help = "Rebuilds the hourly and daily station bike count rollups from the LocationBikeCount history"
+
+    # This method is executed when the management command is run.
+    def handle(self, *args, **kwargs):
+        # one streamed pass over the history, in station then time order, so each period's samples arrive together.
+        # Samples at the same time are taken in the order they were recorded, as BikeCountRollup.add_sample does
+        history = LocationBikeCount.objects.order_by('location_id', 'datetime', 'pk') \
+            .values_list('location_id', 'datetime', 'count').iterator(chunk_size=BATCH_SIZE)
+
+        with transaction.atomic():
+            for rollup in ROLLUPS:
+                rollup.objects.all().delete()
+
+            current = {rollup: None for rollup in ROLLUPS} # the period each rollup is currently summarising
+            batches = {rollup: [] for rollup in ROLLUPS}
+            for location_id, when, count in history:
+                for rollup in ROLLUPS:
+                    row = current[rollup]
+                    period = rollup.truncate(when)
+                    if row is None or row.location_id != location_id or row.period != period:
+                        row = current[rollup] = rollup(
+                            location_id=location_id, period=period, min_count=count, max_count=count,
+                            sum_count=0, num_samples=0
+                        )
+                        self._add(rollup, row, batches)
+                    row.min_count = min(row.min_count, count)
+                    row.max_count = max(row.max_count, count)
+                    row.sum_count += count
+                    row.num_samples += 1
+                    row.last_count, row.last_datetime = count, when
+
+            for rollup in ROLLUPS:
+                rollup.objects.bulk_create(batches[rollup])
+                self.stdout.write(f"{rollup.objects.count()} rows in {rollup.__name__}")
+
+    def _add(self, rollup, row, batches):
+        """ Queues a newly started rollup row, first writing out the batch if it is full.
+            Rows are still updated in place while queued, but starting a new row means every queued row is complete
+        """
+        batch = batches[rollup]
+        if len(batch) >= BATCH_SIZE:
+            rollup.objects.bulk_create(batch)
+            batch.clear()
+        batch.append(row)
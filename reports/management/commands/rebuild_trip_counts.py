@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count
+from django.db.models.functions import TruncDate
+
+from bikes.models import BikeHires
+from reports.models import StationTripCount
+
+BATCH_SIZE = 2000
+
+class Command(BaseCommand):
+    help = "Rebuilds the daily station-to-station trip counts from the BikeHires table"
+
+    # This method is executed when the management command is run.
+    def handle(self, *args, **kwargs):
+        # the counting is done by the database - only one row per station pair per day comes back
+        trips = BikeHires.objects.filter(start_station__isnull=False, end_station__isnull=False) \
+            .annotate(date=TruncDate('date_hired')) \
+            .values_list('start_station', 'end_station', 'date') \
+            .annotate(trips=Count('id')).order_by() \
+            .iterator(chunk_size=BATCH_SIZE)
+
+        with transaction.atomic():
+            StationTripCount.objects.all().delete()
+            batch = []
+            for start_station_id, end_station_id, date, count in trips:
+                batch.append(StationTripCount(
+                    start_station_id=start_station_id, end_station_id=end_station_id, date=date, trips=count
+                ))
+                if len(batch) >= BATCH_SIZE:
+                    StationTripCount.objects.bulk_create(batch)
+                    batch.clear()
+            StationTripCount.objects.bulk_create(batch)
+        self.stdout.write(f"{StationTripCount.objects.count()} rows in StationTripCount")
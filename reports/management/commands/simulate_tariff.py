@@ -0,0 +1,52 @@
+import calendar
+
+from django.core.management.base import BaseCommand, CommandError
+
+from bikes.choices import MembershipType
+from bikes.cost_calculator import Tariff
+from reports.forms import TariffForm
+from reports.utils import simulate_tariff, SIMULATION_CHUNK_SIZE
+
+class Command(BaseCommand):
+    help = "Re-prices every returned hire under an alternative tariff, and compares the revenue with what was " \
+           "actually charged, per membership type and per month. Any charge not given keeps its current setting."
+
+    def add_arguments(self, parser):
+        for key in ('standard', 'student', 'pensioner', 'staff'):
+            parser.add_argument(f'--{key}', type=float, help=f"Basic charge for {key} members")
+        parser.add_argument('--standard-minutes', type=int, help="Length of a standard ride, in minutes")
+        parser.add_argument('--interval-minutes', type=int, help="Length of each charge interval after that")
+        parser.add_argument('--charge-per-interval', type=float, help="Charge for each (part) interval")
+        parser.add_argument('--chunk-size', type=int, default=SIMULATION_CHUNK_SIZE, help="Hires priced at a time")
+
+    # This method is executed when the management command is run.
+    def handle(self, *args, **kwargs):
+        tariff = self._get_tariff(kwargs)
+        simulation = simulate_tariff(tariff, chunk_size=kwargs['chunk_size'])
+
+        self.stdout.write(f"{'Membership':<16}{'Rides':>10}{'Actual':>14}{'Simulated':>14}{'Change':>10}")
+        for membership, revenue in simulation.by_membership.items():
+            self._write_row(MembershipType.get_choice(membership) or "Unknown", revenue)
+        self._write_row("Total", simulation.total)
+
+        self.stdout.write("")
+        self.stdout.write(f"{'Month':<16}{'Rides':>10}{'Actual':>14}{'Simulated':>14}{'Change':>10}")
+        for (year, month), revenue in simulation.by_month.items():
+            self._write_row(f"{calendar.month_abbr[month]} {year}", revenue)
+
+    def _get_tariff(self, kwargs):
+        """ The current tariff, with any charges given on the command line replaced - checked as the simulator's
+            form checks them
+        """
+        data = TariffForm.initial_from_tariff(Tariff.current())
+        data.update((field, kwargs[field]) for field in TariffForm.base_fields if kwargs.get(field) is not None)
+        form = TariffForm(data)
+        if not form.is_valid():
+            raise CommandError("; ".join(
+                f"--{field.replace('_', '-')}: {' '.join(errors)}" for field, errors in form.errors.items()
+            ))
+        return form.tariff()
+
+    def _write_row(self, label, revenue):
+        change = f"{revenue.simulated / revenue.actual - 1:+.1%}" if revenue.actual else "-"
+        self.stdout.write(f"{label:<16}{revenue.hires:>10}{revenue.actual:>14.2f}{revenue.simulated:>14.2f}{change:>10}")
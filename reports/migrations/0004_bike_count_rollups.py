@@ -0,0 +1,53 @@
+# Generated by Django 2.2.4 on 2026-10-17 22:07
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bikes', '0016_location_bike_count'),
+        ('reports', '0003_merge_20191025_1024'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LocationBikeCountHourly',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('period', models.DateTimeField()),
+                ('min_count', models.IntegerField()),
+                ('max_count', models.IntegerField()),
+                ('sum_count', models.IntegerField()),
+                ('num_samples', models.IntegerField()),
+                ('last_count', models.IntegerField()),
+                ('last_datetime', models.DateTimeField()),
+                ('location', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='bikes.Location')),
+            ],
+            options={
+                'ordering': ('period',),
+                'abstract': False,
+                'unique_together': {('location', 'period')},
+            },
+        ),
+        migrations.CreateModel(
+            name='LocationBikeCountDaily',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('period', models.DateTimeField()),
+                ('min_count', models.IntegerField()),
+                ('max_count', models.IntegerField()),
+                ('sum_count', models.IntegerField()),
+                ('num_samples', models.IntegerField()),
+                ('last_count', models.IntegerField()),
+                ('last_datetime', models.DateTimeField()),
+                ('location', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='bikes.Location')),
+            ],
+            options={
+                'ordering': ('period',),
+                'abstract': False,
+                'unique_together': {('location', 'period')},
+            },
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 2.2.4 on 2026-10-17 22:20
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bikes', '0016_location_bike_count'),
+        ('reports', '0004_bike_count_rollups'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StationTripCount',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('trips', models.IntegerField(default=0)),
+                ('end_station', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='trips_to', to='bikes.Location')),
+                ('start_station', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='trips_from', to='bikes.Location')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='stationtripcount',
+            index=models.Index(fields=['date'], name='reports_sta_date_075fd6_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='stationtripcount',
+            unique_together={('start_station', 'date', 'end_station')},
+        ),
+    ]
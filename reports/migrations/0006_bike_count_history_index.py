@@ -0,0 +1,17 @@
+# Generated by Django 2.2.4 on 2026-10-17 22:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('reports', '0005_station_trip_counts'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='locationbikecount',
+            index=models.Index(fields=['location', 'datetime'], name='reports_loc_locatio_e61d89_idx'),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 2.2.4 on 2026-10-17 23:42
+
+import time
+
+from django.db import migrations, models
+from django.utils import timezone
+
+
+def create_version(apps, schema_editor):
+    """ Creates the single version row, starting from the clock as reports.cache.data_version does """
+    ReportDataVersion = apps.get_model('reports', 'ReportDataVersion')
+    ReportDataVersion.objects.create(pk=1, version=int(time.time() * 1000), modified=timezone.now())
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('reports', '0006_bike_count_history_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReportDataVersion',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('version', models.BigIntegerField()),
+                ('modified', models.DateTimeField()),
+            ],
+        ),
+        migrations.RunPython(create_version, migrations.RunPython.noop),
+    ]
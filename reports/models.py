@@ -1,12 +1,126 @@
-from django.db import models
+from django.db import models, IntegrityError, transaction
+from django.db.models import F, Case, When, Value
+from django.db.models.functions import Least, Greatest
 
 from bikes.models import Location
 
 # Create your models here.
 class LocationBikeCount(models.Model):
+    """ Append-only history of the number of bikes at each station.
+        New rows should be added with `append`, which also keeps the hourly and daily rollups up to date
+    """
     location = models.ForeignKey(Location, on_delete=models.CASCADE)
     count = models.IntegerField()
     datetime = models.DateTimeField()
 
     class Meta:
-        ordering = ('datetime',)
\ No newline at end of file
+        ordering = ('datetime',)
+        indexes = [models.Index(fields=['location', 'datetime'])] # a station's history over a date range
+
+    @classmethod
+    def append(cls, location_id, when, count):
+        """ Records a station's bike count at `when`, and adds it to the station's rollups """
+        obj = cls.objects.create(location_id=location_id, datetime=when, count=count)
+        for rollup in (LocationBikeCountHourly, LocationBikeCountDaily):
+            rollup.add_sample(location_id, when, count)
+        return obj
+
+class BikeCountRollup(models.Model):
+    """ Summary of a station's LocationBikeCount history over one period (an hour or a day).
+        Subclasses set PERIOD, and `period` holds the start of the period
+    """
+    PERIOD = None
+
+    location = models.ForeignKey(Location, on_delete=models.CASCADE)
+    period = models.DateTimeField()
+    min_count = models.IntegerField()
+    max_count = models.IntegerField()
+    sum_count = models.IntegerField()   # with num_samples, gives the mean
+    num_samples = models.IntegerField()
+    last_count = models.IntegerField()
+    last_datetime = models.DateTimeField() # time of the sample last_count came from
+
+    class Meta:
+        abstract = True
+        ordering = ('period',)
+        unique_together = ('location', 'period')
+
+    @property
+    def mean_count(self):
+        return self.sum_count / self.num_samples
+
+    @classmethod
+    def truncate(cls, when):
+        """ Returns the start of the period containing `when` """
+        if cls.PERIOD == 'hour':
+            return when.replace(minute=0, second=0, microsecond=0)
+        return when.replace(hour=0, minute=0, second=0, microsecond=0)
+
+    @classmethod
+    def add_sample(cls, location_id, when, count):
+        """ Folds one bike count sample into its period's row, with a single atomic UPDATE where the row exists """
+        period = cls.truncate(when)
+        totals = dict(
+            min_count=Least(F('min_count'), Value(count, output_field=models.IntegerField())),
+            max_count=Greatest(F('max_count'), Value(count, output_field=models.IntegerField())),
+            sum_count=F('sum_count') + count,
+            num_samples=F('num_samples') + 1,
+            # samples can arrive out of order, so only a later sample replaces last_count - or one at the same time,
+            # recorded after it (with a higher pk), as rebuild_bike_count_rollups orders them
+            last_count=Case(
+                When(last_datetime__lte=when, then=Value(count)), default=F('last_count'), output_field=models.IntegerField()
+            ),
+            last_datetime=Greatest(F('last_datetime'), Value(when, output_field=models.DateTimeField())),
+        )
+        rows = cls.objects.filter(location_id=location_id, period=period)
+        if rows.update(**totals):
+            return
+        try:
+            with transaction.atomic():
+                cls.objects.create(
+                    location_id=location_id, period=period, min_count=count, max_count=count, sum_count=count,
+                    num_samples=1, last_count=count, last_datetime=when
+                )
+        except IntegrityError:
+            # another request created the period's row first
+            rows.update(**totals)
+
+class LocationBikeCountHourly(BikeCountRollup):
+    PERIOD = 'hour'
+
+class LocationBikeCountDaily(BikeCountRollup):
+    PERIOD = 'day'
+
+class StationTripCount(models.Model):
+    """ Origin-destination matrix: the number of trips hired on each day from one station and returned to another.
+        Kept up to date by `add_trip` when a bike is returned, and rebuilt from BikeHires by the
+        rebuild_trip_counts command. Trips between any stations over any date range are a sum over a range of rows
+    """
+    start_station = models.ForeignKey(Location, on_delete=models.CASCADE, related_name='trips_from')
+    end_station = models.ForeignKey(Location, on_delete=models.CASCADE, related_name='trips_to')
+    date = models.DateField() # the day the bike was hired
+    trips = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ('start_station', 'date', 'end_station') # also the index for one origin's trips
+        indexes = [models.Index(fields=['date'])] # for the whole network's trips over a date range
+
+    @classmethod
+    def add_trip(cls, start_station_id, end_station_id, date):
+        """ Counts one trip, with a single UPDATE where the day's row for the pair of stations exists """
+        rows = cls.objects.filter(start_station_id=start_station_id, end_station_id=end_station_id, date=date)
+        if rows.update(trips=F('trips') + 1):
+            return
+        try:
+            with transaction.atomic():
+                cls.objects.create(start_station_id=start_station_id, end_station_id=end_station_id, date=date, trips=1)
+        except IntegrityError:
+            # another return created the row first
+            rows.update(trips=F('trips') + 1)
+
+class ReportDataVersion(models.Model):
+    """ The report data version and when it last changed (see reports/cache.py): a single row, kept in the database
+        so that every process sees a write made by any of them
+    """
+    version = models.BigIntegerField()
+    modified = models.DateTimeField()
@@ -1,3 +1,250 @@
+from datetime import date, datetime, timedelta
+from io import StringIO
+
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.core.management import call_command, CommandError
+from django.db.models import F
+from django.http import QueryDict
 from django.test import TestCase
+from django.urls import reverse
+import pytz
+
+from bikes.choices import BikeStatus, MembershipType, UserType
+from bikes.cost_calculator import Tariff
+from bikes.models import Bikes, BikeHires, Location
+from bikes.testing import QueryBudgetTestCase
+from . import cache
+from .charts import CHARTS
+from .models import LocationBikeCount, LocationBikeCountDaily, LocationBikeCountHourly, ReportDataVersion
+from .utils import bike_count_series, financial_summary, lttb, simulate_tariff, trip_counts
+
+class HireHistoryTestCase(TestCase):
+    """ Four returned hires, over December 2019 and January 2020 """
+
+    def setUp(self):
+        self.station = station = Location.objects.create(
+            station_name="Trongate", latitude=55.855789, longitude=-4.246063
+        )
+        bike = Bikes.objects.create(status=BikeStatus.AVAILABLE, location=station)
+        student = User.objects.create_user(username="student", password="password").userprofile
+        student.membership_type = MembershipType.STUDENT
+        student.save()
+        standard = User.objects.create_user(username="standard", password="password").userprofile
+
+        # (user, month hired, minutes, charges under the default tariff)
+        rides = [(standard, 12, 10, 2), (standard, 12, 45, 3), (student, 1, 95, 4), (student, 1, 20, 1)]
+        for user, month, minutes, charges in rides:
+            hired = datetime(2019 if month == 12 else 2020, month, 5, 9, tzinfo=pytz.UTC)
+            BikeHires.objects.create(
+                bike=bike, user=user, start_station=station, end_station=station, date_hired=hired,
+                date_returned=hired + timedelta(minutes=minutes), charges=charges
+            )
+
+class TariffSimulatorTests(HireHistoryTestCase):
+
+    def test_current_tariff_matches_actual(self):
+        simulation = simulate_tariff(Tariff.current(), chunk_size=3)
+        self.assertEqual(simulation.total, (4, 10, 10))
+        self.assertEqual(simulation.by_membership[MembershipType.STANDARD], (2, 5, 5))
+        # months of different years are kept apart, in date order
+        self.assertEqual(list(simulation.by_month), [(2019, 12), (2020, 1)])
+
+    def test_alternative_tariff(self):
+        tariff = Tariff.current()._replace(charge_per_interval=2)
+        simulation = simulate_tariff(tariff, chunk_size=1)
+        self.assertEqual(simulation.by_month[(2020, 1)], (2, 5, 8))
+        self.assertEqual(simulation.total.simulated, 14)
+
+    def test_command_checks_tariff(self):
+        out = StringIO()
+        call_command('simulate_tariff', charge_per_interval=2, stdout=out)
+        self.assertRegex(out.getvalue(), r'Total +4 +10\.00 +14\.00 +\+40\.0%')
+        for option in ({"interval_minutes": 0}, {"standard": -5}):
+            with self.subTest(**option), self.assertRaises(CommandError):
+                call_command('simulate_tariff', stdout=StringIO(), **option)
+
+class FinancialSummaryTests(HireHistoryTestCase):
+
+    def test_summary(self):
+        with self.assertNumQueries(7):
+            summary = financial_summary()
+        self.assertEqual((summary.hires, summary.total_income, summary.maximum_charges), (4, 10, 4))
+        self.assertEqual(summary.income_by_month, {(2019, 12): 5, (2020, 1): 5})
+        self.assertEqual(summary.income_by_membership, {MembershipType.STANDARD: 5, MembershipType.STUDENT: 5})
+        self.assertEqual(summary.charge_histogram, [(1, 1), (2, 1), (3, 1), (4, 1)])
+        self.assertEqual(summary.discount_pct, 0)
+
+    def test_empty(self):
+        BikeHires.objects.all().delete()
+        summary = financial_summary()
+        self.assertEqual((summary.hires, summary.total_income, summary.charge_histogram), (0, 0, []))
+
+class ReportCacheTests(TestCase):
+
+    def setUp(self):
+        caches['default'].clear()
+        caches['reports'].clear()
+        self.builds = 0
+
+    def build(self):
+        self.builds += 1
+        return {"builds": self.builds}
+
+    def test_cached_per_parameters(self):
+        cache.cached_report('report', QueryDict('a=1&b=2'), self.build)
+        cache.cached_report('report', QueryDict('b=2&a=1'), self.build)
+        self.assertEqual(self.builds, 1)
+        cache.cached_report('report', QueryDict('a=2'), self.build)
+        self.assertEqual(self.builds, 2)
+
+    def test_stale_after_write_commits(self):
+        cache.cached_report('report', QueryDict(), self.build)
+        # TestCase never commits, so the on_commit bump is left pending...
+        cache.bump_data_version()
+        self.assertEqual(cache.cached_report('report', QueryDict(), self.build), {"builds": 1})
+        # ...until it runs, as it would on commit
+        cache._bump()
+        self.assertEqual(cache.cached_report('report', QueryDict(), self.build), {"builds": 2})
+
+    def test_stale_after_write_in_another_process(self):
+        cache.cached_report('report', QueryDict(), self.build)
+        # another process's bump, which this process's caches know nothing of
+        ReportDataVersion.objects.update(version=F('version') + 1)
+        self.assertEqual(cache.cached_report('report', QueryDict(), self.build), {"builds": 2})
+
+class ChartDataTests(HireHistoryTestCase):
+
+    def setUp(self):
+        super().setUp()
+        caches['default'].clear()
+        caches['reports'].clear()
+        self.manager = User.objects.create_user(username="manager", password="password")
+        self.manager.userprofile.user_type = UserType.MANAGER
+        self.manager.userprofile.save()
+        self.url = reverse('reports:chart_data', args=['income-per-month'])
+
+    def test_json_and_revalidation(self):
+        self.client.force_login(self.manager)
+        response = self.client.get(self.url)
+        self.assertEqual(response.json(), {"months": ["Dec 2019", "Jan 2020"], "income": [5.0, 5.0]})
+
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+        cache._bump()
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 200)
+
+    def test_managers_only(self):
+        self.client.force_login(User.objects.get(username="student"))
+        self.assertEqual(self.client.get(self.url).status_code, 403)
+        # nor the pages drawn from the charts
+        self.assertRedirects(self.client.get(reverse('reports:bike_status')), reverse('bikes:index'))
+        self.client.force_login(self.manager)
+        self.assertEqual(self.client.get(reverse('reports:chart_data', args=['unknown'])).status_code, 404)
+
+    def test_date_parameters_checked(self):
+        self.client.force_login(self.manager)
+        payload = '";alert(1)//'
+        for page in ('bike_locations', 'path_routes'):
+            with self.subTest(page=page):
+                for params in ({"date_from": payload}, {"date_from": payload, "date_to": "01-02-2020"}):
+                    response = self.client.get(reverse(f'reports:{page}'), params)
+                    self.assertEqual(response.status_code, 200)
+                    self.assertIsNone(response.context['date_from'])
+                    self.assertNotIn(payload, response.content.decode())
+                response = self.client.get(reverse(f'reports:{page}'), {"date_from": "01-12-2019", "date_to": "01-02-2020"})
+                self.assertEqual(response.context['date_from'], "01-12-2019")
+
+class TripCountTests(HireHistoryTestCase):
+
+    def test_rebuild_and_date_range(self):
+        call_command('rebuild_trip_counts', stdout=StringIO())
+        pair = (self.station.pk, self.station.pk)
+        self.assertEqual(trip_counts(), {pair: 4})
+        self.assertEqual(trip_counts(self.station, date(2019, 12, 1), date(2020, 1, 1)), {pair: 2})
+        self.assertEqual(trip_counts(date_from=date(2020, 2, 1)), {})
+
+class BikeCountHistoryTests(TestCase):
+    """ The station bike count rollups, and the downsampled series drawn from them """
+
+    def setUp(self):
+        self.station = Location.objects.create(station_name="Trongate", latitude=55.855789, longitude=-4.246063)
+        self.start = datetime(2020, 1, 1, tzinfo=pytz.UTC)
+
+    def rollups(self):
+        fields = ('period', 'min_count', 'max_count', 'sum_count', 'num_samples', 'last_count', 'last_datetime')
+        return [list(rollup.objects.values_list(*fields)) for rollup in (LocationBikeCountHourly, LocationBikeCountDaily)]
+
+    def test_incremental_rollups_match_rebuild(self):
+        samples = [(minutes, minutes % 7) for minutes in range(0, 3000, 13)]
+        samples += [(659, 9), (659, 2), (1500, 5)] # samples at the same time as another, and out of order
+        for minutes, count in samples:
+            LocationBikeCount.append(self.station.pk, self.start + timedelta(minutes=minutes), count)
+        incremental = self.rollups()
+
+        call_command('rebuild_bike_count_rollups', stdout=StringIO())
+        self.assertEqual(self.rollups(), incremental)
+        hour = LocationBikeCountHourly.objects.get(period=self.start + timedelta(hours=10))
+        self.assertEqual(hour.last_count, 2) # the last recorded of the samples at 10:59
+
+    def test_lttb(self):
+        x = list(range(1000))
+        y = [(i * 37) % 101 for i in x]
+        for threshold in (3, 50, 999):
+            keep = lttb(x, y, threshold)
+            self.assertLessEqual(len(keep), threshold)
+            self.assertEqual((keep[0], keep[-1]), (0, 999))
+            self.assertEqual(list(keep), sorted(set(keep)))
+        self.assertEqual(list(lttb(x[:10], y[:10], 50)), list(range(10))) # already within the budget
+
+    def test_series_resolution(self):
+        for hours in range(0, 24 * 100, 5):
+            LocationBikeCount.append(self.station.pk, self.start + timedelta(hours=hours), hours % 11)
+        for days, resolution in ((3, 'raw'), (4, 'hour'), (60, 'hour'), (61, 'day')):
+            with self.subTest(days=days):
+                series = bike_count_series(self.station, self.start, self.start + timedelta(days=days), max_points=100)
+                self.assertEqual(series['resolution'], resolution)
+                self.assertLessEqual(len(series['datetime']), 100)
+        series = bike_count_series(self.station, max_points=100) # the whole history
+        self.assertEqual(series['resolution'], 'day')
+        self.assertEqual(series['datetime'][0], self.start)
+
+class ReportQueryBudgetTests(QueryBudgetTestCase):
+    """ The number of queries each view in reports.views makes to build its report from an empty report cache """
+
+    def setUp(self):
+        super().setUp()
+        self.client.force_login(self.manager)
+
+    def test_pages(self):
+        budgets = {
+            'reports_index': 2, 'bike_locations': 5, 'user-report': 6, 'financial-report': 11, 'tariff-simulator': 2,
+            'path_routes': 6, 'path_routes_graph': 6, 'bike_status': 4,
+        }
+        for page, queries in budgets.items():
+            with self.subTest(page=page):
+                self.clear_caches()
+                # the financial summary is cached on its own, so building it reads the data version again
+                duplicates = 1 if page == 'financial-report' else 0
+                self.assertQueryBudget(self.client.get(reverse(f'reports:{page}')), queries, duplicates)
+
+    def test_chart_data(self):
+        budgets = {
+            'location-counts': 4, 'location-history': 6, 'membership-counts': 4, 'user-type-counts': 4,
+            'income-per-month': 11, 'income-per-membership': 11, 'charge-histogram': 11, 'bike-statuses': 4,
+        }
+        self.assertEqual(set(budgets), set(CHARTS))
+        for chart, queries in budgets.items():
+            with self.subTest(chart=chart):
+                self.clear_caches()
+                duplicates = 1 if chart.startswith(('income', 'charge')) else 0 # as the financial report
+                self.assertQueryBudget(self.client.get(reverse('reports:chart_data', args=[chart])), queries, duplicates)
 
-# Create your tests here.
+    def test_simulated_tariff(self):
+        response = self.client.get(reverse('reports:tariff-simulator'), {
+            "standard": 2, "student": 1, "pensioner": 1, "staff": 0, "standard_minutes": 30, "interval_minutes": 30,
+            "charge_per_interval": 1
+        })
+        # the hire history is read in chunks, by the same statement
+        self.assertQueryBudget(response, 4, duplicates=1)
@@ -6,9 +6,12 @@ app_name = 'reports'
 
 urlpatterns = [
     path('', views.reports_index, name='reports_index'),
+    path('data/<slug:chart>.json', views.chart_data, name='chart_data'),
     path('bike-locations/', views.bike_locations, name='bike_locations'),
     path('user-report/', views.user_report, name='user-report'), 
     path('financial-report/', views.financial_report, name='financial-report'),
+    path('tariff-simulator/', views.tariff_simulator, name='tariff-simulator'),
     path('path-routes/', views.path_routes, name='path_routes'),
+    path('path-routes/graph.png', views.path_routes_graph, name='path_routes_graph'),
     path('bike-status/', views.bike_status, name='bike_status')
 ]
\ No newline at end of file
@@ -0,0 +1,217 @@
+from collections import namedtuple
+from datetime import timedelta
+
+from django.db.models import Min, Max, Sum, Avg, Count, Q
+from django.db.models.functions import ExtractYear, ExtractMonth, Floor
+
+from bikes.cost_calculator import calculate_costs
+from bikes.models import BikeHires, BikeRepairs, UserDiscounts, UserProfile
+from .models import LocationBikeCount, LocationBikeCountHourly, LocationBikeCountDaily, StationTripCount
+
+# The most points sent to the browser for a station's bike count time series
+TIME_SERIES_POINTS = 500
+
+# Date ranges up to RAW_MAX_SPAN are drawn from the raw history, up to HOURLY_MAX_SPAN from the hourly rollups,
+# and anything longer from the daily rollups
+RAW_MAX_SPAN = timedelta(days=3)
+HOURLY_MAX_SPAN = timedelta(days=60)
+
+# Number of hires read and priced at a time by simulate_tariff
+SIMULATION_CHUNK_SIZE = 20000
+
+def lttb(x, y, threshold):
+    """ Largest-Triangle-Three-Buckets downsampling.
+        Returns the indices of at most `threshold` points of the line (x, y) that best preserve its shape.
+        The first and last points are always kept.
+    """
+    import numpy as np
+
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+
+    # split the points between the first and last into threshold - 2 buckets, and keep one point per bucket
+    edges = np.linspace(1, n - 1, threshold - 1).astype(int)
+    indices = np.empty(threshold, dtype=int)
+    indices[0], indices[-1] = 0, n - 1
+    a = 0 # the previously selected point
+    for i in range(threshold - 2):
+        start, end = edges[i], edges[i + 1]
+        following = slice(edges[i + 1], edges[i + 2]) if i + 2 < len(edges) else slice(n - 1, n)
+        avg_x, avg_y = x[following].mean(), y[following].mean()
+
+        # keep the point forming the largest triangle with the previous point and the next bucket's average
+        area = np.abs((x[a] - avg_x) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (avg_y - y[a]))
+        a = start + int(area.argmax())
+        indices[i + 1] = a
+    return indices
+
+def bike_count_series(location, date_from=None, date_to=None, max_points=TIME_SERIES_POINTS):
+    """ Returns a station's bike count history between two (optional) datetimes, as a dict of lists:
+        datetime, count, and the min/max count over each point's period.
+        The resolution ('raw', 'hour' or 'day') is chosen from the length of the date range, and the series
+        is downsampled to at most `max_points` points, so its size doesn't grow with the history.
+    """
+    if date_from is None or date_to is None:
+        bounds = LocationBikeCountDaily.objects.filter(location=location) \
+            .aggregate(first=Min('period'), last=Max('last_datetime'))
+        if bounds['first'] is None:
+            # the rollups haven't been built - fall back to the raw history
+            bounds = LocationBikeCount.objects.filter(location=location) \
+                .aggregate(first=Min('datetime'), last=Max('datetime'))
+        date_from = date_from or bounds['first']
+        date_to = date_to or bounds['last']
+
+    series = {"resolution": "raw", "datetime": [], "count": [], "min": [], "max": []}
+    if date_from is None or date_to is None:
+        return series # no history for this station
+
+    span = date_to - date_from
+    if span <= RAW_MAX_SPAN:
+        rows = LocationBikeCount.objects.filter(location=location, datetime__gte=date_from, datetime__lte=date_to) \
+            .values_list('datetime', 'count', 'count', 'count')
+    else:
+        rollup = LocationBikeCountHourly if span <= HOURLY_MAX_SPAN else LocationBikeCountDaily
+        series["resolution"] = rollup.PERIOD
+        rows = rollup.objects.filter(location=location, period__gte=rollup.truncate(date_from), period__lte=date_to) \
+            .values_list('period', 'last_count', 'min_count', 'max_count')
+
+    rows = list(rows)
+    if not rows:
+        return series
+    dates, counts, lows, highs = zip(*rows)
+    keep = lttb([d.timestamp() for d in dates], counts, max_points)
+    series.update(
+        datetime=[dates[i] for i in keep],
+        count=[counts[i] for i in keep],
+        min=[lows[i] for i in keep],
+        max=[highs[i] for i in keep],
+    )
+    return series
+
+def trip_counts(start_station=None, date_from=None, date_to=None):
+    """ Returns {(start station pk, end station pk): number of trips} for bikes hired from `start_station`
+        (or any station) between two (optional) dates - date_to is exclusive - summed in the database from the
+        StationTripCount table
+    """
+    rows = StationTripCount.objects.all()
+    if start_station is not None:
+        rows = rows.filter(start_station=start_station)
+    if date_from is not None:
+        rows = rows.filter(date__gte=date_from)
+    if date_to is not None:
+        rows = rows.filter(date__lt=date_to)
+    rows = rows.values_list('start_station', 'end_station').annotate(total=Sum('trips')).order_by()
+    return {(start, end): total for start, end, total in rows}
+
+# Revenue from a group of hires: actual is what was charged, simulated is the re-priced total
+Revenue = namedtuple('Revenue', 'hires actual simulated')
+
+# The result of simulate_tariff. by_membership is keyed on membership type, and by_month on (year, month) of hire
+TariffSimulation = namedtuple('TariffSimulation', 'total by_membership by_month')
+
+def simulate_tariff(tariff, hires=None, chunk_size=SIMULATION_CHUNK_SIZE):
+    """ Re-prices every returned hire (or those in the `hires` queryset) under an alternative Tariff,
+        and totals the result against the charges actually made, per membership type and per month.
+        Hires are read `chunk_size` at a time in primary key order and priced with calculate_costs,
+        so memory use doesn't grow with the number of hires.
+    """
+    import numpy as np
+
+    hires = (BikeHires.objects.all() if hires is None else hires).filter(date_returned__isnull=False)
+    rows = hires.order_by('pk').values_list(
+        'pk', 'date_hired', 'date_returned', 'user__membership_type',
+        'discount_applied__discount_amount', 'discount_applied__date_to', 'charges'
+    )
+
+    by_membership, by_month = {}, {}
+    last_pk = 0
+    while True:
+        chunk = list(rows.filter(pk__gt=last_pk)[:chunk_size])
+        if not chunk:
+            break
+        last_pk = chunk[-1][0]
+
+        durations, memberships, discounts, months, actual = [], [], [], [], []
+        for pk, hired, returned, membership, amount, valid_to, charges in chunk:
+            durations.append(returned - hired)
+            memberships.append(membership or 0)
+            # a discount only counted if it was still valid on the day the bike was returned
+            discounts.append(amount if amount is not None and returned.date() <= valid_to else np.nan)
+            months.append(hired.year * 12 + hired.month - 1)
+            actual.append(charges or 0)
+        simulated, _ = calculate_costs(durations, memberships, discounts, tariff)
+        simulated = np.nan_to_num(simulated) # hires by users with no membership type can't be priced
+        actual = np.array(actual, dtype=float)
+
+        for totals, keys in ((by_membership, np.array(memberships)), (by_month, np.array(months))):
+            groups, inverse = np.unique(keys, return_inverse=True)
+            counts = np.bincount(inverse)
+            actual_sums = np.bincount(inverse, weights=actual)
+            simulated_sums = np.bincount(inverse, weights=simulated)
+            for i, key in enumerate(groups.tolist()):
+                previous = totals.get(key, Revenue(0, 0., 0.))
+                totals[key] = Revenue(
+                    previous.hires + int(counts[i]),
+                    previous.actual + float(actual_sums[i]),
+                    previous.simulated + float(simulated_sums[i])
+                )
+
+    total = Revenue(
+        sum(r.hires for r in by_membership.values()),
+        sum(r.actual for r in by_membership.values()),
+        sum(r.simulated for r in by_membership.values())
+    )
+    by_month = {(key // 12, key % 12 + 1): revenue for key, revenue in sorted(by_month.items())}
+    return TariffSimulation(total, dict(sorted(by_membership.items())), by_month)
+
+# The figures shown on the financial report. income_by_month is keyed on (year, month) of hire, in date order,
+# income_by_membership on membership type, and charge_histogram holds (lower bound in £, number of rides)
+# pairs for £1 wide bins
+FinancialSummary = namedtuple('FinancialSummary', [
+    'hires', 'total_income', 'avg_per_ride', 'maximum_charges', 'discount_pct',
+    'income_by_month', 'income_by_membership', 'charge_histogram',
+    'users_in_debt', 'uncollected_charges', 'discount_savings', 'total_repairs', 'repair_cost'
+])
+
+def financial_summary():
+    """ Computes the financial report with a few aggregate queries - the hire totals in one query,
+        and the month, membership and histogram groupings each in one GROUP BY - so no hires are loaded
+    """
+    hires = BikeHires.objects.order_by()
+    charged = hires.filter(charges__isnull=False)
+
+    totals = hires.aggregate(
+        hires=Count('id'), income=Sum('charges'), avg=Avg('charges'), max=Max('charges'),
+        discounted=Count('discount_applied')
+    )
+    income_by_month = charged \
+        .annotate(year=ExtractYear('date_hired'), month=ExtractMonth('date_hired')) \
+        .values_list('year', 'month').annotate(income=Sum('charges')).order_by('year', 'month')
+    income_by_membership = charged.values_list('user__membership_type') \
+        .annotate(income=Sum('charges')).order_by('user__membership_type')
+    charge_histogram = charged.annotate(bin=Floor('charges')).values_list('bin') \
+        .annotate(rides=Count('id')).order_by('bin')
+
+    debts = UserProfile.objects.aggregate(
+        users=Count('pk', filter=Q(charges__gt=0)), charges=Sum('charges', filter=Q(charges__gt=0))
+    )
+    repairs = BikeRepairs.objects.aggregate(count=Count('pk'), cost=Sum('repair_cost'))
+
+    return FinancialSummary(
+        hires=totals['hires'],
+        total_income=totals['income'] or 0,
+        avg_per_ride=totals['avg'] or 0,
+        maximum_charges=totals['max'] or 0,
+        discount_pct=totals['discounted'] / totals['hires'] * 100 if totals['hires'] else 0,
+        income_by_month={(year, month): income for year, month, income in income_by_month},
+        income_by_membership=dict(income_by_membership),
+        charge_histogram=[(int(lower), rides) for lower, rides in charge_histogram],
+        users_in_debt=debts['users'],
+        uncollected_charges=debts['charges'] or 0,
+        discount_savings=UserDiscounts.objects.aggregate(saved=Sum('amount_saved'))['saved'] or 0,
+        total_repairs=repairs['count'],
+        repair_cost=repairs['cost'] or 0
+    )
@@ -1,406 +1,291 @@
+from hashlib import md5
+import io
 import math
-import os
 import calendar
 from datetime import datetime
-from itertools import groupby
 
-from django.conf import settings
-from django.contrib.auth.decorators import login_required
 from django.contrib.auth.models import User
-from django.db.models import Count, Q, Sum, Avg, Max
-from django.http import HttpResponse
-from django.shortcuts import render, redirect
+from django.db.models import Count, Q
+from django.http import HttpResponse, Http404, JsonResponse
+from django.shortcuts import render
 from django.urls import reverse
-
-from bokeh.plotting import figure
-from bokeh.embed import components
-from bokeh.models import HoverTool, LassoSelectTool, WheelZoomTool, PointDrawTool, ColumnDataSource
-from bokeh.palettes import *
-import numpy as np
-import matplotlib
-matplotlib.use('Agg')
-from matplotlib import pyplot as plt
-import networkx as nx
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date, quote_etag, urlencode
 
 from bikes.choices import UserType, MembershipType, BikeStatus
-from bikes.models import Bikes, Location, BikeHires, UserProfile, UserDiscounts, BikeRepairs
-from bikes.utils import ride_distance, parse_dates
-from reports.models import LocationBikeCount
-
+from bikes.models import Bikes, Location, BikeHires, UserProfile
+from bikes.cost_calculator import Tariff
+from bikes.roles import role_required
+from bikes.utils import ride_distances, parse_dates
+from reports.cache import cached_report, data_version, report_key
+from reports.charts import CHARTS, cached_financial_summary, report_dates, report_location
+from reports.forms import TariffForm
+from reports.utils import simulate_tariff, trip_counts
 
-def is_manager(user):
-    """ This function is the 'test' for which a user must pass to view the reports pages.
-        The user must be of type UserType.MANAGER in order to view any of these pages. """
+# The plotting libraries (bokeh, matplotlib and networkx) are imported inside the functions that draw the reports,
+# rather than here, so they are only loaded by a worker once it serves a report - see the benchmark_startup command.
+# Most charts are drawn in the browser, from the JSON served by chart_data
 
-    return user.userprofile.user_type == UserType.MANAGER
 
-@login_required
+@role_required(UserType.MANAGER)
 def reports_index(request):
-    if not is_manager(request.user):
-        return redirect(reverse('bikes:index'))
     return render(request, 'reports/index.html', {})
 
-@login_required
+@role_required(UserType.MANAGER, forbidden=True)
+def chart_data(request, chart):
+    """ Serves the data for one report chart (see reports/charts.py) as JSON.
+        The ETag and Last-Modified come from the report data version, so a browser revalidating a chart
+        gets a 304 without the data being read (only the version), until a hire, return, move or repair changes it
+    """
+    if chart not in CHARTS:
+        raise Http404(f"No chart named {chart}")
+
+    name = f"chart-{chart}"
+    version, last_modified = data_version()
+    etag = quote_etag(md5(report_key(name, request.GET, version).encode()).hexdigest())
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is None:
+        response = JsonResponse(cached_report(name, request.GET, lambda: CHARTS[chart](request.GET), version))
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(last_modified)
+    patch_cache_control(response, private=True, no_cache=True) # always revalidate - it's cheap
+    return response
+
+@role_required(UserType.MANAGER)
 def bike_locations(request):
-    if not is_manager(request.user):
-        return redirect(reverse('bikes:index'))
+    context = cached_report('bike-locations', request.GET, lambda: _bike_locations_context(request.GET))
+    return render(request, 'reports/bike-locations.html', context)
 
-    loc = request.GET.get('loc', None)
-    if loc is None:
-        location_name = Location.objects.first().station_name
-    else:
-        location_name = Location.objects.get(station_name__iexact=loc).station_name
-    loc = Location.objects.get(station_name__iexact=location_name)
-
-    locations = Location.objects.annotate(bike_count=Count('bikes'))
-    stations = [location.station_name for location in locations]
-    bike_counts = [location.bike_count for location in locations]
-    plot = figure(x_range=stations, plot_height=400,  title="Bikes per location", toolbar_location="below")
-    source = ColumnDataSource(data=dict(stations=stations, bike_counts=bike_counts, color=Spectral6))
-    plot.add_tools(LassoSelectTool())
-    plot.add_tools(WheelZoomTool())
-    plot.add_tools(HoverTool())
-
-    plot.vbar(x='stations', top='bike_counts', width=.8, color='color', source=source)
-
-    plot.xgrid.grid_line_color = "black"
-    plot.xaxis.major_label_orientation = math.pi/6
-    plot.min_border_left = 80
-    plot.min_border_right = 80
-    plot.y_range.start = 0
-    plot.y_range.end   = max(bike_counts) + 2
-
-    script, div = components(plot)
-
-    # Time series graph
-    hire_history = LocationBikeCount.objects.filter(location=loc).values()
-    dates = [hire['datetime'] for hire in hire_history]
-    count = [hire['count'] for hire in hire_history]
-    time_source = ColumnDataSource(
-        data=dict(datetime=dates, count=count)
-    )
-    time_plot = figure(x_axis_type='datetime', plot_height=400)
-    time_plot.step('datetime', 'count', line_width=2, source=time_source)
-    hover = HoverTool()
-    hover.tooltips = [
-        ("Date", "@datetime"), 
-        ("Count", "@count")
-    ]
-    time_plot.add_tools(hover)
-    time_script, time_div = components(time_plot)
+def _bike_locations_context(params):
+    location_name = report_location(params).station_name
+    locations = Location.objects.all()
+
+    # the time series is drawn from the location-history chart data, for the same station and dates
+    date_from, date_to = report_dates(params)
+    history_params = {"loc": location_name}
+    if date_from and date_to:
+        history_params.update(date_from=date_from, date_to=date_to)
 
     context = {
-        "script": script, 
-        "div": div, "location_name": 
-        location_name, 
+        "location_name": location_name,
         "locations": locations,
-        "time_series_script": time_script,
-        "time_series_div": time_div
+        "history_url": f"{reverse('reports:chart_data', args=['location-history'])}?{urlencode(history_params)}",
+        "date_from": date_from,
+        "date_to": date_to
     }
-    return render(request, 'reports/bike-locations.html', context)
 
+    return context
 
 # User Activity report
-@login_required
+@role_required(UserType.MANAGER)
 def user_report(request):
-    if not is_manager(request.user):
-        return redirect(reverse('bikes:index'))
-    
-    users = UserProfile.objects.all()
-    hires = BikeHires.objects.all().select_related('bike', 'user', 'start_station', 'end_station')
-
-    # Count the number of users for each membership type (standard, student, pensioner, staff)
-    membershiptype_counts = users.values('membership_type').annotate(membership_count=Count('membership_type'))
-    memberships = [MembershipType.get_choice(m['membership_type']) for m in membershiptype_counts]
-    member_counts = [m['membership_count'] for m in membershiptype_counts]
-    plot = figure(x_range=memberships, plot_height=300, plot_width=300, title="Users by membership type", toolbar_location="below")
-    source = ColumnDataSource(data=dict(memberships=memberships, member_counts=member_counts, color=Spectral6))
-
-    plot.vbar(x='memberships', top='member_counts', width=.8, color='color', source=source)
-
-    script, div = components(plot)
-
-    # Count the number of users for each user type (customer, operator, manager)
-    usertypes_counts = users.values('user_type').annotate(user_count=Count('user_type'))
-    user_types = [UserType.get_choice(u['user_type']) for u in usertypes_counts]
-    user_counts = [u['user_count'] for u in usertypes_counts]
-    usertype_plot = figure(x_range=user_types, plot_height=300, plot_width=300, title="Users by type", toolbar_location="below")
-    source2 = ColumnDataSource(data=dict(user_types=user_types, user_counts=user_counts, color=Spectral6))
-
-    usertype_plot.vbar(x='user_types', top='user_counts', width=.8, color='color', source=source2)
-
-    # users in order of number of hires
-    user_hirecount = hires.values('user').order_by('user').annotate(num_hires=Count('user_id')) \
-        .order_by('num_hires')
-
-    # user charge totals
-    user_charge_totals = hires.values('user').order_by('user').annotate(total=Sum('charges')) \
-        .order_by('total')
-
-    # hires_by_month 
-    hires_by_month = hires.values('date_hired').order_by('date_hired').filter(end_station__isnull=False)
-    num_hires_per_month = {
-        k: len(list(v)) for k,v in groupby(hires_by_month, key=lambda date: date['date_hired'].month)
-    }
+    context = cached_report('user-report', request.GET, _user_report_context)
+    return render(request, 'reports/user-report.html', context)
 
-    # total distance cycles
-    total_distance_cycled = sum([ride_distance(hire).km for hire in hires if hire.end_station is not None])
-
-    # number of rides per user type
-    hires_per_usertype = hires.values('user__membership_type').order_by('user__membership_type') \
-        .annotate(num_hires=Count('id'))
-
-    ###
-
-    script2, div2 = components(usertype_plot)
+def _user_report_context():
     context = {
-        "script": script,
-        "div": div,
-        "script2": script2,
-        "div2": div2,
-        "usercount": users.count(),
-        "total_distance_cycled": total_distance_cycled,
+        "usercount": UserProfile.objects.count(),
+        "total_distance_cycled": float(ride_distances(BikeHires.objects.all()).sum()),
     }
 
-    return render(request, "reports/user-report.html", context)
+    return context
 
-@login_required
+@role_required(UserType.MANAGER)
 def financial_report(request):
     """ Generates the application's Financial Report """
 
-    if not is_manager(request.user):
-        return redirect(reverse('bikes:index'))
-
-    # All hires
-    hires = BikeHires.objects.all().select_related('bike', 'user', 'start_station', 'end_station')
-
-    # total income from rides
-    total_income = hires.aggregate(income=Sum('charges'))
-    
-    # average per ride
-    avg_per_ride = BikeHires.objects.aggregate(avg=Avg('charges'))
-
-    # maximum charges for individual rides
-    maximum_charges = BikeHires.objects.annotate(max_charge=Max('charges')).order_by('-max_charge')[0]
-
-    # get hire charges ordered from smallest to largest charge
-    hires_by_charge = hires.order_by('charges').values('charges').filter(charges__isnull=False)
-
-    # create a histogram showing distribution of bike charges    
-    arr = np.array([h['charges'] for h in list(hires_by_charge)])
-    bins = np.arange(0, arr[-1], 1)
-    hist, edges = np.histogram(arr, bins=bins)
-
-    # hire_charge_source = ColumnDataSource(
-    #     data=dict(costs=list(hires_by_charge_quantized.keys()), count=list(hires_by_charge_quantized.values()))
-    # )
-    hist_figure = figure(plot_height = 400, plot_width = 450, 
-            title = 'Bike Charges - distribution',
-            x_axis_label = 'Cost (£)', 
-            y_axis_label = 'Number of rides')
-
-    hist_figure.quad(bottom=0, top=hist, left=edges[:-1], right=edges[1:], fill_color='red', line_color='black')
-    
-    hist1_script, hist1_div = components(hist_figure)
-
-    # percentage of rides that have a discount applied
-    discount_pct = hires.aggregate(has_dis=Count('discount_applied'))['has_dis'] / hires.count() * 100
-
-    # charges per month
-    charges_by_month = hires.values('date_hired', 'charges').order_by('date_hired').filter(charges__isnull=False)
-    hbm = {
-        k: sum(v['charges'] for v in list(v)) \
-            for k,v in groupby(charges_by_month, key=lambda date: date['date_hired'].month)
-    }
-    months = [calendar.month_abbr[a] for a in list(hbm.keys())]
-    charges = [c for c in list(hbm.values())]
-
-    per_month_fig = figure(title="Income per month", plot_height=400, plot_width=400, y_range=months,
-                    x_axis_label = 'Cost (£)', y_axis_label = 'Month')
-    per_month_fig.hbar(y=months, left=0, right=charges, height=.5, color="#CAB2D6")
-
-    mscript, mdiv = components(per_month_fig)
-
-
-    # charges per user type
-    charges_per_usertype = hires.values('user__membership_type').order_by('user__membership_type') \
-        .annotate(amt=Sum('charges'))
-    
-    memberships = [u[1] for u in MembershipType.CHOICES]
-    costs = [m['amt'] for m in charges_per_usertype]
-
-    usertype_fig = figure(title="Income per Membership Type", plot_height=400, plot_width=400,
-        y_axis_label = 'Total Charges', x_range=memberships)
-
-    usertype_fig.vbar(x=memberships, bottom=0, top=costs, width=.8)
-
-    utype_script, utype_div = components(usertype_fig)
-
-    # users with outstanding charges
-    users_in_debt = UserProfile.objects.filter(charges__gt=0)
-
-    # total amount still to be collected in charges
-    total_charges_for_collection = users_in_debt.aggregate(charges=Sum('charges'))
-
-    # amount liquid
-    liquid_money = total_income['income'] - total_charges_for_collection['charges']
-
-    # amount saved by discounts
-    discount_savings = UserDiscounts.objects.aggregate(saved=Sum('amount_saved'))['saved']
-
-    # total number of repairs
-    total_repairs = BikeRepairs.objects.count()
+    context = cached_report('financial-report', request.GET, _financial_report_context)
+    return render(request, 'reports/financial-report.html', context)
 
-    # repair cost total
-    repair_cost = BikeRepairs.objects.aggregate(total=Sum('repair_cost'))['total']
+def _financial_report_context():
+    summary = cached_financial_summary()
 
     context = {
-        "hist1_div": hist1_div,
-        "hist1_script": hist1_script,
-        "total_income": total_income['income'],
-        "avg_per_ride": avg_per_ride['avg'],
-        "maximum_charges": maximum_charges.max_charge,
-        "discount_pct": discount_pct,
-        "users_in_debt": users_in_debt.count(),
-        "uncollected_charges": total_charges_for_collection['charges'],
-        "discount_savings": discount_savings,
-        "mscript": mscript,
-        "mdiv": mdiv,
-        "utype_script": utype_script,
-        "utype_div": utype_div,
-        "total_repairs": total_repairs,
-        "repair_cost": repair_cost
+        "total_income": summary.total_income,
+        "avg_per_ride": summary.avg_per_ride,
+        "maximum_charges": summary.maximum_charges,
+        "discount_pct": summary.discount_pct,
+        "users_in_debt": summary.users_in_debt,
+        "uncollected_charges": summary.uncollected_charges,
+        "discount_savings": summary.discount_savings,
+        "total_repairs": summary.total_repairs,
+        "repair_cost": summary.repair_cost
     }
 
+    return context
 
-    return render(request, 'reports/financial-report.html', context)
+@role_required(UserType.MANAGER)
+def tariff_simulator(request):
+    """ Re-prices the hire history under a tariff entered by the manager, and compares it to actual revenue """
 
-@login_required
+    current = Tariff.current()
+    context = {}
+    if request.GET:
+        form = TariffForm(request.GET)
+    else:
+        form = TariffForm(initial=TariffForm.initial_from_tariff(current))
+
+    if form.is_bound and form.is_valid():
+        from bokeh.embed import components
+        from bokeh.models import HoverTool, ColumnDataSource
+        from bokeh.plotting import figure
+
+        simulation = simulate_tariff(form.tariff())
+
+        months = [f"{calendar.month_abbr[month]} {year}" for year, month in simulation.by_month]
+        source = ColumnDataSource(data=dict(
+            months=months,
+            actual=[r.actual for r in simulation.by_month.values()],
+            simulated=[r.simulated for r in simulation.by_month.values()]
+        ))
+        month_fig = figure(title="Revenue per month", plot_height=400, plot_width=800, x_range=months,
+            y_axis_label='Revenue (£)', toolbar_location="below")
+        month_fig.line(x='months', y='actual', line_width=2, color='grey', legend="Actual", source=source)
+        month_fig.line(x='months', y='simulated', line_width=2, color='green', legend="Simulated", source=source)
+        month_fig.xaxis.major_label_orientation = math.pi/4
+        month_fig.add_tools(HoverTool(tooltips=[("Month", "@months"), ("Actual", "£@actual{0.00}"),
+            ("Simulated", "£@simulated{0.00}")]))
+        script, div = components(month_fig)
+
+        context.update({
+            "simulation": simulation,
+            "by_membership": [
+                (MembershipType.get_choice(membership) or "Unknown", revenue)
+                for membership, revenue in simulation.by_membership.items()
+            ],
+            "by_month": list(zip(months, simulation.by_month.values())),
+            "script": script,
+            "div": div
+        })
+
+    context["form"] = form
+    return render(request, 'reports/tariff-simulator.html', context)
+
+@role_required(UserType.MANAGER)
 def path_routes(request):
-    if not is_manager(request.user):
-        return redirect(reverse('bikes:index'))
-    SAVE_PATH = os.path.join(settings.STATIC_DIR, 'network.png')
-    locations = Location.objects.all()
+    context = cached_report('path-routes', request.GET, lambda: _path_routes_context(request.GET))
+    return render(request, 'reports/path-routes.html', context)
 
-    # add nodes to graph
-    G = nx.DiGraph()
-    for loc in locations:
-        G.add_node(loc.station_name, pos=(loc.longitude, loc.latitude))
+@role_required(UserType.MANAGER)
+def path_routes_graph(request):
+    """ The path_routes network graph, as a PNG. Takes the same parameters as the path_routes page """
+    image = cached_report('path-routes-graph', request.GET, lambda: _path_routes_graph(request.GET))
+    return HttpResponse(image, content_type='image/png')
 
-    station_urlparam = request.GET.get('station', None)
+def _route_counts(params):
+    """ Returns the stations, the selected station, and the number of journeys from it to each other station
+        as {(station name, destination name): count}, for the path_routes station and date parameters
+    """
+    locations = Location.objects.all()
+
+    station_urlparam = params.get('station', None)
     if station_urlparam is None:
         station = locations.first()
     else:
         station = locations.get(pk=station_urlparam)
 
     # extract date args from request (if given)
-    date_from = request.GET.get('date_from', None)
-    date_to   = request.GET.get('date_to', None)
-    date_from_should_filter = date_from is not None and len(date_from) > 0
-    date_to_should_filter = date_to is not None and len(date_to) > 0
-
-
-    # get all hires from the given station. filter by date if applicable
-    station_links = BikeHires.objects.filter(start_station=station, end_station__isnull=False) \
-        .select_related('start_station', 'end_station')
+    date_from, date_to = report_dates(params)
 
-    if date_from_should_filter and date_to_should_filter:
+    # number of rides from the given station to every other station, filtered by date if applicable
+    if date_from and date_to:
         date_from, date_to = parse_dates(date_from, date_to)
-        station_links = station_links.filter(date_hired__gt=date_from, date_hired__lt=date_to)
-        ride_counts = BikeHires.objects.filter(start_station=station, date_hired__gt=date_from, date_hired__lt=date_to) \
-            .values('end_station').order_by('end_station').annotate(cnt=Count('end_station'))
+        ride_counts = trip_counts(station, date_from.date(), date_to.date())
     else:
-        # get number of rides from given station to all other stations
-        ride_counts = BikeHires.objects.filter(start_station=station, end_station__isnull=False) \
-            .values('end_station').order_by('end_station').annotate(cnt=Count('end_station'))
+        ride_counts = trip_counts(station)
 
-    # add edges to the graphs for all rides
-    for hire in station_links:
-        start = hire.start_station.station_name
-        end   = hire.end_station.station_name
-        G.add_edge(start, end) # add edge to graph
-
-    # construct journey counts formatted for adding label to each edge in the graph
+    # construct journey counts formatted for adding label to each edge in the graph, without self loops
+    names = {loc.pk: loc.station_name for loc in locations}
     edge_counts = {
-        (station.station_name, 
-        Location.objects.get(pk=e['end_station']).station_name): e['cnt'] for e in ride_counts
+        (station.station_name, names[end]): count
+        for (start, end), count in sorted(ride_counts.items()) if end != station.pk
     }
+    return locations, station, edge_counts
+
+def _path_routes_context(params):
+    locations, station, edge_counts = _route_counts(params)
+
+    # the graph is fetched from path_routes_graph, for the same station and dates
+    date_from, date_to = report_dates(params)
+    graph_params = {"station": station.pk}
+    if date_from and date_to:
+        graph_params.update(date_from=date_from, date_to=date_to)
+
+    context = {
+        "graph_url": f"{reverse('reports:path_routes_graph')}?{urlencode(graph_params)}",
+        "ride_counts": edge_counts,
+        "current_station": station,
+        "locations": locations,
+        "date_from": date_from,
+        "date_to": date_to
+    }
+
+    return context
+
+def _path_routes_graph(params):
+    """ Draws the journeys from a station over a map-like layout - each station at its longitude and latitude,
+        so every graph has the same shape - and returns the PNG image
+    """
+    from matplotlib.figure import Figure
+    import networkx as nx
 
-    # remove self loops from the graph
-    if (station.station_name, station.station_name) in edge_counts.keys():
-        del edge_counts[(station.station_name, station.station_name)]
+    locations, station, edge_counts = _route_counts(params)
+
+    # add nodes to graph. Longitude is scaled by cos(latitude), so distances are about right across Glasgow
+    G = nx.DiGraph()
+    graph_pos = {}
+    for loc in locations:
+        G.add_node(loc.station_name)
+        graph_pos[loc.station_name] = (loc.longitude * math.cos(math.radians(loc.latitude)), loc.latitude)
+    G.add_edges_from(edge_counts)
 
     # graph options
     options = {
-        'node_color': 'blue',
+        'node_color': ['red' if name == station.station_name else 'blue' for name in G],
         'node_size': 30,
-        'line_color': 'grey',
         'linewidths': 1,
         'edge_color': 'green',
         'width': 2
     }
-    fig = plt.figure(figsize=(12,8))
-    graph_pos=nx.spring_layout(G)
-
-    labels = {k:k for k in list(graph_pos.keys())}
+    # a Figure of its own rather than pyplot's global one, which isn't safe to use from several threads
+    fig = Figure(figsize=(12,8))
+    ax = fig.subplots()
 
     # draw graph
-    nx.draw_networkx_edge_labels(G, graph_pos, edge_labels=edge_counts,font_size=16)
-    nx.draw_networkx_nodes(G,graph_pos, **options)
-    nx.draw_networkx_edges(G,graph_pos, width=2)
+    nx.draw_networkx_edge_labels(G, graph_pos, edge_labels=edge_counts,font_size=16, ax=ax)
+    nx.draw_networkx_nodes(G,graph_pos, ax=ax, **options)
+    nx.draw_networkx_edges(G,graph_pos, width=2, ax=ax)
 
-    # get the given station's y coordinate on figure
+    # draw station labels on graph, above or below the station to move them off the edges from the given station
+    ys = [y for x, y in graph_pos.values()]
+    offset = (max(ys) - min(ys)) * .03
     station_ycoord = graph_pos[station.station_name][1]
-
-    # draw station labels on graph
     for k,v in graph_pos.items():
-        if k == station.station_name:
-            continue
         if v[1] >= float(station_ycoord):
-            plt.text(v[0], v[1] + .075, k, fontsize=10, bbox=dict(facecolor='red', alpha=0.3), horizontalalignment='center')
+            ax.text(v[0], v[1] + offset, k, fontsize=10, bbox=dict(facecolor='red', alpha=0.3), horizontalalignment='center')
         else:
-            plt.text(v[0], v[1] - .075, k, fontsize=10, bbox=dict(facecolor='red', alpha=0.3), horizontalalignment='center')
+            ax.text(v[0], v[1] - offset, k, fontsize=10, bbox=dict(facecolor='red', alpha=0.3), horizontalalignment='center')
 
-    plt.title(f"Number of journeys from {station.station_name} \n(centred on graph)")      
-    plt.axis('off')
-    plt.savefig(SAVE_PATH)
-    context = {
-        "impath": 'network.png',
-        "ride_counts": edge_counts,
-        "current_station": station,
-        "locations": locations,
-        "date_from": request.GET.get('date_from', None),
-        "date_to": request.GET.get('date_to', None)
-    }
-
-    return render(request, 'reports/path-routes.html', context)
+    ax.set_title(f"Number of journeys from {station.station_name} \n(in red)")
+    ax.axis('off')
 
+    image = io.BytesIO()
+    fig.savefig(image, format='png')
+    return image.getvalue()
 
+@role_required(UserType.MANAGER)
 def bike_status(request):
-    from bokeh.transform import cumsum
-    from bokeh.palettes import Category20c
-    bikes = Bikes.objects.all()
-    total_bikes = bikes.count()
-    num_onhire = bikes.filter(status=BikeStatus.ON_HIRE).count()
-    num_repaired = bikes.filter(status=BikeStatus.BEING_REPAIRED).count()
-    num_available = bikes.filter(status=BikeStatus.AVAILABLE).count()
-
-    statuses = [b[1] for b in BikeStatus.CHOICES]
-    counts = [b['cnt'] for b in Bikes.objects.values('status').order_by('status').annotate(cnt=Count('status'))]
-
-    p = figure(plot_height=350, title="Current Bike Statuses", x_range=statuses)
-
-    p.vbar(x=statuses, bottom=0, top=counts, width=.8)
+    context = cached_report('bike-status', request.GET, _bike_status_context)
+    return render(request, 'reports/bike-status.html', context)
 
-    script, div = components(p)
+def _bike_status_context():
+    counts = dict(Bikes.objects.values_list('status').annotate(cnt=Count('pk')).order_by())
 
     context = {
-        "total_bikes": total_bikes,
-        "num_onhire": num_onhire,
-        "num_repaired": num_repaired,
-        "num_available": num_available,
-        "script": script,
-        "div": div
+        "total_bikes": sum(counts.values()),
+        "num_onhire": counts.get(BikeStatus.ON_HIRE, 0),
+        "num_repaired": counts.get(BikeStatus.BEING_REPAIRED, 0),
+        "num_available": counts.get(BikeStatus.AVAILABLE, 0)
     }
 
-    return render(request, 'reports/bike-status.html', context)
\ No newline at end of file
+    return context
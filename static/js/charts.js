@@ -0,0 +1,139 @@
+/**
+ * Draws the report charts in the browser, with the BokehJS API.
+ * Each chart is an element like <div class="report-chart" data-chart="income-per-month" data-url="...">,
+ * where data-url is its JSON data (see reports/charts.py) and data-chart picks the function below that draws it.
+ * A chart's data is only fetched once the chart is about to scroll into view.
+ */
+(function() {
+
+    var SPECTRAL6 = ["#3288bd", "#99d594", "#e6f598", "#fee08b", "#fc8d59", "#d53e4f"];
+
+    function colours(n) {
+        var result = [];
+        for (var i = 0; i < n; i++) {
+            result.push(SPECTRAL6[i % SPECTRAL6.length]);
+        }
+        return result;
+    }
+
+    /* A vertical bar per category, optionally coloured by category */
+    function categoryBars(x, top, options) {
+        var source = new Bokeh.ColumnDataSource({data: {x: x, top: top, color: colours(x.length)}});
+        var plot = Bokeh.Plotting.figure(Object.assign({
+            x_range: x, y_range: [0, Math.max.apply(null, top.concat([0])) + 2],
+            tools: "pan,wheel_zoom,box_zoom,reset,save,hover", toolbar_location: "below"
+        }, options));
+        plot.vbar({
+            x: {field: "x"}, top: {field: "top"}, width: 0.8, source: source,
+            fill_color: options.colour ? {value: options.colour} : {field: "color"}, line_color: {value: "white"}
+        });
+        return plot;
+    }
+
+    var charts = {
+        "location-counts": function(data) {
+            var plot = categoryBars(data.stations, data.bike_counts, {title: "Bikes per location", plot_height: 400});
+            plot.below.forEach(function(axis) { axis.major_label_orientation = Math.PI / 6; });
+            return plot;
+        },
+
+        "location-history": function(data, element) {
+            var source = new Bokeh.ColumnDataSource({
+                data: {datetime: data.datetime, count: data.count, low: data.min, high: data.max}
+            });
+            var plot = Bokeh.Plotting.figure({x_axis_type: "datetime", plot_height: 400, tools: "pan,wheel_zoom,box_zoom,reset,save"});
+            if (data.resolution != "raw") {
+                // shade the range of counts seen within each hour/day
+                plot.varea({x: {field: "datetime"}, y1: {field: "low"}, y2: {field: "high"}, fill_alpha: 0.2, source: source});
+                $(element).after('<p class="text-muted small">Showing the count at the end of each ' + data.resolution +
+                    '. The shaded area is the range of counts within the ' + data.resolution + '.</p>');
+            }
+            plot.step({x: {field: "datetime"}, y: {field: "count"}, line_width: 2, mode: "before", source: source});
+            plot.add_tools(new Bokeh.HoverTool({
+                tooltips: [["Date", "@datetime{%F %H:%M}"], ["Count", "@count"], ["Range", "@low - @high"]],
+                formatters: {datetime: "datetime"}
+            }));
+            return plot;
+        },
+
+        "membership-counts": function(data) {
+            return categoryBars(data.memberships, data.counts, {title: "Users by membership type", plot_height: 300, plot_width: 300});
+        },
+
+        "user-type-counts": function(data) {
+            return categoryBars(data.user_types, data.counts, {title: "Users by type", plot_height: 300, plot_width: 300});
+        },
+
+        "income-per-month": function(data) {
+            var source = new Bokeh.ColumnDataSource({data: {month: data.months, income: data.income}});
+            var plot = Bokeh.Plotting.figure({
+                title: "Income per month", plot_height: 400, plot_width: 400, y_range: data.months,
+                x_axis_label: "Cost (£)", y_axis_label: "Month", tools: "pan,wheel_zoom,reset,save"
+            });
+            plot.hbar({y: {field: "month"}, left: {value: 0}, right: {field: "income"}, height: 0.5,
+                fill_color: {value: "#CAB2D6"}, line_color: {value: "#CAB2D6"}, source: source});
+            return plot;
+        },
+
+        "income-per-membership": function(data) {
+            return categoryBars(data.memberships, data.income, {
+                title: "Income per Membership Type", plot_height: 400, plot_width: 400,
+                y_axis_label: "Total Charges", colour: "#1f77b4"
+            });
+        },
+
+        "charge-histogram": function(data) {
+            var source = new Bokeh.ColumnDataSource({data: {
+                left: data.lower,
+                right: data.lower.map(function(lower) { return lower + data.bin_width; }),
+                top: data.rides
+            }});
+            var plot = Bokeh.Plotting.figure({
+                title: "Bike Charges - distribution", plot_height: 400, plot_width: 450,
+                x_axis_label: "Cost (£)", y_axis_label: "Number of rides", tools: "pan,wheel_zoom,reset,save"
+            });
+            plot.quad({left: {field: "left"}, right: {field: "right"}, top: {field: "top"}, bottom: {value: 0},
+                fill_color: {value: "red"}, line_color: {value: "black"}, source: source});
+            return plot;
+        },
+
+        "bike-statuses": function(data) {
+            return categoryBars(data.statuses, data.counts, {title: "Current Bike Statuses", plot_height: 350, colour: "#1f77b4"});
+        }
+    };
+
+    function draw(element) {
+        // the browser revalidates the data with its ETag, so unchanged data comes back as a 304 from its cache
+        fetch(element.dataset.url, {credentials: "same-origin"})
+            .then(function(response) {
+                if (!response.ok) {
+                    throw new Error(response.statusText);
+                }
+                return response.json();
+            })
+            .then(function(data) {
+                Bokeh.Plotting.show(charts[element.dataset.chart](data, element), element);
+            })
+            .catch(function() {
+                $(element).html('<p class="text-danger">This chart could not be loaded.</p>');
+            });
+    }
+
+    $(document).ready(function() {
+        var elements = document.querySelectorAll(".report-chart");
+        if (!("IntersectionObserver" in window)) {
+            elements.forEach(draw);
+            return;
+        }
+        var observer = new IntersectionObserver(function(entries) {
+            entries.forEach(function(entry) {
+                if (entry.isIntersecting) {
+                    observer.unobserve(entry.target);
+                    draw(entry.target);
+                }
+            });
+        }, {rootMargin: "200px"}); // start loading just before the chart comes into view
+        elements.forEach(function(element) { observer.observe(element); });
+    });
+
+})();